@@ -1,10 +1,46 @@
 # auth.py
+"""
+Login OIDC (authorization code) e sessione utente.
+
+I token restano in sessione (session_store). login_required li tiene validi
+senza rifare il giro di redirect verso il provider:
+  - a meno di OIDC_REFRESH_MARGIN secondi dalla scadenza dell'access token
+    parte un rinnovo in background (grant refresh_token), la richiesta non
+    aspetta; la richiesta successiva trova i token nuovi e li salva;
+  - a token già scaduto il rinnovo è sincrono; se fallisce (refresh token
+    scaduto o revocato) si torna al login.
+Il risultato di un rinnovo è condiviso tra i worker (shared_state) per
+qualche minuto: richieste parallele e worker diversi con lo stesso refresh
+token ne fanno uno solo, anche se il provider ruota il refresh token.
+
+I token ricevuti sono verificati (firma, scadenza, issuer se configurato)
+con le chiavi JWKS del provider, tenute in cache per OIDC_JWKS_TTL secondi e
+riscaricate solo se arriva un kid sconosciuto; i claim verificati restano in
+memoria fino alla scadenza del token. L'URL delle chiavi è OIDC_JWKS_URL o,
+se manca, il jwks_uri del documento di discovery del provider
+(.well-known/openid-configuration), cercato in ordine su OIDC_DISCOVERY_URL,
+OIDC_ISSUER, base del realm Keycloak e origine di OIDC_TOKEN_URL. Se il
+provider non pubblica nessun documento di discovery i claim vengono letti
+senza verifica, come prima (con un avviso nel log); un errore di rete invece
+fa fallire la verifica, senza degradare a token non verificati.
+
+ENV (oltre alle OIDC_* obbligatorie):
+  OIDC_JWKS_URL          (default: vuoto) URL delle chiavi; vuoto = jwks_uri dalla discovery
+  OIDC_DISCOVERY_URL     (default: vuoto) URL di .well-known/openid-configuration, se non standard
+  OIDC_ISSUER            (default: vuoto) issuer atteso; vuoto = non controllato
+  OIDC_JWKS_TTL          (default: 86400) secondi di cache delle chiavi
+  OIDC_REFRESH_MARGIN    (default: 60)    secondi prima della scadenza in cui si rinnova
+  OIDC_USERINFO_MAX_AGE  (default: 300)   cache privata del browser per /api/userinfo
+"""
 from flask import Blueprint, request, session, redirect, url_for, jsonify
 from urllib.parse import urlencode, urlparse
 from functools import wraps
-import os, time, json, requests, jwt
+from collections import OrderedDict
+import os, time, json, hashlib, threading, requests, jwt
 from dotenv import load_dotenv
 
+from shared_state import FileLock, SharedCache, shared_path
+
 auth_bp = Blueprint("auth", __name__)
 
 # ========== Config ==========
@@ -20,6 +56,14 @@ OIDC_USERINFO_URL  = os.getenv("OIDC_USERINFO_URL")
 # opzionale: limita i redirect post-login all’host corrente
 ALLOW_EXTERNAL_REDIRECTS = os.getenv("ALLOW_EXTERNAL_REDIRECTS", "0") == "1"
 
+# verifica dei token e rinnovo (vedi docstring)
+OIDC_JWKS_URL         = os.getenv("OIDC_JWKS_URL", "")
+OIDC_DISCOVERY_URL    = os.getenv("OIDC_DISCOVERY_URL", "")
+OIDC_ISSUER           = os.getenv("OIDC_ISSUER", "")
+OIDC_JWKS_TTL         = int(os.getenv("OIDC_JWKS_TTL", "86400"))
+OIDC_REFRESH_MARGIN   = int(os.getenv("OIDC_REFRESH_MARGIN", "60"))
+OIDC_USERINFO_MAX_AGE = int(os.getenv("OIDC_USERINFO_MAX_AGE", "300"))
+
 REQUIRED_VARS = [
     "OIDC_CLIENT_ID","OIDC_CLIENT_SECRET","OIDC_REDIRECT_URI",
     "OIDC_AUTH_URL","OIDC_TOKEN_URL"
@@ -48,11 +92,253 @@ def _safe_next(default_url: str) -> str:
     return nxt if _same_host(current_origin, nxt) else default_url
 
 
+# ========== Verifica token (JWKS in cache) ==========
+_jwks_cache = SharedCache("oidc-jwks")
+_jwks_lock = threading.Lock()
+_jwks: dict = {}                                  # kid -> PyJWK
+_claims_cache: OrderedDict = OrderedDict()        # sha256(token) -> claims verificati
+_claims_lock = threading.Lock()
+_CLAIMS_CACHE_SIZE = 1024
+
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+_WELL_KNOWN = "/.well-known/openid-configuration"
+_jwks_url: str | None = None                      # risolto al primo uso; "" = nessuna chiave pubblicata
+
+
+def _discovery_urls() -> list[str]:
+    """Dove cercare il documento di discovery, in ordine (vedi docstring)."""
+    urls = [OIDC_DISCOVERY_URL] if OIDC_DISCOVERY_URL else []
+    if OIDC_ISSUER:
+        urls.append(OIDC_ISSUER.rstrip("/") + _WELL_KNOWN)
+    if "/protocol/openid-connect/" in OIDC_TOKEN_URL:   # Keycloak: .../realms/<realm>/protocol/...
+        urls.append(OIDC_TOKEN_URL.split("/protocol/openid-connect/")[0] + _WELL_KNOWN)
+    origin = urlparse(OIDC_TOKEN_URL)
+    urls.append(f"{origin.scheme}://{origin.netloc}{_WELL_KNOWN}")
+    return list(dict.fromkeys(urls))
+
+
+def _resolve_jwks_url() -> str:
+    """OIDC_JWKS_URL o jwks_uri dalla discovery (in cache); "" se il provider non ne pubblica."""
+    global _jwks_url
+    if _jwks_url is not None:
+        return _jwks_url
+    url = OIDC_JWKS_URL or _jwks_cache.get("jwks_uri")
+    if url is None:
+        url = ""
+        for candidate in _discovery_urls():
+            # errori di rete: eccezione, si riprova alla prossima richiesta
+            r = requests.get(candidate, timeout=10)
+            if r.status_code != 200:
+                continue
+            try:
+                url = r.json().get("jwks_uri") or ""
+            except ValueError:
+                continue
+            if url:
+                break
+        if not url:
+            print(f"[OIDC][WARN] Nessun jwks_uri ({', '.join(_discovery_urls())}): "
+                  f"token NON verificati, impostare OIDC_JWKS_URL", flush=True)
+        _jwks_cache.set("jwks_uri", url, OIDC_JWKS_TTL)
+    _jwks_url = url
+    return url
+
+
+def _signing_key(kid: str | None):
+    """Chiave JWKS per `kid`: cache del processo, poi cache condivisa, poi il provider."""
+    with _jwks_lock:
+        if kid in _jwks:
+            return _jwks[kid]
+        for fresh in (False, True):
+            data = None if fresh else _jwks_cache.get("jwks")
+            if data is None:
+                r = requests.get(_resolve_jwks_url(), timeout=10)
+                r.raise_for_status()
+                data = r.json()
+                _jwks_cache.set("jwks", data, OIDC_JWKS_TTL)
+            keys = jwt.PyJWKSet.from_dict(data).keys
+            _jwks.clear()
+            _jwks.update({k.key_id: k for k in keys})
+            if kid in _jwks:
+                return _jwks[kid]
+            if kid is None and len(keys) == 1:
+                return keys[0]
+        raise jwt.InvalidTokenError(f"Chiave di firma sconosciuta (kid={kid})")
+
+
+def verify_token(token: str) -> dict:
+    """Claim dell'access token, verificato con le chiavi JWKS (risultato in cache fino alla scadenza)."""
+    h = _token_hash(token)
+    now = time.time()
+    with _claims_lock:
+        cached = _claims_cache.get(h)
+        if cached is not None and cached.get("exp", now + 1) > now:
+            _claims_cache.move_to_end(h)
+            return cached
+
+    with _jwks_lock:
+        jwks_url = _resolve_jwks_url()
+    if not jwks_url:
+        claims = jwt.decode(token, options={"verify_signature": False, "verify_aud": False})
+    else:
+        header = jwt.get_unverified_header(token)
+        key = _signing_key(header.get("kid"))
+        # algoritmo della chiave JWKS, non quello dichiarato dal token; solo firme asimmetriche
+        alg = key.algorithm_name or "RS256"
+        if alg.upper().startswith("HS") or alg.lower() == "none":
+            raise jwt.InvalidTokenError(f"Algoritmo di firma non ammesso: {alg}")
+        claims = jwt.decode(
+            token, key.key, algorithms=[alg],
+            issuer=OIDC_ISSUER or None, leeway=30,
+            options={"verify_aud": False, "verify_iss": bool(OIDC_ISSUER)},
+        )
+
+    with _claims_lock:
+        _claims_cache[h] = claims
+        while len(_claims_cache) > _CLAIMS_CACHE_SIZE:
+            _claims_cache.popitem(last=False)
+    return claims
+
+
+# ========== Token in sessione e rinnovo ==========
+# sha256(refresh token) -> token rinnovati, solo i campi usati da _store_tokens. Contiene
+# token validi: il database sta in SHARED_STATE_DIR, fuori dalla cartella servita, con
+# permessi 0600 (vedi shared_state), come quello delle sessioni che li contiene comunque
+_refreshed = SharedCache("oidc-refresh")
+_REFRESH_FIELDS = ("access_token", "refresh_token", "id_token", "expires_in", "refresh_expires_in")
+# lock per refresh token (64 file, scelti dall'hash): un rinnovo lento non blocca quelli degli altri utenti
+_refresh_locks = [FileLock(shared_path(f"oidc-refresh-{i:02x}.lock")) for i in range(64)]
+_refreshing: set = set()
+_refreshing_lock = threading.Lock()
+_REFRESH_RESULT_TTL = 300
+
+
+def _store_tokens(tokens: dict) -> dict:
+    """Salva in sessione i token della risposta del token endpoint; restituisce i claim verificati."""
+    claims = verify_token(tokens["access_token"])
+    obtained = int(tokens.get("obtained_at") or time.time())
+    refresh_expires_in = int(tokens.get("refresh_expires_in", 0))
+
+    session["access_token"]        = tokens["access_token"]
+    session["refresh_token"]       = tokens.get("refresh_token") or session.get("refresh_token")
+    session["expires_at"]          = obtained + int(tokens.get("expires_in", 300))
+    # 0 = scadenza non comunicata dal provider (es. token offline)
+    session["refresh_expires_at"]  = obtained + refresh_expires_in if refresh_expires_in else 0
+    if tokens.get("id_token"):
+        session["id_token"]        = tokens["id_token"]
+
+    session["user_email"] = claims.get("email")
+    session["user"]       = claims.get("preferred_username") or claims.get("email") or claims.get("sub")
+    session["user_info"]  = claims
+    return claims
+
+
+def _refresh(refresh_token: str) -> dict | None:
+    """
+    Grant refresh_token, una volta sola per refresh token tra tutti i thread e
+    worker: il risultato resta in _refreshed per _REFRESH_RESULT_TTL secondi.
+    None se il provider rifiuta il rinnovo.
+    """
+    key = _token_hash(refresh_token)
+    done = _refreshed.get(key)
+    if done is not None:
+        return done or None
+    with _refresh_locks[int(key[:2], 16) % len(_refresh_locks)]:
+        done = _refreshed.get(key)
+        if done is not None:
+            return done or None
+        try:
+            r = requests.post(
+                OIDC_TOKEN_URL,
+                data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": refresh_token,
+                    "client_id": OIDC_CLIENT_ID,
+                    "client_secret": OIDC_CLIENT_SECRET,
+                },
+                headers={"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=30,
+            )
+        except requests.RequestException as e:
+            print(f"[OIDC] rinnovo token fallito: {e}", flush=True)
+            return None
+        if r.status_code != 200:
+            print(f"[OIDC] rinnovo token rifiutato: {r.status_code} {r.text[:200]}", flush=True)
+            _refreshed.set(key, {}, _REFRESH_RESULT_TTL)  # niente nuovi tentativi con lo stesso token
+            return None
+        body = r.json()
+        tokens = {k: body[k] for k in _REFRESH_FIELDS if k in body}
+        tokens["obtained_at"] = int(time.time())
+        _refreshed.set(key, tokens, _REFRESH_RESULT_TTL)
+        return tokens
+
+
+def _refresh_async(refresh_token: str) -> None:
+    """Rinnovo in un thread daemon; un solo thread per refresh token nel processo."""
+    with _refreshing_lock:
+        if refresh_token in _refreshing:
+            return
+        _refreshing.add(refresh_token)
+
+    def _run():
+        try:
+            _refresh(refresh_token)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(refresh_token)
+
+    threading.Thread(target=_run, daemon=True, name="oidc-refresh").start()
+
+
+def _ensure_token() -> bool:
+    """True se la sessione ha un access token valido, rinnovandolo se serve (vedi docstring)."""
+    if "access_token" not in session:
+        return False
+    now = time.time()
+    if "expires_at" not in session or session["expires_at"] - now > OIDC_REFRESH_MARGIN:
+        return True  # caso comune: nessun accesso al provider né alla cache condivisa
+
+    # rinnovo già fatto (in background, da un'altra richiesta o da un altro worker)
+    refresh_token = session.get("refresh_token")
+    if refresh_token:
+        done = _refreshed.get(_token_hash(refresh_token))
+        if done:
+            try:
+                _store_tokens(done)
+                refresh_token = session.get("refresh_token")
+            except jwt.InvalidTokenError as e:
+                print(f"[OIDC] token rinnovato non valido: {e}", flush=True)
+
+    expires_at = session.get("expires_at", 0)
+    if expires_at - now > OIDC_REFRESH_MARGIN:
+        return True
+    refresh_expires_at = session.get("refresh_expires_at", 0)
+    if not refresh_token or (refresh_expires_at and refresh_expires_at <= now):
+        return expires_at > now
+    if expires_at > now:
+        _refresh_async(refresh_token)
+        return True
+
+    tokens = _refresh(refresh_token)
+    if tokens is None:
+        return False
+    try:
+        _store_tokens(tokens)
+    except jwt.InvalidTokenError as e:
+        print(f"[OIDC] token rinnovato non valido: {e}", flush=True)
+        return False
+    return True
+
+
 # ========== Decoratore ==========
 def login_required(fn):
     @wraps(fn)
     def _wrapped(*args, **kwargs):
-        if "access_token" not in session:
+        if not _ensure_token():
             nxt = request.url
             return redirect(url_for("auth.login", next=nxt))
         return fn(*args, **kwargs)
@@ -98,26 +384,9 @@ def oidc_callback():
             timeout=30,
         )
         token_response.raise_for_status()
-        tokens = token_response.json()
-
-        access_token        = tokens["access_token"]
-        refresh_token       = tokens.get("refresh_token")
-        id_token            = tokens.get("id_token")
-        expires_in          = int(tokens.get("expires_in", 300))
-        refresh_expires_in  = int(tokens.get("refresh_expires_in", 0))
-
-        # salva in sessione
-        session["access_token"]        = access_token
-        session["refresh_token"]       = refresh_token
-        session["expires_at"]          = int(time.time()) + expires_in
-        session["refresh_expires_at"]  = int(time.time()) + refresh_expires_in
-        session["id_token"]            = id_token
-
-        # decodifica senza verifica firma (solo per leggere claim)
-        decoded = jwt.decode(access_token, options={"verify_signature": False, "verify_aud": False})
-        session["user_email"] = decoded.get("email")
-        session["user"]       = decoded.get("preferred_username") or decoded.get("email") or decoded.get("sub")
-        session["user_info"]  = decoded
+
+        # salva in sessione token e claim (verificati con le chiavi JWKS, vedi verify_token)
+        decoded = _store_tokens(token_response.json())
 
         # opzionale: vincolo utenti CNR
         if decoded.get("is_cnr_user") is False:
@@ -169,7 +438,12 @@ def logout():
 @auth_bp.route("/api/userinfo")
 @login_required
 def userinfo():
-    return jsonify({
+    """Dati dell'utente dai claim già verificati in sessione, in cache privata del browser."""
+    resp = jsonify({
         "email": session.get("user_email"),
         "username": session.get("user"),
     })
+    resp.cache_control.private = True
+    resp.cache_control.max_age = OIDC_USERINFO_MAX_AGE
+    resp.vary.add("Cookie")
+    return resp
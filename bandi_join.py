@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Join lato server tra le fonti dei bandi per codice bando: URP
+(bandi-completi-urp.json), Selezioni Online (bandi-concorsi-pubblici-sol.json),
+Mobilità (bandi-mobilita.json) e RDP (bandi-con-rdp.json, se presente).
+
+Le pagine (index.html, stato-avanzamento.html) leggono il risultato,
+bandi-join.json, invece di confrontare ogni bando URP con tutti quelli SOL.
+Il file viene ricostruito da ogni scraper a fine giro (write_join, dopo aver
+salvato la propria fonte), all'avvio del processo web se è più vecchio delle
+fonti (start_rebuild) o a mano: python bandi_join.py
+
+Codice canonico (canonical_code): maiuscolo, senza accenti e senza diciture
+"BANDO N." / "Codice Bando", token alfanumerici separati da "-":
+  "380.1 TEC"              -> 380-1-TEC
+  "BANDO N. 365.198 CTER"  -> 365-198-CTER
+  "IREA BR-009-2025- BA"   -> IREA-BR-009-2025-BA
+
+Abbinamento di un codice URP con l'indice di un'altra fonte (CodeIndex),
+in tempo costante per codice, quindi O(n) in tutto:
+  1. stesso codice canonico                                   confidenza 1.0
+  2. stesso codice compatto (senza separatori e zeri iniziali) confidenza 0.95
+  3. blocco per prefisso numerico: i codici con gli stessi numeri (il numero
+     del bando, 367.600 e 367.601 sono bandi diversi); tra questi conta
+     quante sigle del codice più corto ritrovano una sigla dell'altro (uguale
+     o simile per trigrammi, es. ICMAT/ICMATE): confidenza fino a 0.9.
+     "ISAC-BR-07-2025" e "IREA-BR-07-2025" hanno gli stessi numeri ma sigle
+     diverse e non si abbinano;
+  4. se il blocco numerico è vuoto, blocchi per trigrammi del codice
+     compatto: candidati i cui numeri sono un prefisso di quelli cercati o
+     viceversa (es. "367.600" e "367.600 FA 2"), stesso punteggio x 0.85.
+Si tiene il candidato migliore con confidenza >= BANDI_JOIN_MIN_CONF. Per la
+Mobilità vale anche l'URL della pagina URP (stessa pagina = confidenza 1.0).
+
+Uscita:
+  {
+    "generated": "2025-12-01T10:00:00",
+    "sources": {"urp": mtime, "sol": mtime, "mob": mtime, "rdp": mtime|null},
+    "stats": {"urp": n, "sol": {"matched": n, "orphans": n}, ...},
+    "rows": [ { "urp_url", "categoria", "codice", "canonico",
+                "sol": {"codice", "confidence", "method"} | null,
+                "mob": {"url", "codice", "confidence", "method"} | null,
+                "rdp": {"codice", "rdp_group", "rdp_members", "confidence", "method"} | null }, ... ],
+    "orphans": {"sol": [codici SOL senza bando URP], "mob": [...], "rdp": [...]}
+  }
+
+ENV:
+  BANDI_JOIN_MIN_CONF   (default: 0.6) confidenza minima di un abbinamento
+  BANDI_JOIN_MAX_BLOCK  (default: 50)  blocchi di trigrammi più grandi vengono ignorati (es. "202" degli anni)
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import unicodedata
+from datetime import datetime
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+URP_JSON = "bandi-completi-urp.json"
+SOL_JSON = "bandi-concorsi-pubblici-sol.json"
+MOB_JSON = "bandi-mobilita.json"
+RDP_JSON = "bandi-con-rdp.json"
+JOIN_JSON = "bandi-join.json"
+
+BANDI_JOIN_MIN_CONF = float(os.environ.get("BANDI_JOIN_MIN_CONF", "0.6"))
+BANDI_JOIN_MAX_BLOCK = int(os.environ.get("BANDI_JOIN_MAX_BLOCK", "50"))
+
+_PREFIX_RE = re.compile(r"^\s*(?:codice\s+bando|bando\s*n\.?|bando)\s*[:.]?\s*", re.I)
+_TOKEN_RE = re.compile(r"[A-Z0-9]+")
+
+
+# ========= Codici =========
+def canonical_code(raw) -> str | None:
+    """Codice canonico (vedi sopra); None se vuoto o senza cifre ("--", "1 BORSA" non sono codici)."""
+    if not raw:
+        return None
+    s = unicodedata.normalize("NFKD", str(raw)).encode("ascii", "ignore").decode().upper()
+    tokens = _TOKEN_RE.findall(_PREFIX_RE.sub("", s))
+    if not tokens or not any(t.isdigit() for t in tokens):
+        return None
+    return "-".join(tokens)
+
+
+def _numbers(canon: str) -> tuple:
+    """Numeri del codice senza zeri iniziali: il "numero del bando" usato come blocco."""
+    return tuple(t.lstrip("0") or "0" for t in canon.split("-") if t.isdigit())
+
+
+def _compact(canon: str) -> str:
+    return "".join(t.lstrip("0") or "0" if t.isdigit() else t for t in canon.split("-"))
+
+
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)} if len(s) >= 3 else {s}
+
+
+def urp_code(item: dict) -> str | None:
+    """Codice di un bando URP, come estraiCodiceBandoUI di index.html."""
+    m = re.search(r"Codice\s+Bando\s+(.+)$", item.get("titolo_bando") or "", re.I)
+    if m and m.group(1).strip():
+        return m.group(1).strip()
+    prefer = str(item.get("codice_bando") or "").strip()
+    if prefer:
+        return prefer
+    joined = f"{item.get('titolo_bando') or ''} // {item.get('estratto') or ''}".lower()
+    for pattern in (r"\bbando\s*n\.?\s*([0-9]{3}\.[0-9]+(?:\s+[a-zà-ù]+)?)",
+                    r"\bcodice\s+bando\s+([0-9]{3}\.[0-9]+(?:\s+[a-zà-ù]+)?)",
+                    r"\b([0-9]{3}\.[0-9]+(?:\s+[a-zà-ù]+)?)\b"):
+        m = re.search(pattern, joined, re.I)
+        if m:
+            return m.group(1).upper()
+    return None
+
+
+# ========= Indice con blocchi =========
+class CodeIndex:
+    """Indice dei codici di una fonte: dizionari esatti + blocchi per numeri e trigrammi."""
+
+    def __init__(self, records: list[tuple[str, dict]]):
+        self.records = records
+        self.exact: dict[str, int] = {}
+        self.compact: dict[str, int] = {}
+        self.by_numbers: dict[tuple, list[int]] = {}
+        self.by_gram: dict[str, list[int]] = {}
+        for i, (canon, _) in enumerate(records):
+            comp = _compact(canon)
+            self.exact.setdefault(canon, i)
+            self.compact.setdefault(comp, i)
+            self.by_numbers.setdefault(_numbers(canon), []).append(i)
+            for g in _trigrams(comp):
+                self.by_gram.setdefault(g, []).append(i)
+
+    def match(self, canon: str, min_conf: float = BANDI_JOIN_MIN_CONF) -> tuple[int, float, str] | None:
+        """(indice del record, confidenza, metodo) del miglior abbinamento, o None."""
+        if canon in self.exact:
+            return self.exact[canon], 1.0, "exact"
+        comp = _compact(canon)
+        if comp in self.compact:
+            return self.compact[comp], 0.95, "normalized"
+
+        numbers = _numbers(canon)
+        candidates, factor = self.by_numbers.get(numbers), 1.0
+        if not candidates:
+            seen = set()
+            for g in _trigrams(comp):
+                block = self.by_gram.get(g, ())
+                if len(block) <= BANDI_JOIN_MAX_BLOCK:
+                    seen.update(block)
+            candidates, factor = [i for i in sorted(seen) if _numbers_prefix(numbers, _numbers(self.records[i][0]))], 0.85
+
+        best = None
+        for i in candidates:
+            conf = round(factor * _sigle_score(canon, self.records[i][0]), 3)
+            if conf >= min_conf and (best is None or conf > best[1]):
+                best = (i, conf, "fuzzy")
+        return best
+
+
+def _numbers_prefix(a: tuple, b: tuple) -> bool:
+    n = min(len(a), len(b))
+    return n > 0 and a[:n] == b[:n]
+
+
+def _same_sigla(a: str, b: str) -> bool:
+    if a == b:
+        return True
+    if min(len(a), len(b)) < 4:
+        return False
+    ga, gb = _trigrams(a), _trigrams(b)
+    return 2 * len(ga & gb) / (len(ga) + len(gb)) >= 0.6
+
+
+def _sigle_score(a: str, b: str) -> float:
+    """0.9 x frazione delle sigle del codice con meno sigle ritrovate nell'altro; 0.8 se uno non ne ha."""
+    sa = [t for t in a.split("-") if not t.isdigit()]
+    sb = [t for t in b.split("-") if not t.isdigit()]
+    if not sa or not sb:
+        return 0.8
+    short, other = (sa, sb) if len(sa) <= len(sb) else (sb, sa)
+    found = sum(1 for t in short if any(_same_sigla(t, o) for o in other))
+    return 0.9 * found / len(short)
+
+
+# ========= Fonti =========
+def load_source(name: str):
+    """JSON di una fonte nella cartella dell'app; None se manca o non è leggibile."""
+    try:
+        with open(os.path.join(DIR, name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def source_mtime(name: str) -> float | None:
+    try:
+        return os.path.getmtime(os.path.join(DIR, name))
+    except OSError:
+        return None
+
+
+def flatten_urp(data) -> list[dict]:
+    """Come le pagine: lista, oppure {categoria: [bandi]}."""
+    if isinstance(data, list):
+        return [dict(b, categoria=b.get("categoria") or b.get("fonte") or "") for b in data]
+    if isinstance(data, dict):
+        return [dict(b, categoria=cat) for cat, bandi in data.items() if isinstance(bandi, list) for b in bandi]
+    return []
+
+
+def _index(items, code_of) -> CodeIndex:
+    records = []
+    for it in items or []:
+        canon = canonical_code(code_of(it))
+        if canon:
+            records.append((canon, it))
+    return CodeIndex(records)
+
+
+# ========= Join =========
+def build_join() -> dict:
+    """Join completo dalle fonti su disco (vedi la docstring per il formato)."""
+    t0 = time.perf_counter()
+    urp = flatten_urp(load_source(URP_JSON))
+    sources = {"sol": (load_source(SOL_JSON), lambda it: it.get("codice")),
+               "mob": (load_source(MOB_JSON), lambda it: it.get("codice")),
+               "rdp": (load_source(RDP_JSON), lambda it: it.get("codice"))}
+    indexes = {name: _index(items if isinstance(items, list) else [], code_of)
+               for name, (items, code_of) in sources.items()}
+    mob_by_url = {it.get("url"): it for it in (sources["mob"][0] or []) if isinstance(it, dict) and it.get("url")}
+    used = {name: set() for name in indexes}
+
+    rows = []
+    for item in urp:
+        code = urp_code(item)
+        canon = canonical_code(code)
+        row = {"urp_url": item.get("url"), "categoria": item.get("categoria"),
+               "codice": code, "canonico": canon, "sol": None, "mob": None, "rdp": None}
+        for name, index in indexes.items():
+            hit = index.match(canon) if canon else None
+            if hit is None:
+                continue
+            i, conf, method = hit
+            used[name].add(i)
+            rec = index.records[i][1]
+            row[name] = {"codice": rec.get("codice"), "confidence": conf, "method": method}
+            if name == "mob":
+                row[name]["url"] = rec.get("url")
+            elif name == "rdp":
+                row[name].update(rdp_group=rec.get("rdp_group"), rdp_members=rec.get("rdp_members"))
+        # Mobilità: la stessa pagina URP è l'abbinamento più sicuro
+        mob = mob_by_url.get(item.get("url"))
+        if mob is not None:
+            row["mob"] = {"codice": mob.get("codice"), "url": mob.get("url"), "confidence": 1.0, "method": "url"}
+        rows.append(row)
+
+    orphans = {name: [rec.get("codice") for i, (_, rec) in enumerate(index.records) if i not in used[name]]
+               for name, index in indexes.items()}
+    stats = {"urp": len(rows), "urp_without_code": sum(1 for r in rows if not r["canonico"])}
+    for name in indexes:
+        stats[name] = {"records": len(indexes[name].records),
+                       "matched": sum(1 for r in rows if r[name]),
+                       "fuzzy": sum(1 for r in rows if r[name] and r[name]["method"] == "fuzzy"),
+                       "orphans": len(orphans[name])}
+    stats["seconds"] = round(time.perf_counter() - t0, 3)
+    return {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "sources": {"urp": source_mtime(URP_JSON), "sol": source_mtime(SOL_JSON), "mob": source_mtime(MOB_JSON), "rdp": source_mtime(RDP_JSON)},
+        "stats": stats,
+        "rows": rows,
+        "orphans": orphans,
+    }
+
+
+def write_join() -> dict:
+    """
+    Ricostruisce e salva bandi-join.json (scrittura atomica); restituisce le
+    statistiche. Serializzata tra processi: gli scraper SOL e Mobilità girano
+    in parallelo e l'ultimo a scrivere deve aver letto le fonti più recenti.
+    """
+    from shared_state import FileLock, shared_path
+
+    with FileLock(shared_path("bandi-join.lock")):
+        data = build_join()
+        path = os.path.join(DIR, JOIN_JSON)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    return data["stats"]
+
+
+def summary(stats: dict) -> str:
+    return (f"{stats['urp']} bandi URP, SOL {stats['sol']['matched']}, Mobilità {stats['mob']['matched']}, "
+            f"RDP {stats['rdp']['matched']} ({stats['seconds']} s)")
+
+
+def is_stale() -> bool:
+    """True se bandi-join.json manca o è più vecchio di una delle fonti."""
+    built = source_mtime(JOIN_JSON)
+    if built is None:
+        return source_mtime(URP_JSON) is not None
+    return any((m or 0) > built for m in (source_mtime(URP_JSON), source_mtime(SOL_JSON), source_mtime(MOB_JSON), source_mtime(RDP_JSON)))
+
+
+def start_rebuild() -> threading.Thread:
+    """
+    Thread daemon: all'avvio ricostruisce il join se manca o è più vecchio
+    delle fonti (es. JSON aggiornati a mano o scraper interrotto). Dopo, lo
+    aggiornano gli scraper stessi.
+    """
+    def _run():
+        try:
+            if is_stale():
+                print(f"[JOIN] {JOIN_JSON} aggiornato: {summary(write_join())}", flush=True)
+        except Exception as e:
+            print(f"[JOIN] Errore nel join dei bandi: {e}", flush=True)
+
+    t = threading.Thread(target=_run, daemon=True, name="bandi-join")
+    t.start()
+    return t
+
+
+if __name__ == "__main__":
+    print(json.dumps(write_join(), ensure_ascii=False, indent=2))
+    sys.exit(0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Confronta i backend di inferenza CPU del modello firme (firme_model,
+FIRME_BACKEND) sullo stesso insieme fisso di pagine: latenza per pagina,
+throughput a batch e accordo delle box con il checkpoint PyTorch.
+
+Le pagine vengono renderizzate una sola volta; per ogni backend si misura il
+caricamento (export compreso la prima volta, poi dalla cache), la latenza
+con una pagina per chiamata (mediana e p95) e le pagine/s con chiamate da
+--batch pagine. L'accordo usa torch come riferimento (vedi bench_detect.agreement).
+
+Richiede il modello vero (HUGGINGFACE_TOKEN nel .env) e le dipendenze dei
+backend confrontati (onnxruntime, openvino, ...).
+
+Uso:
+  python bench_backend.py doc1.pdf doc2.pdf
+  python bench_backend.py --backends torch,onnx,openvino --threads 4 --max-pages 40 doc.pdf
+  python bench_backend.py --json doc.pdf
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from firme_model import load_yolo_firme, predict_signatures, set_threads, BACKENDS, FIRME_PREDICT_BATCH
+from bench_detect import load_pages, agreement
+
+
+def bench_backend(backend: str, images: list, batch: int, repeat: int) -> tuple[dict, list]:
+    t0 = time.perf_counter()
+    model = load_yolo_firme(backend)
+    load_s = time.perf_counter() - t0
+    # riscaldamento: allocazioni e prima compilazione fuori dalle misure
+    predict_signatures(model, images[:1], mode="single")
+
+    lat = []
+    for img in images:
+        t = time.perf_counter()
+        predict_signatures(model, [img], mode="single")
+        lat.append(time.perf_counter() - t)
+    lat.sort()
+
+    best, boxes = None, []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        boxes = predict_signatures(model, images, batch=batch, mode="single")
+        secs = time.perf_counter() - t
+        best = secs if best is None else min(best, secs)
+
+    return {
+        "backend": backend,
+        "load_s": round(load_s, 2),
+        "latency_ms_p50": round(lat[len(lat) // 2] * 1000, 1),
+        "latency_ms_p95": round(lat[min(len(lat) - 1, int(len(lat) * 0.95))] * 1000, 1),
+        "pages_per_sec": round(len(images) / best, 2) if best else None,
+        "boxes": sum(len(b) for b in boxes),
+    }, boxes
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark backend CPU del modello firme")
+    ap.add_argument("pdf", nargs="+")
+    ap.add_argument("--backends", default="torch,onnx,openvino",
+                    help=f"elenco separato da virgole tra {', '.join(BACKENDS)}")
+    ap.add_argument("--dpi", type=int, default=200)
+    ap.add_argument("--max-pages", type=int, default=32)
+    ap.add_argument("--batch", type=int, default=FIRME_PREDICT_BATCH)
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--threads", type=int, default=0, help="thread intra-op (0 = default del backend)")
+    ap.add_argument("--inter", type=int, default=0, help="thread inter-op / stream (0 = default)")
+    ap.add_argument("--iou", type=float, default=0.5)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    backends = [b.strip().lower() for b in args.backends.split(",") if b.strip()]
+    unknown = [b for b in backends if b not in BACKENDS]
+    if unknown:
+        ap.error(f"backend sconosciuti: {', '.join(unknown)}")
+    # torch sempre per primo: è il riferimento per l'accordo delle box
+    backends = ["torch"] + [b for b in backends if b != "torch"]
+
+    images = load_pages(args.pdf, args.dpi, args.max_pages)
+    if not images:
+        print("[BACKEND] Nessuna pagina da analizzare.", file=sys.stderr)
+        return 1
+    set_threads(args.threads, args.inter)
+
+    results, reference = [], None
+    for backend in backends:
+        try:
+            res, boxes = bench_backend(backend, images, max(1, args.batch), args.repeat)
+        except Exception as e:
+            results.append({"backend": backend, "error": str(e)})
+            continue
+        if backend == "torch":
+            reference = boxes
+        res["agreement"] = agreement(reference, boxes, args.iou) if reference is not None else None
+        results.append(res)
+
+    report = {
+        "pdf": [os.path.basename(p) for p in args.pdf],
+        "pages": len(images),
+        "threads": {"intra": args.threads, "inter": args.inter},
+        "batch": args.batch,
+        "results": results,
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"[BACKEND] {len(images)} pagine, batch {args.batch}, "
+          f"thread intra {args.threads or 'default'} / inter {args.inter or 'default'}")
+    for r in results:
+        if "error" in r:
+            print(f"  {r['backend']:<14} ERRORE: {r['error']}")
+            continue
+        a = r["agreement"] or {}
+        print(f"  {r['backend']:<14} load {r['load_s']:>6} s  p50 {r['latency_ms_p50']:>7} ms  "
+              f"p95 {r['latency_ms_p95']:>7} ms  {r['pages_per_sec']:>7} pagine/s  "
+              f"recall {a.get('recall')}  precision {a.get('precision')}  IoU {a.get('mean_iou')}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Confronta il rilevamento firme a passata singola (FIRME_IMGSZ sulla pagina
+intera) con quello coarse-to-fine (firme_model.predict_coarse_to_fine) sulle
+stesse pagine: tempo di inferenza, pagine/s e accordo delle box.
+
+Le pagine vengono renderizzate una sola volta al DPI di analisi e tenute in
+memoria; il tempo misurato è solo quello del modello. L'accordo usa la
+passata singola come riferimento: una box coarse-to-fine è "trovata" se ha
+IoU >= --iou con una box di riferimento non ancora abbinata.
+
+Richiede il modello vero (HUGGINGFACE_TOKEN nel .env).
+
+Uso:
+  python bench_detect.py doc1.pdf doc2.pdf
+  python bench_detect.py --dpi 200 --repeat 3 --max-pages 50 doc.pdf
+  python bench_detect.py --json doc.pdf
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+
+from firme_model import get_yolo_firme, predict_signatures, FIRME_COARSE_IMGSZ, FIRME_IMGSZ, FIRME_REFINE_IMGSZ
+
+
+def load_pages(pdf_paths: list[str], dpi: int, max_pages: int | None) -> list:
+    """Pagine BGR in memoria, come le riceve il modello durante /api/firme/analyze."""
+    import numpy as np
+    from firme_raster import iter_pdf_pages
+
+    images = []
+    for pdf_path in pdf_paths:
+        for page in iter_pdf_pages(pdf_path, dpi=dpi):
+            # copia: page.bgr è una vista sul pixmap, liberato con la PageRaster
+            images.append(np.ascontiguousarray(page.bgr))
+            if max_pages and len(images) >= max_pages:
+                return images
+    return images
+
+
+def bench_mode(model, images: list, mode: str, repeat: int) -> tuple[dict, list]:
+    best, boxes = None, []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        boxes = predict_signatures(model, images, mode=mode)
+        secs = time.perf_counter() - t0
+        best = secs if best is None else min(best, secs)
+    return {
+        "mode": mode,
+        "seconds": round(best, 3),
+        "pages_per_sec": round(len(images) / best, 2) if best else None,
+        "boxes": sum(len(b) for b in boxes),
+    }, boxes
+
+
+def _iou(a: dict, b: dict) -> float:
+    ix = max(0.0, min(a["x"] + a["w"], b["x"] + b["w"]) - max(a["x"], b["x"]))
+    iy = max(0.0, min(a["y"] + a["h"], b["y"] + b["h"]) - max(a["y"], b["y"]))
+    inter = ix * iy
+    union = a["w"] * a["h"] + b["w"] * b["h"] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def agreement(reference: list[list[dict]], candidate: list[list[dict]], min_iou: float) -> dict:
+    """Recall/precision di `candidate` rispetto a `reference` e IoU medio delle coppie."""
+    matched, ious = 0, []
+    for ref, cand in zip(reference, candidate):
+        free = list(ref)
+        for b in sorted(cand, key=lambda b: -b["score"]):
+            best = max(free, key=lambda r: _iou(r, b), default=None)
+            if best is not None and _iou(best, b) >= min_iou:
+                matched += 1
+                ious.append(_iou(best, b))
+                free.remove(best)
+    n_ref = sum(len(r) for r in reference)
+    n_cand = sum(len(c) for c in candidate)
+    return {
+        "recall": round(matched / n_ref, 3) if n_ref else None,
+        "precision": round(matched / n_cand, 3) if n_cand else None,
+        "mean_iou": round(sum(ious) / len(ious), 3) if ious else None,
+        "pages_differing": sum(1 for r, c in zip(reference, candidate) if len(r) != len(c)),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark rilevamento firme single vs coarse-to-fine")
+    ap.add_argument("pdf", nargs="+")
+    ap.add_argument("--dpi", type=int, default=200)
+    ap.add_argument("--max-pages", type=int, default=None)
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--iou", type=float, default=0.5, help="IoU minimo per considerare due box la stessa firma")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    images = load_pages(args.pdf, args.dpi, args.max_pages)
+    if not images:
+        print("[DETECT] Nessuna pagina da analizzare.", file=sys.stderr)
+        return 1
+
+    model = get_yolo_firme()
+    # riscaldamento: il primo predict include l'inizializzazione del modello
+    predict_signatures(model, images[:1], mode="single")
+
+    single, ref = bench_mode(model, images, "single", args.repeat)
+    coarse, cand = bench_mode(model, images, "coarse", args.repeat)
+    res = {
+        "pdf": [os.path.basename(p) for p in args.pdf],
+        "pages": len(images),
+        "imgsz": {"single": FIRME_IMGSZ, "coarse": FIRME_COARSE_IMGSZ, "refine": FIRME_REFINE_IMGSZ},
+        "single": single,
+        "coarse": coarse,
+        "speedup": round(single["seconds"] / coarse["seconds"], 2) if coarse["seconds"] else None,
+        "agreement": agreement(ref, cand, args.iou),
+    }
+
+    if args.json:
+        print(json.dumps(res, ensure_ascii=False, indent=2))
+        return
+
+    print(f"[DETECT] {res['pages']} pagine da {len(args.pdf)} PDF "
+          f"(imgsz single {FIRME_IMGSZ}, coarse {FIRME_COARSE_IMGSZ} + ritagli {FIRME_REFINE_IMGSZ})")
+    for m in (single, coarse):
+        print(f"  {m['mode']:<7} {m['seconds']:>8} s  {m['pages_per_sec']:>8} pagine/s  {m['boxes']:>6} box")
+    a = res["agreement"]
+    print(f"  speedup {res['speedup']}x  recall {a['recall']}  precision {a['precision']}  "
+          f"IoU medio {a['mean_iou']}  pagine con numero di box diverso {a['pages_differing']}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark end-to-end della redazione firme, offline: PDF sintetici attraverso
+gli stessi percorsi di /api/firme/analyze e /api/firme/confirm.
+
+Per ogni scenario (prodotto di --pages, --scan e --scan-dpi) viene generato
+un PDF con pagine native digitali (testo, blocco firma "Il Direttore" con
+firma vettoriale) e una quota di pagine "scansionate" (stessa pagina
+renderizzata a --scan-dpi in grigio con rumore e reinserita come JPEG, senza
+strato di testo). Poi, in un processo separato (così il picco di RSS è dello
+scenario), con FIRME_SCRATCH_DIR temporanea e inferenza inline:
+  rasterize  firme_raster.iter_pdf_pages da solo (solo rendering)
+  analyze    POST /api/firme/analyze?sync=1 (rendering, pre-filtro, rilevamento, PNG/anteprime)
+  detect     tempo passato dentro model.predict durante analyze
+  redact     firme_redact.redact_document sulle box trovate
+  confirm    POST /api/firme/confirm (redazione + ZIP in streaming, letto per intero)
+Per ogni stadio: secondi, pagine/s e RSS massimo dopo lo stadio; in più la
+dimensione del PDF, dello ZIP e il picco di RSS dei processi di rendering.
+
+Il modello è uno stub con la stessa API predict di ultralytics (una box fissa
+in basso a destra, --stub-ms millisecondi per immagine a FIRME_IMGSZ, scalati
+sull'area per imgsz diversi); --real-model usa il modello vero
+(HUGGINGFACE_TOKEN). Le variabili FIRME_* dell'ambiente valgono come in
+produzione (pre-filtro, ancore, cache pHash, backend, ...) e vengono salvate
+nel JSON insieme a versione (git) e macchina, per confrontare due versioni:
+
+Uso:
+  python bench_e2e.py                                   # scenari di default
+  python bench_e2e.py --pages 8,64 --scan 0,1 --scan-dpi 200 --out risultati.json
+  python bench_e2e.py --compare vecchio.json --out nuovo.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import itertools
+import subprocess
+import tempfile
+
+from bench_startup import DUMMY_ENV
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ("rasterize", "analyze", "detect", "redact", "confirm")
+
+WORDS = (
+    "il la di del della che per con non una nel sono alla come dalla "
+    "commissione verbale concorso candidati prova punteggio graduatoria "
+    "determina decreto bando pubblico selezione ufficio reclutamento "
+    "ammissione valutazione titoli colloquio seduta componenti segretario "
+    "approvato visto considerato ritenuto articolo comma allegato"
+).split()
+
+
+# ========= PDF sintetici =========
+def _compose_page(page, rnd: random.Random, index: int, signed: bool) -> None:
+    """Pagina nativa digitale: intestazione, testo corrente e (se signed) blocco firma."""
+    page.insert_text((72, 72), f"Ufficio Reclutamento - Documento di prova, pagina {index + 1}", fontsize=11)
+    y = 110
+    for _ in range(rnd.randint(18, 34)):
+        line = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 13)))
+        page.insert_text((72, y), line.capitalize() + ".", fontsize=10)
+        y += 16
+    if signed:
+        x = rnd.randint(300, 380)
+        y = min(y + 30, 700)
+        page.insert_text((x, y), "Il Direttore", fontsize=11)
+        # firma "autografa": qualche curva di Bézier sotto la dicitura
+        px, py = x - 10, y + 40
+        for _ in range(rnd.randint(3, 5)):
+            nx, ny = px + rnd.randint(25, 45), py + rnd.randint(-20, 20)
+            page.draw_bezier((px, py), (px + 10, py - rnd.randint(10, 35)),
+                             (nx - 10, ny + rnd.randint(10, 35)), (nx, ny),
+                             color=(0.05, 0.05, 0.35), width=1.4)
+            px, py = nx, ny
+
+
+def make_pdf(path: str, pages: int, scan: float, scan_dpi: int, seed: int = 0) -> dict:
+    """Scrive il PDF sintetico e restituisce la sua composizione."""
+    import fitz  # PyMuPDF
+    import numpy as np
+    from PIL import Image
+
+    rnd = random.Random(seed)
+    rng = np.random.default_rng(seed)
+    scan_idx = set(rnd.sample(range(pages), round(pages * scan)))
+    signed_idx = {i for i in range(pages) if i == pages - 1 or rnd.random() < 0.3}
+
+    doc = fitz.open()
+    for i in range(pages):
+        if i not in scan_idx:
+            _compose_page(doc.new_page(width=595, height=842), rnd, i, i in signed_idx)
+            continue
+        with fitz.open() as tmp:
+            src = tmp.new_page(width=595, height=842)
+            _compose_page(src, rnd, i, i in signed_idx)
+            pix = src.get_pixmap(dpi=scan_dpi, colorspace=fitz.csGRAY)
+        arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width).astype(np.float32)
+        # carta non bianca, toner non nero, rumore del sensore
+        arr = np.clip(arr * 0.92 + 12 + rng.normal(0, 5, arr.shape), 0, 255).astype(np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(arr, "L").save(buf, "JPEG", quality=75)
+        page = doc.new_page(width=595, height=842)
+        page.insert_image(page.rect, stream=buf.getvalue())
+    doc.save(path, garbage=3, deflate=True)
+    doc.close()
+    return {"pages": pages, "scan_pages": len(scan_idx), "signed_pages": len(signed_idx),
+            "bytes": os.path.getsize(path)}
+
+
+# ========= Modello stub =========
+class _Tensor:
+    """Quanto basta di un tensore torch per boxes_from_result: .cpu().numpy()."""
+
+    def __init__(self, arr):
+        self._arr = arr
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._arr
+
+
+class _Boxes:
+    def __init__(self, xyxyn, conf):
+        self.xyxyn, self.conf = _Tensor(xyxyn), _Tensor(conf)
+
+    def __len__(self):
+        return len(self.conf.numpy())
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubModel:
+    """Stessa API predict di ultralytics: una box fissa, costo simulato proporzionale all'area."""
+
+    def __init__(self, ms_per_image: float, imgsz: int):
+        self.ms_per_image = ms_per_image
+        self.imgsz = imgsz
+
+    def predict(self, source, imgsz=None, conf=None, batch=None, **kw):
+        import numpy as np
+
+        imgsz = imgsz or self.imgsz
+        time.sleep(len(source) * self.ms_per_image * (imgsz / self.imgsz) ** 2 / 1000)
+        box = np.array([[0.55, 0.78, 0.9, 0.9]])
+        return [_Result(_Boxes(box, np.array([0.9]))) for _ in source]
+
+
+class TimedModel:
+    """Misura il tempo passato dentro model.predict (stub o modello vero)."""
+
+    def __init__(self, model):
+        self.model = model
+        self.seconds = 0.0
+
+    def predict(self, *args, **kw):
+        t0 = time.perf_counter()
+        try:
+            return self.model.predict(*args, **kw)
+        finally:
+            self.seconds += time.perf_counter() - t0
+
+
+# ========= Uno scenario (processo figlio) =========
+def _rss_mb(who=None) -> float:
+    import resource
+
+    # ru_maxrss è in KB su Linux, in byte su macOS
+    rss = resource.getrusage(who if who is not None else resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def run_scenario(pdf_path: str, stub_ms: float | None, mode: str) -> dict:
+    """Esegue gli stadi su un PDF; va chiamata in un processo dedicato (vedi main)."""
+    import resource
+    from flask import Flask
+
+    import firme_model
+    import firme_pipeline
+    from firme import firme_bp
+    from firme_raster import iter_pdf_pages
+    from firme_redact import pages_from_payload, redact_document
+
+    base = StubModel(stub_ms, firme_model.FIRME_IMGSZ) if stub_ms is not None else firme_model.load_yolo_firme()
+    model = TimedModel(base)
+    firme_model._yolo_firme = model  # get_yolo_firme() restituisce questo
+
+    app = Flask("bench_e2e")
+    app.secret_key = os.urandom(16)
+    app.register_blueprint(firme_bp)
+    client = app.test_client()
+    with client.session_transaction() as s:
+        s["access_token"] = "bench"
+        s["user"] = "bench"
+
+    stages = {}
+
+    def stage(name: str, seconds: float, pages: int):
+        stages[name] = {"seconds": round(seconds, 3),
+                        "pages_per_sec": round(pages / seconds, 2) if seconds > 0 else None,
+                        "rss_after_mb": _rss_mb()}
+
+    # rasterize: solo rendering, stesso DPI dell'analisi
+    t0 = time.perf_counter()
+    n = sum(1 for _ in iter_pdf_pages(pdf_path, dpi=200))
+    stage("rasterize", time.perf_counter() - t0, n)
+
+    # analyze: stesso endpoint della UI, risposta sincrona
+    with open(pdf_path, "rb") as f:
+        t0 = time.perf_counter()
+        r = client.post("/api/firme/analyze?sync=1", data={"pdf": (f, os.path.basename(pdf_path))},
+                        content_type="multipart/form-data")
+        secs = time.perf_counter() - t0
+    if r.status_code != 200:
+        raise RuntimeError(f"analyze: HTTP {r.status_code} {r.get_data(as_text=True)[:200]}")
+    doc = r.get_json()["documents"][0]
+    stage("analyze", secs, n)
+    stage("detect", model.seconds, n)
+
+    payload_pages = [{"page_index": p["index"], "boxes": p["auto_boxes"]} for p in doc["pages"]]
+    boxes = sum(len(p["boxes"]) for p in payload_pages)
+
+    # redact: solo la redazione, sulla cartella del documento
+    import firme_store
+    t0 = time.perf_counter()
+    pdf_bytes, _, used_mode = redact_document(firme_store.doc_dir(doc["doc_id"]),
+                                              pages_from_payload(doc["doc_id"], payload_pages), mode)
+    stage("redact", time.perf_counter() - t0, n)
+
+    # confirm: redazione + ZIP in streaming, come la UI (rilascia il documento)
+    t0 = time.perf_counter()
+    r = client.post("/api/firme/confirm", json={
+        "mode": mode,
+        "documents": [{"doc_id": doc["doc_id"], "filename": os.path.basename(pdf_path), "pages": payload_pages}],
+    })
+    zip_bytes = len(r.get_data())
+    stage("confirm", time.perf_counter() - t0, n)
+    if r.status_code != 200:
+        raise RuntimeError(f"confirm: HTTP {r.status_code}")
+
+    # i processi di rendering contano in RUSAGE_CHILDREN solo dopo essere terminati
+    if firme_pipeline._pool is not None:
+        firme_pipeline._pool.shutdown(wait=True)
+    return {
+        "stages": stages,
+        "boxes": boxes,
+        "skipped_pages": sum(1 for p in doc["pages"] if p.get("skipped")),
+        "redact_mode": used_mode,
+        "redacted_pdf_bytes": len(pdf_bytes or b""),
+        "zip_bytes": zip_bytes,
+        "peak_rss_mb": _rss_mb(),
+        "peak_rss_children_mb": _rss_mb(resource.RUSAGE_CHILDREN),
+    }
+
+
+# ========= Orchestrazione =========
+def _git_version() -> str | None:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _scenarios(args) -> list[dict]:
+    pages = [int(x) for x in args.pages.split(",")]
+    scans = [float(x) for x in args.scan.split(",")]
+    dpis = [int(x) for x in args.scan_dpi.split(",")]
+    out = []
+    for n, scan, dpi in itertools.product(pages, scans, dpis):
+        if scan == 0 and dpi != dpis[0]:
+            continue  # senza pagine scansionate il DPI di scansione non conta
+        out.append({"name": f"p{n}-scan{int(scan * 100)}-dpi{dpi if scan else 0}",
+                    "pages": n, "scan": scan, "scan_dpi": dpi})
+    return out
+
+
+def _run_child(pdf_path: str, args, work_dir: str) -> dict:
+    result_path = os.path.join(work_dir, "result.json")
+    env = dict(os.environ, **{k: v for k, v in DUMMY_ENV.items() if k not in os.environ})
+    env.update(FIRME_SCRATCH_DIR=os.path.join(work_dir, "docs_firme"), FIRME_WORKERS="0")
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", pdf_path, "--result", result_path,
+           "--mode", args.mode]
+    if not args.real_model:
+        cmd += ["--stub-ms", str(args.stub_ms)]
+    proc = subprocess.run(cmd, cwd=DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0 or not os.path.exists(result_path):
+        tail = (proc.stderr or proc.stdout).strip().splitlines()[-5:]
+        return {"error": " | ".join(tail) or f"exit {proc.returncode}"}
+    with open(result_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _compare(old: dict, new: dict) -> None:
+    prev = {s["name"]: s for s in old.get("scenarios", [])}
+    print(f"[E2E] Confronto con {old.get('version')} ({old.get('timestamp')})")
+    for s in new["scenarios"]:
+        o = prev.get(s["name"])
+        if not o or "stages" not in o or "stages" not in s:
+            continue
+        cells = []
+        for name in STAGES:
+            a, b = o["stages"].get(name, {}).get("pages_per_sec"), s["stages"].get(name, {}).get("pages_per_sec")
+            if a and b:
+                cells.append(f"{name} {(b - a) / a * 100:+.0f}%")
+        print(f"  {s['name']:<22} " + "  ".join(cells))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark end-to-end della redazione firme")
+    ap.add_argument("--pages", default="4,32", help="numeri di pagine, separati da virgole")
+    ap.add_argument("--scan", default="0,0.5,1", help="quote di pagine scansionate (0..1)")
+    ap.add_argument("--scan-dpi", default="150,300", help="DPI delle pagine scansionate")
+    ap.add_argument("--stub-ms", type=float, default=60.0, help="costo simulato del modello per immagine")
+    ap.add_argument("--real-model", action="store_true", help="modello vero al posto dello stub")
+    ap.add_argument("--mode", default="raster", help="modalità di redazione (raster | vector)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="file JSON dei risultati")
+    ap.add_argument("--compare", help="JSON di un'esecuzione precedente da confrontare")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    ap.add_argument("--result", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        res = run_scenario(args.child, None if args.real_model else args.stub_ms, args.mode)
+        with open(args.result, "w", encoding="utf-8") as f:
+            json.dump(res, f)
+        return 0
+
+    report = {
+        "version": _git_version(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpu_count": os.cpu_count()},
+        "model": "real" if args.real_model else f"stub {args.stub_ms} ms/immagine",
+        "config": {k: v for k, v in sorted(os.environ.items()) if k.startswith("FIRME_")},
+        "scenarios": [],
+    }
+    for i, sc in enumerate(_scenarios(args)):
+        with tempfile.TemporaryDirectory(prefix="bench_e2e_") as work_dir:
+            pdf_path = os.path.join(work_dir, f"{sc['name']}.pdf")
+            # seed diverso per scenario: niente riusi (dedup, cache pHash) tra uno e l'altro
+            sc["pdf"] = make_pdf(pdf_path, sc["pages"], sc["scan"], sc["scan_dpi"], seed=args.seed + i)
+            sc.update(_run_child(pdf_path, args, work_dir))
+        report["scenarios"].append(sc)
+
+        if "error" in sc:
+            print(f"[E2E] {sc['name']:<22} ERRORE: {sc['error']}", flush=True)
+            continue
+        cells = "  ".join(f"{name} {sc['stages'][name]['pages_per_sec']}" for name in STAGES)
+        print(f"[E2E] {sc['name']:<22} pagine/s: {cells}  | RSS {sc['peak_rss_mb']} MB "
+              f"(+{sc['peak_rss_children_mb']} MB rendering)  PDF {sc['pdf']['bytes']} -> "
+              f"ZIP {sc['zip_bytes']} byte", flush=True)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[E2E] Risultati salvati in {args.out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            _compare(json.load(f), report)
+    return 1 if any("error" in s for s in report["scenarios"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
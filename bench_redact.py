@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Confronta le due modalità di redazione firme (raster vs vector) sugli stessi
+PDF e sugli stessi box: pagine/s e dimensione del PDF prodotto.
+
+Per ogni PDF viene preparata una cartella temporanea come quella di
+docs_firme/<doc_id> (original.pdf + page_N.png al DPI di analisi), poi si
+chiama firme_redact.redact_document in entrambe le modalità. I box sono fissi
+(riquadro in basso a destra, dove di solito sta la firma) su una pagina ogni
+`--every`.
+
+Uso:
+  python bench_redact.py doc1.pdf doc2.pdf
+  python bench_redact.py --dpi 200 --every 2 --repeat 3 doc.pdf
+  python bench_redact.py --json doc.pdf
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from firme_redact import redact_document
+
+# box tipico di una firma, normalizzato
+SIGNATURE_BOX = {"x": 0.55, "y": 0.78, "w": 0.35, "h": 0.12}
+
+
+def prepare_doc(pdf_path: str, work_dir: str, dpi: int) -> int:
+    """Copia il PDF e renderizza i PNG come fa /api/firme/analyze. Restituisce le pagine."""
+    from firme_raster import iter_pdf_pages
+
+    shutil.copyfile(pdf_path, os.path.join(work_dir, "original.pdf"))
+    n = 0
+    for page in iter_pdf_pages(pdf_path, dpi=dpi):
+        page.save_png(os.path.join(work_dir, f"page_{page.index}.png"))
+        n += 1
+    return n
+
+
+def bench_mode(work_dir: str, pages: dict, mode: str, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        pdf_bytes, n, used = redact_document(work_dir, pages, mode)
+        secs = time.perf_counter() - t0
+        best = secs if best is None else min(best, secs)
+    return {
+        "mode": used,
+        "seconds": round(best, 3),
+        "pages_per_sec": round(n / best, 2) if best else None,
+        "bytes": len(pdf_bytes or b""),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark redazione raster vs vector")
+    ap.add_argument("pdf", nargs="+")
+    ap.add_argument("--dpi", type=int, default=200)
+    ap.add_argument("--every", type=int, default=1, help="box su una pagina ogni N")
+    ap.add_argument("--repeat", type=int, default=1)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    results = []
+    for pdf_path in args.pdf:
+        with tempfile.TemporaryDirectory(prefix="bench_redact_") as work_dir:
+            n = prepare_doc(pdf_path, work_dir, args.dpi)
+            pages = {i: ([SIGNATURE_BOX] if i % max(1, args.every) == 0 else []) for i in range(n)}
+            res = {
+                "pdf": os.path.basename(pdf_path),
+                "pages": n,
+                "original_bytes": os.path.getsize(pdf_path),
+                "raster": bench_mode(work_dir, pages, "raster", args.repeat),
+                "vector": bench_mode(work_dir, pages, "vector", args.repeat),
+            }
+        results.append(res)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    for r in results:
+        print(f"[REDACT] {r['pdf']}: {r['pages']} pagine, originale {r['original_bytes']} byte")
+        for mode in ("raster", "vector"):
+            m = r[mode]
+            note = "" if m["mode"] == mode else f" (ripiego su {m['mode']})"
+            print(f"  {mode:<7} {m['seconds']:>8} s  {m['pages_per_sec']:>8} pagine/s  {m['bytes']:>10} byte{note}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Misura il tempo di import di avvia_tool.py con `python -X importtime`
+e fallisce (exit 1) se supera il budget o se all'avvio vengono caricate
+librerie che devono restare lazy (YOLO, OpenCV, PyMuPDF, ...).
+
+Uso:
+  python bench_startup.py                 # budget di default
+  python bench_startup.py --budget-ms 800 --top 15
+  python bench_startup.py --json          # report in JSON (per CI)
+
+ENV:
+  IMPORT_BUDGET_MS (default: 1500)
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_BUDGET_MS = int(os.environ.get("IMPORT_BUDGET_MS", "1500"))
+
+# moduli che NON devono essere importati all'avvio del server
+LAZY_MODULES = [
+    "cv2", "ultralytics", "torch", "fitz", "img2pdf",
+    "huggingface_hub", "pdfminer", "pikepdf", "numpy", "PIL",
+]
+
+# variabili minime perché auth.py non si rifiuti di partire
+DUMMY_ENV = {
+    "OIDC_CLIENT_ID": "bench",
+    "OIDC_CLIENT_SECRET": "bench",
+    "OIDC_REDIRECT_URI": "http://localhost/oidc-callback",
+    "OIDC_AUTH_URL": "http://localhost/auth",
+    "OIDC_TOKEN_URL": "http://localhost/token",
+}
+
+
+def run_importtime(module: str = "avvia_tool") -> list[tuple[int, int, str]]:
+    """
+    Lancia un interprete pulito con -X importtime e restituisce
+    [(self_us, cumulative_us, nome_modulo), ...] nell'ordine di stampa.
+    """
+    env = dict(os.environ)
+    for k, v in DUMMY_ENV.items():
+        env.setdefault(k, v)
+    env["FIRME_PRELOAD"] = "0"
+
+    cmd = [sys.executable, "-X", "importtime", "-c", f"import {module}"]
+    proc = subprocess.run(cmd, cwd=DIR, env=env, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} fallito:\n{proc.stderr[-2000:]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        # formato: "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3:
+            continue
+        try:
+            self_us = int(parts[0].strip())
+            cum_us = int(parts[1].strip())
+        except ValueError:
+            continue  # riga di intestazione
+        name = parts[2].rstrip()[1:]  # toglie lo spazio dopo il separatore
+        rows.append((self_us, cum_us, name))
+    return rows
+
+
+def build_report(rows: list[tuple[int, int, str]], budget_ms: int, top: int) -> dict:
+    total_us = sum(r[0] for r in rows)
+    imported = {r[2].strip() for r in rows}
+
+    # import diretti del modulo misurato (indentazione di un livello), per costo cumulativo
+    direct = [r for r in rows if r[2].startswith("  ") and not r[2].startswith("    ")]
+    direct.sort(key=lambda r: r[1], reverse=True)
+
+    eager = sorted({
+        m for m in imported
+        for lazy in LAZY_MODULES
+        if m == lazy or m.startswith(lazy + ".")
+    })
+
+    return {
+        "total_ms": round(total_us / 1000, 1),
+        "budget_ms": budget_ms,
+        "modules": len(rows),
+        "top": [
+            {"module": r[2].strip(), "cumulative_ms": round(r[1] / 1000, 1)}
+            for r in direct[:top]
+        ],
+        "eager_heavy_modules": eager,
+        "ok": (total_us / 1000) <= budget_ms and not eager,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Budget del tempo di import di avvia_tool")
+    ap.add_argument("--budget-ms", type=int, default=IMPORT_BUDGET_MS)
+    ap.add_argument("--top", type=int, default=10)
+    ap.add_argument("--module", default="avvia_tool")
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    report = build_report(run_importtime(args.module), args.budget_ms, args.top)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"[IMPORT] {args.module}: {report['total_ms']} ms "
+              f"({report['modules']} moduli, budget {report['budget_ms']} ms)")
+        for t in report["top"]:
+            print(f"  {t['cumulative_ms']:>8} ms  {t['module']}")
+        if report["eager_heavy_modules"]:
+            print(f"[ERRORE] Librerie pesanti importate all'avvio: {', '.join(report['eager_heavy_modules'])}")
+
+    if not report["ok"]:
+        if not report["eager_heavy_modules"]:
+            print(f"[ERRORE] Budget superato: {report['total_ms']} ms > {report['budget_ms']} ms")
+        sys.exit(1)
+    print("[OK] Avvio entro il budget.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# corpus_allegati.py
+"""
+Testo degli allegati PDF dei bandi (criteri, tracce, graduatorie, ...),
+estratto una sola volta per contenuto e conservato compresso.
+
+Lo scraper URP scarica già ogni PDF per la verifica di accessibilità: qui
+il testo viene estratto pagina per pagina in un pool di processi (PyMuPDF,
+altrimenti pdfminer) mentre lo scraper analizza i tag, e salvato in SQLite
+(SHARED_STATE_DIR/corpus.sqlite) con chiave lo SHA-256 del file. Un PDF già
+visto, anche sotto un altro URL o a un nuovo giro di scraping, non viene
+più estratto. Anche le estrazioni fallite vengono registrate (stesso file,
+stesso esito).
+
+Per ogni documento: testo completo compresso con zlib e offset di inizio di
+ogni pagina, così search_index indicizza le singole pagine e mostra lo
+snippet con il numero di pagina.
+
+ENV:
+  CORPUS_PROCS      (default: metà dei core) processi di estrazione
+  CORPUS_TIMEOUT    (default: 120) secondi massimi di attesa di un'estrazione
+  CORPUS_MAX_CHARS  (default: 2000000) caratteri conservati per documento
+"""
+import io
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+import multiprocessing as mp
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from shared_state import SharedDB
+
+CORPUS_PROCS = int(os.environ.get("CORPUS_PROCS", str(max(1, (os.cpu_count() or 2) // 2))))
+CORPUS_TIMEOUT = int(os.environ.get("CORPUS_TIMEOUT", "120"))
+CORPUS_MAX_CHARS = int(os.environ.get("CORPUS_MAX_CHARS", "2000000"))
+
+_db = SharedDB("corpus", """
+CREATE TABLE IF NOT EXISTS texts (
+  hash TEXT PRIMARY KEY, pages INTEGER NOT NULL, offsets TEXT NOT NULL, body BLOB NOT NULL,
+  extractor TEXT, error TEXT, extracted_at REAL
+);
+""")
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+# estrazioni in corso in questo processo: hash -> Future (stesso PDF inviato due volte)
+_inflight: dict[str, Future] = {}
+
+
+def content_hash(pdf_bytes: bytes) -> str:
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: i processi non ereditano thread/lock del chiamante
+            _pool = ProcessPoolExecutor(max_workers=CORPUS_PROCS, mp_context=mp.get_context("spawn"))
+        return _pool
+
+
+# ========= Lato processo di estrazione =========
+def extract_pages(pdf_bytes: bytes) -> tuple[list[str], str]:
+    """Testo di ogni pagina e nome dell'estrattore usato."""
+    try:
+        import fitz  # PyMuPDF
+    except ImportError:
+        fitz = None
+    if fitz is not None:
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            return [page.get_text() for page in doc], "pymupdf"
+
+    from pdfminer.high_level import extract_text
+
+    # pdfminer separa le pagine con un form feed
+    text = extract_text(io.BytesIO(pdf_bytes)) or ""
+    pages = text.split("\f")
+    if len(pages) > 1 and not pages[-1].strip():
+        pages.pop()
+    return pages, "pdfminer"
+
+
+# ========= Archivio =========
+def _store(h: str, pages: list[str], extractor: str | None, error: str | None = None) -> list[str]:
+    kept, total = [], 0
+    for p in pages:
+        p = p[: max(0, CORPUS_MAX_CHARS - total)]
+        kept.append(p)
+        total += len(p)
+    offsets, pos = [], 0
+    for p in kept:
+        offsets.append(pos)
+        pos += len(p)
+    _db.connect().execute(
+        "INSERT OR REPLACE INTO texts (hash, pages, offsets, body, extractor, error, extracted_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (h, len(kept), json.dumps(offsets), zlib.compress("".join(kept).encode("utf-8")),
+         extractor, error, time.time()))
+    return kept
+
+
+def get_pages(h: str) -> list[str] | None:
+    """Testo per pagina del PDF con hash `h`; None se mai estratto."""
+    row = _db.connect().execute("SELECT offsets, body FROM texts WHERE hash = ?", (h,)).fetchone()
+    if row is None:
+        return None
+    offsets = json.loads(row[0])
+    body = zlib.decompress(row[1]).decode("utf-8")
+    return [body[a:b] for a, b in zip(offsets, offsets[1:] + [len(body)])]
+
+
+def known(hashes) -> set[str]:
+    """Quali degli hash hanno già il testo in archivio."""
+    hashes = list(hashes)
+    out = set()
+    conn = _db.connect()
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        out.update(r[0] for r in conn.execute(
+            f"SELECT hash FROM texts WHERE hash IN ({', '.join('?' * len(chunk))})", chunk))
+    return out
+
+
+def submit(pdf_bytes: bytes) -> tuple[str, Future]:
+    """
+    Hash del PDF e Future con il testo per pagina (list[str], [] se non
+    estraibile). Se il testo è già in archivio il Future è già completato e
+    non parte nessuna estrazione.
+    """
+    h = content_hash(pdf_bytes)
+    with _pool_lock:
+        pending = _inflight.get(h)
+    if pending is not None:
+        return h, pending
+
+    done: Future = Future()
+    pages = get_pages(h)
+    if pages is not None:
+        done.set_result(pages)
+        return h, done
+
+    with _pool_lock:
+        if h in _inflight:
+            return h, _inflight[h]
+        _inflight[h] = done
+
+    def _finish(f: Future):
+        pages = []
+        try:
+            pages = _store(h, *f.result())
+        except BrokenProcessPool:
+            # processo morto (es. memoria): non è un esito del file, si riproverà
+            _reset_pool()
+        except Exception as e:
+            _store(h, [], None, error=str(e)[:500])
+        finally:
+            with _pool_lock:
+                _inflight.pop(h, None)
+            done.set_result(pages)
+
+    try:
+        get_pool().submit(extract_pages, pdf_bytes).add_done_callback(_finish)
+    except BrokenProcessPool:
+        _reset_pool()
+        get_pool().submit(extract_pages, pdf_bytes).add_done_callback(_finish)
+    return h, done
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        _pool = None
+
+
+def shutdown() -> None:
+    """Chiude il pool (fine dello scraper)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
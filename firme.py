@@ -0,0 +1,581 @@
+# firme.py
+"""
+Redazione firme: analisi PDF con YOLO e generazione PDF oscurati.
+
+Le librerie pesanti (PyMuPDF, Pillow, img2pdf, numpy, huggingface_hub,
+ultralytics) NON vengono importate a livello di modulo: il blueprint si registra
+all'avvio senza costi e le dipendenze si caricano alla prima richiesta che le usa.
+L'inferenza YOLO gira in un processo dedicato (vedi firme_worker).
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import itertools
+import threading
+from typing import TYPE_CHECKING
+
+from flask import (
+    Blueprint, Response, jsonify, request, session, url_for, send_file,
+    stream_with_context
+)
+
+from auth import login_required
+from signed_urls import sign_url, signed_or_login_required, has_signature
+from firme_model import get_yolo_firme, predict_signatures, merge_part_boxes, FIRME_PREDICT_BATCH
+from firme_worker import get_inference_client, InferenceBusy, InferenceError
+from firme_raster import (
+    iter_pdf_pages, page_count, PageRaster, preview_filename, ensure_preview, FIRME_PREVIEW_WIDTH
+)
+from firme_pipeline import iter_pipeline, use_pipeline
+from firme_phash import get_layout_cache, with_prior
+from firme_jobs import Job, jobs
+import firme_store
+from firme_store import DOCS_FIRME_ROOT
+from firme_redact import (
+    pages_from_payload, iter_finalized, stream_zip, REDACT_MODES, FIRME_REDACT_MODE
+)
+
+if TYPE_CHECKING:  # solo per le annotazioni, nessun import a runtime
+    import numpy as np
+
+firme_bp = Blueprint("firme", __name__)
+
+# ========= Config firme / modello YOLO =========
+# cartella dove salvare PDF e immagini per la redazione firme (vedi firme_store)
+os.makedirs(DOCS_FIRME_ROOT, exist_ok=True)
+
+# FIRME_PRELOAD=1 -> il modello viene caricato in background all'avvio del server
+FIRME_PRELOAD = os.environ.get("FIRME_PRELOAD", "0") == "1"
+
+# immagini delle pagine per la UI: larghezza dello zoom e cache del browser (privata)
+PAGES_URL = "/api/firme/pages"
+FIRME_ZOOM_WIDTH = int(os.environ.get("FIRME_ZOOM_WIDTH", "1600"))
+FIRME_PAGE_MAX_AGE = int(os.environ.get("FIRME_PAGE_MAX_AGE", "3600"))
+
+
+def preload_model_async() -> threading.Thread | None:
+    """
+    Se FIRME_PRELOAD=1 avvia subito i worker di inferenza (o carica il modello
+    inline se FIRME_WORKERS=0) in un thread daemon, senza bloccare l'avvio.
+    """
+    if not FIRME_PRELOAD:
+        return None
+
+    def _load():
+        try:
+            client = get_inference_client()
+            if client is not None:
+                client.start()
+            else:
+                get_yolo_firme()
+        except Exception as e:
+            print(f"[FIRME][ERR] Preload modello fallito: {e}", flush=True)
+
+    t = threading.Thread(target=_load, daemon=True)
+    t.start()
+    return t
+
+
+def detect_signatures(images: list, sizes: list | None = None) -> list[list[dict]]:
+    """
+    Rileva le firme su più pagine in memoria (array numpy HxWx3 BGR), a batch.
+
+    L'inferenza gira nel worker dedicato (firme_worker) oppure, con
+    FIRME_WORKERS=0, nel processo corrente. Parametri (imgsz, confidenza,
+    batch) da FIRME_IMGSZ / FIRME_CONF / FIRME_PREDICT_BATCH; con
+    FIRME_DETECT_MODE=coarse rilevamento a due passate (firme_model).
+    `sizes`: imgsz per immagine, None = pagina intera (ritagli di firme_anchors).
+
+    Restituisce, per ogni pagina, box NORMALIZZATE:
+    [
+      {"x": x_norm, "y": y_norm, "w": w_norm, "h": h_norm, "score": conf},
+      ...
+    ]
+    dove x,y sono top-left, w,h dimensioni, tutto in [0,1].
+    """
+    if not images:
+        return []
+    client = get_inference_client()
+    if client is not None:
+        return client.detect(images, sizes)
+    import numpy as np
+
+    try:
+        return predict_signatures(get_yolo_firme(), [np.ascontiguousarray(img) for img in images], imgsz=sizes)
+    except Exception as e:
+        raise InferenceError(str(e)) from e
+
+
+def _holder() -> str:
+    """
+    Chi usa i documenti caricati (riferimenti in firme_store): l'utente della
+    sessione. Le schede dello stesso utente condividono la sessione, per questo
+    firme_store conta un riferimento per upload e non uno per utente.
+    """
+    return session.get("user") or "anonimo"
+
+
+def _page_info(doc_id: str, url_prefix: str, holder: str, index: int, width: int, height: int,
+               auto_boxes: list[dict], skipped: bool = False) -> dict:
+    page_url = f"{url_prefix}/{doc_id}/{index}"
+    # la firma copre anche chi ha caricato il documento: valida finché ne tiene un riferimento
+    h = firme_store.holder_tag(holder)
+    return {
+        "index": index,
+        # anteprima leggera per la lista pagine, zoom e originale su richiesta
+        # URL firmati: il browser li carica senza passare dalla sessione e li tiene in cache
+        "image_url": sign_url(page_url, {"w": FIRME_PREVIEW_WIDTH, "h": h}),
+        "zoom_url": sign_url(page_url, {"w": min(width, FIRME_ZOOM_WIDTH), "h": h}),
+        "full_image_url": sign_url(page_url, {"h": h}),
+        "width": width,
+        "height": height,
+        "auto_boxes": auto_boxes,
+        "skipped": skipped,  # scartata dal pre-filtro, YOLO non eseguito
+    }
+
+
+def _detect_and_store(batch: list[PageRaster], doc_dir: str) -> list[tuple[int, int, int, list[dict], bool]]:
+    """
+    Rileva le firme su un gruppo di pagine e salva PNG e anteprime per la UI.
+    Le pagine scartate dal pre-filtro (firme_prefilter) non vanno al modello,
+    quelle con ancore di testo (firme_anchors) ci vanno solo come ritagli;
+    con FIRME_PHASH=1 alle pagine già viste si aggiungono le box in cache.
+    """
+    cache = get_layout_cache()
+    parts = [page.detect_parts() for page in batch]
+    flat = [part for page_parts in parts for part in page_parts]
+    found = iter(detect_signatures([img for img, _, _ in flat], [size for _, _, size in flat]))
+
+    out = []
+    for page, page_parts in zip(batch, parts):
+        boxes = merge_part_boxes([(rect, next(found)) for _, rect, _ in page_parts])
+        skipped = not page_parts
+        key = page.layout_key() if page_parts and cache is not None else None
+        if key is not None:
+            prior = cache.lookup(key)
+            cache.store(key, boxes)  # solo le box del modello, i suggerimenti non si propagano
+            boxes = with_prior(boxes, prior)
+        # PNG solo per la UI di revisione, il modello non lo rilegge
+        page.save_png(os.path.join(doc_dir, f"page_{page.index}.png"))
+        page.save_preview(os.path.join(doc_dir, preview_filename(page.index)))
+        out.append((page.index, page.width, page.height, boxes, skipped))
+    return out
+
+
+def _iter_streaming(pdf_path: str, doc_dir: str, dpi: int):
+    """Percorso a processo singolo: rendering in streaming + rilevamento a batch."""
+    batch: list[PageRaster] = []
+    for page in iter_pdf_pages(pdf_path, dpi=dpi):
+        batch.append(page)
+        if len(batch) >= FIRME_PREDICT_BATCH:
+            yield from _detect_and_store(batch, doc_dir)
+            batch = []
+    if batch:
+        yield from _detect_and_store(batch, doc_dir)
+
+
+def analyze_pdf(pdf_path: str, doc_id: str, doc_dir: str, url_prefix: str, holder: str,
+                dpi: int = 200, on_page=None, n_pages: int | None = None) -> list[dict]:
+    """
+    Rasterizza il PDF e rileva le firme pagina per pagina, in ordine.
+
+    - documenti lunghi: pipeline multi-processo (firme_pipeline), rendering
+      parallelo sovrapposto all'inferenza;
+    - altrimenti: rendering in streaming e rilevamento a gruppi di
+      FIRME_PREDICT_BATCH pagine.
+    In entrambi i casi la memoria resta limitata qualunque sia il numero di pagine.
+
+    on_page(page_info), se passato, viene chiamato appena ogni pagina è pronta.
+    holder: chi ha caricato il PDF, legato agli URL firmati delle pagine.
+    """
+    n = page_count(pdf_path) if n_pages is None else n_pages
+    if use_pipeline(n):
+        results = iter_pipeline(pdf_path, doc_dir, dpi=dpi, n_pages=n)
+    else:
+        results = _iter_streaming(pdf_path, doc_dir, dpi)
+
+    pages_info: list[dict] = []
+    for index, width, height, auto_boxes, skipped in results:
+        info = _page_info(doc_id, url_prefix, holder, index, width, height, auto_boxes, skipped)
+        pages_info.append(info)
+        if on_page:
+            on_page(info)
+
+    n_skipped = sum(p["skipped"] for p in pages_info)
+    if n_skipped:
+        print(f"[FIRME] Pre-filtro: {n_skipped}/{len(pages_info)} pagine senza inchiostro candidato, "
+              f"YOLO saltato (doc_id={doc_id[:12]})", flush=True)
+    return pages_info
+
+
+def _run_analysis(job: Job, url_prefix: str) -> None:
+    """
+    Corpo del job: documento per documento, pagina per pagina.
+    Un PDF illeggibile segna solo quel documento; un errore del modello ferma il job.
+    """
+    for doc in job.documents:
+        doc_id = doc["doc_id"]
+        doc_dir = firme_store.doc_dir(doc_id)
+        pdf_path = os.path.join(doc_dir, "original.pdf")
+
+        # stesso PDF caricato più volte: una sola analisi, le altre attendono e la riusano
+        try:
+            with firme_store.analysis_lock(doc_id):
+                cached = firme_store.load_analysis(doc_id)
+                if cached is not None:
+                    job.start_document(doc_id, len(cached))
+                    for p in cached:
+                        job.add_page(doc_id, _page_info(doc_id, url_prefix, job.owner, p["index"], p["width"],
+                                                        p["height"], p["auto_boxes"], p.get("skipped", False)))
+                    print(f"[FIRME] Documento {doc_id[:12]} già analizzato: riuso {len(cached)} pagine", flush=True)
+                    continue
+
+                n_pages = page_count(pdf_path)
+                job.start_document(doc_id, n_pages)
+                pages_info = analyze_pdf(pdf_path, doc_id, doc_dir, url_prefix, job.owner, dpi=200, n_pages=n_pages,
+                                         on_page=lambda info, d=doc_id: job.add_page(d, info))
+                firme_store.save_analysis(doc_id, pages_info)
+        except InferenceBusy as e:
+            print(f"[FIRME][WARN] Inferenza satura (doc_id={doc_id}): {e}", flush=True)
+            raise
+        except InferenceError as e:
+            print(f"[FIRME][ERR] Rilevamento firme (doc_id={doc_id}): {e}", flush=True)
+            raise InferenceError(f"Modello firme non disponibile: {e}") from e
+        except Exception as e:
+            print(f"[FIRME][ERR] PDF->immagini (doc_id={doc_id}): {e}", flush=True)
+            job.fail_document(doc_id, f"Errore nella conversione PDF->immagini (PyMuPDF): {e}")
+
+    print(f"[FIRME] Analizzati {len(job.documents)} documenti per la redazione firme (job {job.id})", flush=True)
+
+
+# ========= Routes =========
+@firme_bp.route("/api/firme/analyze", methods=["POST"])
+@login_required
+def api_firme_analyze():
+    """
+    Accetta uno o più PDF (campo 'pdf'), li salva e avvia l'analisi in background.
+    Il doc_id è lo SHA-256 del file: un PDF già caricato di recente viene
+    restituito subito con le pagine e i rilevamenti già calcolati.
+    Risponde subito (202) con:
+    {
+      "job_id": "...",
+      "status_url": "/api/firme/jobs/<job_id>",          # snapshot / polling (?since=N)
+      "events_url": "/api/firme/jobs/<job_id>/events",   # Server-Sent Events
+      "documents": [ {"doc_id": "...", "filename": "nome.pdf"}, ... ]
+    }
+
+    Eventi prodotti dal job (stesso formato in SSE e in polling):
+      {"type": "document", "doc_id", "filename", "total_pages"}
+      {"type": "page", "doc_id", "page": {index, image_url, width, height, auto_boxes}}
+      {"type": "document_error", "doc_id", "error"}
+      {"type": "done", "status": "done"|"error", "error"}
+
+    Con ?sync=1 la risposta è quella storica, a fine analisi:
+    { "documents": [ { "doc_id", "filename", "pages": [ {...}, ... ] }, ... ] }
+    """
+    files = request.files.getlist("pdf")
+    if not files:
+        return jsonify({"error": "Nessun file PDF inviato"}), 400
+
+    documents = []
+    holder = _holder()
+
+    for pdf_file in files:
+        if not pdf_file.filename:
+            continue
+
+        # ID = SHA-256 del contenuto: lo stesso PDF ricaricato riusa l'analisi già fatta
+        doc_id, reused = firme_store.save_upload(pdf_file.stream, holder)
+        if any(d["doc_id"] == doc_id for d in documents):
+            print(f"[FIRME][WARN] {pdf_file.filename}: PDF duplicato nello stesso invio, ignorato", flush=True)
+            continue
+        if reused:
+            print(f"[FIRME] {pdf_file.filename}: documento già presente ({doc_id[:12]})", flush=True)
+
+        documents.append({"doc_id": doc_id, "filename": pdf_file.filename})
+
+    if not documents:
+        return jsonify({"error": "Nessun file PDF inviato"}), 400
+
+    # immagini servite da /api/firme/pages/<doc_id>/<index> (URL firmati, anteprime in cache)
+    url_prefix = request.script_root + PAGES_URL
+
+    if request.args.get("sync") == "1":
+        job = Job(holder, documents)
+        try:
+            _run_analysis(job, url_prefix)
+        except InferenceBusy as e:
+            return jsonify({"error": str(e)}), 503
+        except InferenceError as e:
+            return jsonify({"error": str(e)}), 503
+        failed = [d for d in job.documents if d["error"]]
+        if failed:
+            return jsonify({"error": failed[0]["error"]}), 500
+        return jsonify({"documents": [
+            {"doc_id": d["doc_id"], "filename": d["filename"], "pages": d["pages"]}
+            for d in job.documents
+        ]})
+
+    job = jobs.submit(holder, documents, lambda j: _run_analysis(j, url_prefix))
+    print(f"[FIRME] Job {job.id}: {len(documents)} documenti in coda", flush=True)
+    return jsonify({
+        "job_id": job.id,
+        "status_url": url_for("firme.api_firme_job", job_id=job.id),
+        "events_url": url_for("firme.api_firme_job_events", job_id=job.id),
+        "documents": documents,
+    }), 202
+
+
+@firme_bp.get("/api/firme/jobs/<job_id>")
+@login_required
+def api_firme_job(job_id):
+    """
+    Stato del job. Con ?since=N include anche gli eventi a partire dall'N-esimo
+    (polling incrementale: il client ripassa il valore di "next").
+    """
+    job = jobs.get(job_id, owner=_holder())
+    if job is None:
+        return jsonify({"error": "Job non trovato o scaduto"}), 404
+
+    out = job.snapshot()
+    since = request.args.get("since", type=int)
+    if since is not None:
+        events = job.events[since:]
+        out["events"] = events
+        out["next"] = since + len(events)
+    return jsonify(out)
+
+
+@firme_bp.get("/api/firme/jobs/<job_id>/events")
+@login_required
+def api_firme_job_events(job_id):
+    """Eventi del job in streaming (text/event-stream), una pagina per evento."""
+    job = jobs.get(job_id, owner=_holder())
+    if job is None:
+        return jsonify({"error": "Job non trovato o scaduto"}), 404
+
+    # riconnessione EventSource: riparte dall'evento successivo all'ultimo ricevuto
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    cursor = last_id + 1 if last_id is not None else request.args.get("since", 0, type=int)
+
+    def _stream(cursor: int):
+        while True:
+            events = job.wait_events(cursor, timeout=15)
+            if not events:
+                if job.finished:
+                    return
+                yield ": keepalive\n\n"
+                continue
+            for ev in events:
+                yield f"id: {cursor}\nevent: {ev['type']}\ndata: {json.dumps(ev)}\n\n"
+                cursor += 1
+                if ev["type"] == "done":
+                    return
+
+    return Response(stream_with_context(_stream(cursor)), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # niente buffering su nginx/proxy
+    })
+
+
+def _zip_members(results):
+    """(nome, risultato di finalize_document) -> (nome, pdf_bytes), saltando gli errori."""
+    for safe_name, res in results:
+        if res["error"]:
+            print(f"[FIRME][ERR] Errore nella redazione di {safe_name}: {res['error']}", flush=True)
+            continue
+        if not res["pdf"]:
+            print(f"[FIRME][WARN] Nessuna pagina redatta per {safe_name}", flush=True)
+            continue
+        print(f"[FIRME] Aggiungo al ZIP: {safe_name} ({res['pages']} pagine, {res['mode']}, "
+              f"{res['seconds']}s)", flush=True)
+        yield safe_name, res["pdf"]
+
+
+def _release_documents(doc_ids: list[str], holder: str):
+    """
+    Rilascia i documenti confermati: la cartella viene cancellata solo se
+    nessun altro utente sta usando lo stesso PDF (vedi firme_store.release).
+    """
+    for doc_id in doc_ids:
+        try:
+            if firme_store.release(doc_id, holder):
+                print(f"[FIRME] Eliminata cartella temporanea: {firme_store.doc_dir(doc_id)}", flush=True)
+        except Exception as e:
+            print(f"[FIRME][WARN] Impossibile eliminare {doc_id}: {e}", flush=True)
+
+
+@firme_bp.get("/api/firme/storage")
+@login_required
+def api_firme_storage():
+    """
+    Occupazione di docs_firme (documenti, byte, quota), contatori di pulizia/dedup
+    e della cache dei rilevamenti per le pagine ricorrenti (firme_phash).
+    """
+    cache = get_layout_cache()
+    return jsonify(dict(firme_store.stats(), layout_cache=cache.stats() if cache is not None else None))
+
+
+@firme_bp.get(PAGES_URL + "/<doc_id>/<int:index>")
+@signed_or_login_required
+def api_firme_page(doc_id, index):
+    """
+    Immagine di una pagina analizzata.
+      ?w=N  anteprima WebP/JPEG larga N px (arrotondata a multipli di 200 px),
+            generata dal PNG alla prima richiesta e poi servita dalla cache su disco
+      senza w: PNG a piena risoluzione
+    Le immagini non cambiano mai per un dato doc_id: cache privata del browser + ETag
+    (con URL firmato fino alla scadenza della firma, vedi signed_urls).
+    Servita solo a chi ha ancora un riferimento sul documento: l'utente indicato
+    nella firma (?h=, vedi _page_info) o, senza firma, quello della sessione.
+    """
+    if not firme_store.is_valid_doc_id(doc_id):
+        return jsonify({"error": "doc_id non valido"}), 404
+    tag = request.args.get("h", "") if has_signature(request) else firme_store.holder_tag(_holder())
+    if not tag or not firme_store.held_by(doc_id, tag):
+        return jsonify({"error": "Pagina non trovata"}), 404
+    doc_dir = firme_store.doc_dir(doc_id)
+    firme_store.touch(doc_id)
+
+    width = request.args.get("w", type=int)
+    if width:
+        # larghezze "a gradini": poche varianti in cache per pagina
+        if width != FIRME_PREVIEW_WIDTH:
+            width = min(max(200, -(-width // 200) * 200), 4000)
+        path = ensure_preview(doc_dir, index, width)
+    else:
+        path = os.path.join(doc_dir, f"page_{index}.png")
+        if not os.path.exists(path):
+            path = None
+    if path is None:
+        return jsonify({"error": "Pagina non trovata"}), 404
+
+    resp = send_file(path, conditional=True, max_age=FIRME_PAGE_MAX_AGE)
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
+
+@firme_bp.post("/api/firme/confirm")
+@login_required
+def api_firme_confirm():
+    """
+    Riceve:
+    {
+      "documents": [
+        {
+          "doc_id": "...",
+          "filename": "nome.pdf",
+          "pages": [
+            {
+              "page_index": 0,
+              "boxes": [ {"x":..,"y":..,"w":..,"h":..}, ... ]
+            },
+            ...
+          ]
+        },
+        ...
+      ]
+    }
+
+    Campo opzionale "mode": "raster" (default, vedi FIRME_REDACT_MODE) o
+    "vector" (redazione PyMuPDF su original.pdf, testo selezionabile).
+
+    Per ogni documento (in parallelo, vedi firme_redact.iter_finalized):
+      - applica i rettangoli neri (irreversibili) alle pagine con box
+      - crea un PDF oscurato in memoria
+    Poi:
+      - invia lo ZIP in streaming, un membro per documento appena è pronto
+      - a fine invio (anche se il client si disconnette) rilascia i documenti:
+        le cartelle docs_firme/<doc_id> vengono cancellate, tranne quelle di
+        PDF che un altro utente ha caricato e sta ancora rivedendo
+
+    Nessun file PDF o immagine rimane sul server dopo la risposta, salvo che
+    per i documenti ancora in uso da altri. I doc_id che l'utente non ha
+    caricato (nessun riferimento in firme_store) vengono ignorati.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({"error": "JSON mancante in /api/firme/confirm"}), 400
+
+        docs_data = data.get("documents", [])
+        if not docs_data:
+            return jsonify({"error": "Nessun documento da elaborare"}), 400
+
+        mode = (data.get("mode") or FIRME_REDACT_MODE).lower()
+        if mode not in REDACT_MODES:
+            return jsonify({"error": f"mode non valido: {mode} (ammessi: {', '.join(REDACT_MODES)})"}), 400
+
+        print(f"[FIRME] Conferma redazione per {len(docs_data)} documenti (modalità {mode})", flush=True)
+
+        doc_ids = []   # riferimenti da rilasciare alla fine
+        tasks = []     # (nome nello ZIP, doc_dir, pages)
+        holder = _holder()
+
+        for doc_entry in docs_data:
+            doc_id = doc_entry.get("doc_id")
+            pages_data = doc_entry.get("pages", [])
+            filename = (doc_entry.get("filename") or f"documento_{doc_id}.pdf").strip()
+
+            if not doc_id:
+                print("[FIRME][WARN] doc_id mancante in una voce di documents", flush=True)
+                continue
+
+            if not firme_store.is_valid_doc_id(doc_id):
+                print(f"[FIRME][WARN] doc_id non valido: {doc_id!r}", flush=True)
+                continue
+
+            doc_dir = firme_store.doc_dir(doc_id)
+            if not os.path.isdir(doc_dir):
+                print(f"[FIRME][WARN] Cartella documento non trovata: {doc_dir}", flush=True)
+                continue
+
+            # solo i documenti caricati da chi conferma (e una volta sola: un riferimento da rilasciare)
+            if doc_id in doc_ids or not firme_store.held_by(doc_id, firme_store.holder_tag(holder)):
+                print(f"[FIRME][WARN] Documento {doc_id[:12]} non caricato da questo utente o ripetuto, "
+                      f"ignorato", flush=True)
+                continue
+
+            doc_ids.append(doc_id)
+            firme_store.touch(doc_id)  # niente sfratto LRU durante la finalizzazione
+
+            safe_name = os.path.basename(filename)
+            if not safe_name.lower().endswith(".pdf"):
+                safe_name += ".pdf"
+            tasks.append((safe_name, doc_dir, pages_from_payload(doc_id, pages_data)))
+
+        t0 = time.perf_counter()
+        members = _zip_members(iter_finalized(tasks, mode))
+
+        # il primo documento pronto si attende prima di rispondere: se non ce n'è
+        # nessuno si può ancora restituire un errore esplicito invece di uno ZIP vuoto
+        first = next(members, None)
+        if first is None:
+            _release_documents(doc_ids, holder)
+            print("[FIRME][ERR] ZIP vuoto: nessun PDF oscurato generato", flush=True)
+            return jsonify({"error": "Nessun PDF oscurato generato (nessuna pagina utile)."}), 400
+        print(f"[FIRME] Primo PDF oscurato pronto in {time.perf_counter() - t0:.2f}s, avvio invio ZIP", flush=True)
+
+        def _stream():
+            sent = 0
+            try:
+                for chunk in stream_zip(itertools.chain([first], members)):
+                    sent += len(chunk)
+                    yield chunk
+            finally:
+                members.close()  # ferma la finalizzazione se il client si è disconnesso
+                _release_documents(doc_ids, holder)
+                print(f"[FIRME] ZIP inviato: {sent} byte in {time.perf_counter() - t0:.2f}s", flush=True)
+
+        return Response(_stream(), mimetype="application/zip", headers={
+            "Content-Disposition": 'attachment; filename="pdf_oscurati.zip"',
+            "X-Accel-Buffering": "no",
+        })
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"Errore interno durante la generazione ZIP: {e}"}), 500
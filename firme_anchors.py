@@ -0,0 +1,110 @@
+# firme_anchors.py
+"""
+Regioni di interesse dallo strato di testo per i PDF nativi digitali
+(determine, verbali, decreti): la firma sta quasi sempre accanto a diciture
+prevedibili ("Il Direttore", "Firmato", "Il Presidente della Commissione", ...)
+o sotto le ultime righe della pagina.
+
+Se una pagina ha almeno un'ancora, il modello non vede la pagina intera ma
+solo i ritagli attorno alle ancore (più la zona sotto le ultime righe), ognuno
+con un imgsz proporzionale (firme_model.roi_imgsz): stessa scala della pagina
+intera, molti meno pixel. Senza ancore (scansioni, pagine di solo testo
+corrente) si torna al rilevamento sulla pagina intera; idem se i ritagli
+coprirebbero quasi tutta la pagina.
+
+Un'ancora è una riga corta (al massimo FIRME_ANCHOR_MAX_WORDS parole) che
+contiene una delle diciture di FIRME_ANCHOR_REGEX: così "... il Presidente
+della Commissione dichiara aperta la riunione" nel corpo del verbale non conta.
+In larghezza il ritaglio copre la dicitura e le righe di testo che cadono
+nella sua fascia verticale (nome, linea puntinata per la firma), più un margine.
+
+ENV:
+  FIRME_ANCHORS            (default: 0)    1 = rilevamento solo attorno alle ancore di testo
+  FIRME_ANCHOR_REGEX       (default: diciture di firma italiane) regex, senza distinzione di maiuscole
+  FIRME_ANCHOR_MAX_WORDS   (default: 8)    parole massime di una riga ancora
+  FIRME_ANCHOR_BELOW       (default: 0.15) altezza della zona sotto l'ancora (frazione di pagina)
+  FIRME_ANCHOR_SIDE        (default: 0.15) margine orizzontale attorno all'ancora (frazione di pagina)
+  FIRME_ANCHOR_TAIL_LINES  (default: 2)    ultime righe della pagina usate come ancora aggiuntiva; 0 = no
+  FIRME_ANCHOR_MAX_AREA    (default: 0.6)  oltre questa frazione di pagina si usa la pagina intera
+"""
+from __future__ import annotations
+
+import os
+import re
+
+from firme_model import merge_rects
+
+FIRME_ANCHORS = os.environ.get("FIRME_ANCHORS", "0") == "1"
+FIRME_ANCHOR_REGEX = os.environ.get(
+    "FIRME_ANCHOR_REGEX",
+    r"\b(il|la)\s+(direttore|direttrice|dirigente|presidente|segretari[oa]|responsabile"
+    r"|rettore|rettrice|commissari[oa]|componente|sindac[oa]|funzionari[oa])\b"
+    r"|\bi\s+componenti\b|\bfirmat[oa]\b|\bf\.to\b|\bfirma\b",
+)
+FIRME_ANCHOR_MAX_WORDS = int(os.environ.get("FIRME_ANCHOR_MAX_WORDS", "8"))
+FIRME_ANCHOR_BELOW = float(os.environ.get("FIRME_ANCHOR_BELOW", "0.15"))
+FIRME_ANCHOR_SIDE = float(os.environ.get("FIRME_ANCHOR_SIDE", "0.15"))
+FIRME_ANCHOR_TAIL_LINES = int(os.environ.get("FIRME_ANCHOR_TAIL_LINES", "2"))
+FIRME_ANCHOR_MAX_AREA = float(os.environ.get("FIRME_ANCHOR_MAX_AREA", "0.6"))
+
+_anchor_re = re.compile(FIRME_ANCHOR_REGEX, re.IGNORECASE)
+
+
+def text_lines(words: list, matrix) -> list[tuple[str, int, list[float]]]:
+    """
+    Righe dello strato di testo da page.get_text("words"): (testo, n. parole,
+    rettangolo [x0, y0, x1, y1] in pixel del render), dall'alto in basso.
+    """
+    import fitz  # PyMuPDF
+
+    lines: dict[tuple[int, int], list] = {}
+    for w in words:
+        x0, y0, x1, y1, text, block, line = w[:7]
+        entry = lines.setdefault((block, line), [[], fitz.Rect(x0, y0, x1, y1)])
+        entry[0].append(text)
+        entry[1] |= fitz.Rect(x0, y0, x1, y1)
+
+    out = []
+    for texts, rect in lines.values():
+        r = rect * matrix
+        out.append((" ".join(texts), len(texts), [r.x0, r.y0, r.x1, r.y1]))
+    out.sort(key=lambda ln: (ln[2][1], ln[2][0]))
+    return out
+
+
+def anchor_rois(words: list, matrix, shape: tuple) -> list[tuple[int, int, int, int]] | None:
+    """
+    Ritagli (x0, y0, x1, y1) in pixel del render su cui cercare le firme, già
+    uniti se si sovrappongono; None = nessuna ancora, usare la pagina intera.
+    """
+    h, w = shape[:2]
+    lines = text_lines(words, matrix)
+    anchors = [ln for ln in lines
+               if ln[1] <= FIRME_ANCHOR_MAX_WORDS and _anchor_re.search(ln[0])]
+    if not anchors:
+        return None
+
+    below, side = FIRME_ANCHOR_BELOW * h, FIRME_ANCHOR_SIDE * w
+    rects = []
+    for _, _, (x0, y0, x1, y1) in anchors:
+        lh = y1 - y0
+        # la firma può stare sopra la dicitura (sul nome) o sotto
+        top, bottom = y0 - 2 * lh, y1 + below
+        # in larghezza: anche le righe della zona (nome, linea puntinata "……")
+        band = [ln[2] for ln in lines if ln[2][3] > top and ln[2][1] < bottom]
+        left = min([x0] + [r[0] for r in band])
+        right = max([x1] + [r[2] for r in band])
+        rects.append([left - side, top, right + side, bottom])
+    if FIRME_ANCHOR_TAIL_LINES > 0:
+        tail = [ln[2] for ln in lines[-FIRME_ANCHOR_TAIL_LINES:]]
+        top, bottom = min(r[1] for r in tail), max(r[3] for r in tail)
+        rects.append([0, top - (bottom - top), w, bottom + below])
+
+    rois = []
+    for x0, y0, x1, y1 in merge_rects([[max(0, r[0]), max(0, r[1]), min(w, r[2]), min(h, r[3])]
+                                        for r in rects]):
+        if x1 - x0 >= 1 and y1 - y0 >= 1:
+            rois.append((int(x0), int(y0), int(x1 + 0.999), int(y1 + 0.999)))
+    if not rois or sum((r[2] - r[0]) * (r[3] - r[1]) for r in rois) > FIRME_ANCHOR_MAX_AREA * w * h:
+        return None
+    return rois
@@ -0,0 +1,258 @@
+# firme_jobs.py
+"""
+Job asincroni per l'analisi firme.
+
+/api/firme/analyze salva i PDF, crea un job e risponde subito con il job_id;
+il lavoro (rasterizzazione + rilevamento) gira in un pool di thread in
+background e ogni pagina pronta viene registrata come evento. La UI legge gli
+eventi in streaming (Server-Sent Events) o in polling e può iniziare la
+revisione della pagina 1 mentre la pagina 80 è ancora in analisi.
+
+Con più worker web (WEB_CONCURRENCY > 1, vedi gunicorn.conf.py) il job gira
+nel worker che ha ricevuto l'upload, ma le richieste di stato e di eventi
+possono arrivare a un altro: gli eventi vengono quindi anche salvati in SQLite
+(JobStore) e gli altri worker ricostruiscono lo stato rileggendoli (StoredJob).
+
+ENV:
+  FIRME_JOB_WORKERS (default: 2)    job analizzati in parallelo
+  FIRME_JOB_TTL     (default: 3600) secondi di conservazione di un job concluso
+"""
+import os
+import time
+import uuid
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_state import SharedDB, MULTI_PROCESS
+
+FIRME_JOB_WORKERS = int(os.environ.get("FIRME_JOB_WORKERS", "2"))
+FIRME_JOB_TTL = int(os.environ.get("FIRME_JOB_TTL", "3600"))
+
+# stati del job
+QUEUED, RUNNING, DONE, ERROR = "queued", "running", "done", "error"
+
+
+class Job:
+    """
+    Stato di un job di analisi. Gli eventi sono una lista append-only:
+    il cursore di un client è semplicemente l'indice del prossimo evento.
+    """
+
+    def __init__(self, owner: str, documents: list[dict], store: "JobStore | None" = None):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.status = QUEUED
+        self.error: str | None = None
+        self.created = time.time()
+        self.updated = self.created
+        # [{doc_id, filename, total_pages, pages: [...], skipped_pages, error}]
+        self.documents = [dict(d, total_pages=None, pages=[], skipped_pages=0, error=None) for d in documents]
+        self.events: list[dict] = []
+        self._cond = threading.Condition()
+        self._store = store
+        if store is not None:
+            store.create(self, documents)
+
+    # --- scrittura (thread del pool) ---
+    def _apply(self, event: dict):
+        """Aggiorna lo stato con un evento (anche quando lo rilegge uno StoredJob)."""
+        kind = event["type"]
+        if kind == "status":
+            self.status = event["status"]
+        elif kind == "document":
+            self._doc(event["doc_id"])["total_pages"] = event["total_pages"]
+        elif kind == "page":
+            doc = self._doc(event["doc_id"])
+            doc["pages"].append(event["page"])
+            doc["skipped_pages"] += bool(event["page"].get("skipped"))
+        elif kind == "document_error":
+            self._doc(event["doc_id"])["error"] = event["error"]
+        elif kind == "done":
+            self.status = event["status"]
+            self.error = event["error"]
+
+    def _emit(self, event: dict):
+        with self._cond:
+            self._apply(event)
+            self.events.append(event)
+            self.updated = time.time()
+            if self._store is not None:
+                self._store.append(self, len(self.events) - 1, event)
+            self._cond.notify_all()
+
+    def _doc(self, doc_id: str) -> dict:
+        return next(d for d in self.documents if d["doc_id"] == doc_id)
+
+    def start(self):
+        self._emit({"type": "status", "status": RUNNING})
+
+    def start_document(self, doc_id: str, total_pages: int):
+        self._emit({"type": "document", "doc_id": doc_id,
+                    "filename": self._doc(doc_id)["filename"], "total_pages": total_pages})
+
+    def add_page(self, doc_id: str, page: dict):
+        self._emit({"type": "page", "doc_id": doc_id, "page": page})
+
+    def fail_document(self, doc_id: str, error: str):
+        self._emit({"type": "document_error", "doc_id": doc_id, "error": error})
+
+    def finish(self, error: str | None = None):
+        self._emit({"type": "done", "status": ERROR if error else DONE, "error": error})
+
+    # --- lettura (request Flask) ---
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, ERROR)
+
+    def wait_events(self, cursor: int, timeout: float) -> list[dict]:
+        """Eventi da `cursor` in poi; se non ce ne sono attende fino a `timeout` secondi."""
+        with self._cond:
+            if cursor >= len(self.events) and not self.finished:
+                self._cond.wait(timeout=timeout)
+            return self.events[cursor:]
+
+    def snapshot(self) -> dict:
+        pages_done = sum(len(d["pages"]) for d in self.documents)
+        pages_total = sum(d["total_pages"] or 0 for d in self.documents)
+        pages_skipped = sum(d["skipped_pages"] for d in self.documents)
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "progress": {"pages_done": pages_done, "pages_total": pages_total,
+                         "pages_skipped": pages_skipped},
+            "documents": self.documents,
+        }
+
+
+class StoredJob(Job):
+    """Job eseguito da un altro processo web, in sola lettura: lo stato si ricostruisce dagli eventi salvati."""
+
+    def __init__(self, store: "JobStore", job_id: str, owner: str, documents: list[dict], created: float):
+        super().__init__(owner, documents)
+        self.id = job_id
+        self.created = self.updated = created
+        self._source = store
+
+    def refresh(self):
+        """Applica gli eventi salvati dopo l'ultimo letto."""
+        for event in self._source.events(self.id, len(self.events)):
+            self._apply(event)
+            self.events.append(event)
+
+    def wait_events(self, cursor: int, timeout: float) -> list[dict]:
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            if cursor < len(self.events) or self.finished or time.monotonic() >= deadline:
+                return self.events[cursor:]
+            time.sleep(0.25)
+
+
+class JobStore:
+    """Job ed eventi in SQLite (shared_state), letti dai processi web che non eseguono il job."""
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY, owner TEXT, documents TEXT, created REAL, updated REAL);
+    CREATE TABLE IF NOT EXISTS events (
+        job_id TEXT, seq INTEGER, event TEXT, PRIMARY KEY (job_id, seq));
+    """
+
+    def __init__(self):
+        self._db = SharedDB("firme-jobs", self._SCHEMA)
+
+    def create(self, job: Job, documents: list[dict]):
+        self._db.connect().execute(
+            "INSERT INTO jobs (id, owner, documents, created, updated) VALUES (?, ?, ?, ?, ?)",
+            (job.id, job.owner, json.dumps(documents, ensure_ascii=False), job.created, job.created))
+
+    def append(self, job: Job, seq: int, event: dict):
+        conn = self._db.connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("INSERT INTO events (job_id, seq, event) VALUES (?, ?, ?)",
+                         (job.id, seq, json.dumps(event, ensure_ascii=False)))
+            conn.execute("UPDATE jobs SET updated = ? WHERE id = ?", (job.updated, job.id))
+
+    def load(self, job_id: str) -> StoredJob | None:
+        row = self._db.connect().execute(
+            "SELECT owner, documents, created FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = StoredJob(self, job_id, row[0], json.loads(row[1]), row[2])
+        job.refresh()
+        return job
+
+    def events(self, job_id: str, since: int) -> list[dict]:
+        rows = self._db.connect().execute(
+            "SELECT event FROM events WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, since))
+        return [json.loads(r[0]) for r in rows]
+
+    def sweep(self, limit: float):
+        """Elimina i job senza eventi da prima di `limit` (conclusi, o il cui processo è terminato)."""
+        conn = self._db.connect()
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM events WHERE job_id IN (SELECT id FROM jobs WHERE updated < ?)", (limit,))
+            conn.execute("DELETE FROM jobs WHERE updated < ?", (limit,))
+
+
+class JobManager:
+    """Registro dei job + pool di esecuzione in background."""
+
+    def __init__(self, workers: int = FIRME_JOB_WORKERS, ttl: int = FIRME_JOB_TTL,
+                 store: JobStore | None = None):
+        self.ttl = ttl
+        self._store = store
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="firme-job")
+
+    def submit(self, owner: str, documents: list[dict], fn) -> Job:
+        """
+        Crea un job di `owner` e pianifica fn(job) nel pool. fn deve chiamare
+        job.start_document / add_page; start/finish sono gestiti qui.
+        """
+        if not owner:
+            raise ValueError("Job senza proprietario")
+        self._sweep()
+        job = Job(owner, documents, store=self._store)
+        with self._lock:
+            self._jobs[job.id] = job
+
+        def _run():
+            job.start()
+            try:
+                fn(job)
+                job.finish()
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                job.finish(error=str(e))
+
+        self._pool.submit(_run)
+        return job
+
+    def get(self, job_id: str, owner: str) -> Job | None:
+        """Il job `job_id` se appartiene a `owner`; None se non esiste o è di un altro."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self._store is not None:
+            job = self._store.load(job_id)
+        if job is None or not owner or job.owner != owner:
+            return None
+        return job
+
+    def _sweep(self):
+        """Dimentica i job conclusi da più di ttl secondi."""
+        limit = time.time() - self.ttl
+        with self._lock:
+            for job_id in [j.id for j in self._jobs.values() if j.finished and j.updated < limit]:
+                del self._jobs[job_id]
+        if self._store is not None:
+            self._store.sweep(limit)
+
+
+jobs = JobManager(store=JobStore() if MULTI_PROCESS else None)
@@ -0,0 +1,469 @@
+# firme_model.py
+"""
+Modello YOLO per il rilevamento firme: caricamento e conversione dei risultati
+in box normalizzate {x, y, w, h, score}.
+
+Usato sia dal processo web (modalità inline) sia dal worker di inferenza
+(firme_worker.py). Nessuna dipendenza pesante a livello di modulo.
+
+Backend di inferenza (solo CPU), scelto con FIRME_BACKEND:
+  torch          checkpoint .pt di PyTorch (default)
+  onnx           export ONNX, eseguito con ONNX Runtime
+  onnx-int8      export ONNX con pesi quantizzati INT8 (quantizzazione dinamica,
+                 nessun dato di calibrazione)
+  openvino       export OpenVINO IR (FP32)
+  openvino-int8  export OpenVINO quantizzato INT8 con NNCF; serve un dataset di
+                 calibrazione (FIRME_INT8_DATA, yaml in formato ultralytics)
+Gli export vengono fatti una volta sola (con shape dinamiche, per i ritagli
+di firme_anchors e la passata coarse) e restano in cache in
+FIRME_MODEL_CACHE/<checkpoint>-<sha>/; le dipendenze (onnx, onnxruntime,
+openvino, nncf) servono solo per il backend scelto. Le box restano identiche
+nel formato: l'API predict di ultralytics è la stessa per tutti i backend.
+Confronto di latenza, throughput e accordo delle box: bench_backend.py.
+
+ENV:
+  FIRME_IMGSZ          (default: 640)    lato dell'immagine in ingresso al modello
+  FIRME_CONF           (default: 0.25)   confidenza minima
+  FIRME_PREDICT_BATCH  (default: 8)      immagini per chiamata predict
+  FIRME_DETECT_MODE    (default: single) single | coarse (vedi predict_coarse_to_fine)
+  FIRME_BACKEND        (default: torch)  torch | onnx | onnx-int8 | openvino | openvino-int8
+  FIRME_MODEL_CACHE    (default: models_firme accanto al codice) cartella degli export
+  FIRME_INT8_DATA      (default: vuoto)  yaml di calibrazione per openvino-int8
+  FIRME_INTRA_THREADS  (default: 0)      thread intra-op del backend; 0 = default del backend
+  FIRME_INTER_THREADS  (default: 0)      thread inter-op (torch) / stream (OpenVINO); 0 = default
+                                         (nel worker di inferenza vale FIRME_TORCH_THREADS e 1)
+"""
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+MODEL_FIRME_REPO = "tech4humans/yolov8s-signature-detector"
+MODEL_FIRME_FILENAME = "yolov8s.pt"
+
+# parametri di inferenza (override da .env)
+FIRME_IMGSZ = int(os.environ.get("FIRME_IMGSZ", "640"))
+FIRME_CONF = float(os.environ.get("FIRME_CONF", "0.25"))
+FIRME_PREDICT_BATCH = int(os.environ.get("FIRME_PREDICT_BATCH", "8"))
+
+# rilevamento a due passate (coarse-to-fine): "single" = una predict per pagina a
+# FIRME_IMGSZ; "coarse" = passata a bassa risoluzione sull'intera pagina, poi
+# predict solo su ritagli ad alta risoluzione attorno ai candidati
+FIRME_DETECT_MODE = os.environ.get("FIRME_DETECT_MODE", "single").strip().lower()
+FIRME_COARSE_IMGSZ = int(os.environ.get("FIRME_COARSE_IMGSZ", "320"))
+FIRME_COARSE_CONF = float(os.environ.get("FIRME_COARSE_CONF", "0.10"))
+FIRME_REFINE_IMGSZ = int(os.environ.get("FIRME_REFINE_IMGSZ", "640"))
+FIRME_REFINE_MARGIN = float(os.environ.get("FIRME_REFINE_MARGIN", "0.5"))
+DETECT_MODES = ("single", "coarse")
+
+# backend di inferenza su CPU
+FIRME_BACKEND = os.environ.get("FIRME_BACKEND", "torch").strip().lower()
+FIRME_MODEL_CACHE = os.environ.get("FIRME_MODEL_CACHE", os.path.join(DIR, "models_firme"))
+FIRME_INT8_DATA = os.environ.get("FIRME_INT8_DATA", "")
+FIRME_INTRA_THREADS = int(os.environ.get("FIRME_INTRA_THREADS", "0"))
+FIRME_INTER_THREADS = int(os.environ.get("FIRME_INTER_THREADS", "0"))
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino", "openvino-int8")
+
+# nome dell'export in cache per backend
+_ARTIFACTS = {
+    "onnx": "model.onnx",
+    "onnx-int8": "model.int8.onnx",
+    "openvino": "openvino_model",
+    "openvino-int8": "openvino_int8_model",
+}
+
+_yolo_firme = None
+_yolo_lock = threading.Lock()
+_threads = {"intra": FIRME_INTRA_THREADS, "inter": FIRME_INTER_THREADS}
+
+
+def set_threads(intra: int, inter: int) -> None:
+    """Thread del backend per i modelli caricati da qui in avanti (0 = default del backend)."""
+    _threads.update(intra=intra, inter=inter)
+
+
+def _checkpoint_path() -> str:
+    """Login a Hugging Face e download (in cache) del checkpoint .pt."""
+    # Token Hugging Face (meglio in .env: HUGGINGFACE_TOKEN=hf_...)
+    token = os.environ.get("HUGGINGFACE_TOKEN")
+    if not token:
+        raise RuntimeError("Imposta HUGGINGFACE_TOKEN nel file .env con il tuo token Hugging Face")
+
+    from huggingface_hub import login, hf_hub_download
+
+    login(token)
+    return hf_hub_download(
+        repo_id=MODEL_FIRME_REPO,
+        filename=MODEL_FIRME_FILENAME
+    )
+
+
+def _file_sha(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def export_backend(pt_path: str, backend: str) -> str:
+    """
+    Percorso dell'export del checkpoint per `backend`, creato al primo uso.
+
+    L'export avviene in una cartella temporanea (ultralytics scrive accanto al
+    .pt) e viene spostato in cache con os.replace: più worker che partono
+    insieme non si pestano i piedi, al peggio esportano due volte.
+    """
+    stem = os.path.splitext(os.path.basename(pt_path))[0]
+    cache_dir = os.path.join(FIRME_MODEL_CACHE, f"{stem}-{_file_sha(pt_path)[:12]}")
+    final = os.path.join(cache_dir, _ARTIFACTS[backend])
+    if os.path.exists(final):
+        return final
+    if backend == "openvino-int8" and not FIRME_INT8_DATA:
+        raise RuntimeError("FIRME_BACKEND=openvino-int8 richiede FIRME_INT8_DATA "
+                           "(yaml del dataset di calibrazione con pagine firmate)")
+
+    from ultralytics import YOLO
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=".export-", dir=cache_dir)
+    print(f"[FIRME] Export del modello per il backend {backend} (una tantum)...", flush=True)
+    try:
+        src = os.path.join(tmp, os.path.basename(pt_path))
+        shutil.copyfile(pt_path, src)
+        if backend.startswith("onnx"):
+            out = YOLO(src).export(format="onnx", dynamic=True, simplify=True, imgsz=FIRME_IMGSZ)
+            if backend == "onnx-int8":
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+
+                q = os.path.join(tmp, _ARTIFACTS[backend])
+                quantize_dynamic(out, q, weight_type=QuantType.QUInt8)
+                out = q
+        else:
+            kw = {"int8": True, "data": FIRME_INT8_DATA} if backend == "openvino-int8" else {}
+            out = YOLO(src).export(format="openvino", dynamic=True, imgsz=FIRME_IMGSZ, **kw)
+        try:
+            os.replace(out, final)
+        except OSError:
+            # un altro processo ha finito prima (cartella già presente)
+            if not os.path.exists(final):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    print(f"[FIRME] Export {backend} salvato in {final}", flush=True)
+    return final
+
+
+def _apply_threads(model, backend: str, path: str) -> None:
+    """
+    Applica _threads al backend. ultralytics crea la sessione ONNX Runtime /
+    il modello OpenVINO compilato alla prima predict, senza opzioni di thread:
+    dopo una predict di riscaldamento vengono ricreati con le opzioni giuste.
+    """
+    intra, inter = _threads["intra"], _threads["inter"]
+    if backend == "torch":
+        import torch
+        if intra > 0:
+            torch.set_num_threads(intra)
+        if inter > 0:
+            try:
+                torch.set_num_interop_threads(inter)
+            except RuntimeError:
+                pass  # già fissato (si può fare una volta sola per processo)
+        return
+    if intra <= 0 and inter <= 0:
+        return
+
+    import numpy as np
+
+    model.predict(source=[np.zeros((64, 64, 3), dtype=np.uint8)], imgsz=64, save=False, verbose=False)
+    backend_model = getattr(getattr(model, "predictor", None), "model", None)
+    try:
+        if backend.startswith("onnx"):
+            import onnxruntime as ort
+
+            opts = ort.SessionOptions()
+            if intra > 0:
+                opts.intra_op_num_threads = intra
+            if inter > 0:
+                opts.inter_op_num_threads = inter
+            backend_model.session = ort.InferenceSession(path, opts, providers=["CPUExecutionProvider"])
+        else:
+            import openvino as ov
+
+            config = {"PERFORMANCE_HINT": "LATENCY"}
+            if intra > 0:
+                config["INFERENCE_NUM_THREADS"] = intra
+            if inter > 0:
+                config["NUM_STREAMS"] = inter
+            core = ov.Core()
+            xml = next(f for f in sorted(os.listdir(path)) if f.endswith(".xml"))
+            backend_model.ov_compiled_model = core.compile_model(
+                core.read_model(os.path.join(path, xml)), "CPU", config
+            )
+    except (AttributeError, ImportError) as e:
+        print(f"[FIRME][WARN] Thread del backend {backend} non impostabili ({e}): "
+              f"uso il default del backend", flush=True)
+
+
+def load_yolo_firme(backend: str | None = None):
+    """Download del checkpoint, export per il backend (se serve, in cache) e caricamento YOLO."""
+    backend = (backend or FIRME_BACKEND).strip().lower()
+    if backend not in BACKENDS:
+        raise RuntimeError(f"FIRME_BACKEND non valido: {backend!r} (attesi: {', '.join(BACKENDS)})")
+
+    from ultralytics import YOLO
+
+    print(f"[FIRME] Login a Hugging Face e caricamento modello YOLO (backend {backend})...", flush=True)
+    pt_path = _checkpoint_path()
+    path = pt_path if backend == "torch" else export_backend(pt_path, backend)
+    model = YOLO(path, task="detect")
+    _apply_threads(model, backend, path)
+    print("[FIRME] Modello YOLO firme caricato.", flush=True)
+    return model
+
+
+def get_yolo_firme():
+    """Modello YOLO del processo corrente, caricato al primo utilizzo (thread-safe)."""
+    global _yolo_firme
+    if _yolo_firme is not None:
+        return _yolo_firme
+    with _yolo_lock:
+        if _yolo_firme is None:
+            _yolo_firme = load_yolo_firme()
+        return _yolo_firme
+
+
+def boxes_from_arrays(xyxyn, conf) -> list[dict]:
+    """
+    Da array numpy (N,4) di coordinate normalizzate x1,y1,x2,y2 e (N,) confidenze
+    a box NORMALIZZATE:
+    [
+      {"x": x_norm, "y": y_norm, "w": w_norm, "h": h_norm, "score": conf},
+      ...
+    ]
+    dove x,y sono top-left, w,h dimensioni, tutto in [0,1].
+    """
+    import numpy as np
+
+    if len(xyxyn) == 0:
+        return []
+    xyxyn = np.asarray(xyxyn, dtype=np.float64).reshape(-1, 4)
+
+    # clamp per sicurezza (tutto vettoriale, niente float() box per box)
+    xy = np.clip(xyxyn[:, :2], 0.0, 1.0)
+    wh = np.clip(xyxyn[:, 2:] - xyxyn[:, :2], 0.0, None)
+    wh = np.minimum(wh, 1.0 - xy)
+
+    rows = np.column_stack([xy, wh, np.asarray(conf, dtype=np.float64).reshape(-1)]).tolist()
+    return [dict(zip(("x", "y", "w", "h", "score"), r)) for r in rows]
+
+
+def boxes_from_result(result) -> list[dict]:
+    """Box normalizzate lette direttamente dai tensori del risultato YOLO (xyxyn, conf)."""
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return []
+    return boxes_from_arrays(boxes.xyxyn.cpu().numpy(), boxes.conf.cpu().numpy())
+
+
+def _predict_batched(model, images: list, imgsz: int, conf: float, batch: int) -> list[list[dict]]:
+    """Chiamate predict a gruppi di `batch` immagini, box normalizzate sull'immagine passata."""
+    out: list[list[dict]] = []
+    for start in range(0, len(images), batch):
+        chunk = list(images[start:start + batch])
+        results = model.predict(source=chunk, imgsz=imgsz, conf=conf,
+                                batch=len(chunk), save=False, verbose=False)
+        out.extend(boxes_from_result(res) for res in results)
+    return out
+
+
+def merge_rects(rects: list[list[float]]) -> list[list[float]]:
+    """Unisce i rettangoli (x0, y0, x1, y1) che si sovrappongono: un ritaglio per zona."""
+    merged: list[list[float]] = []
+    for r in sorted(rects):
+        for m in merged:
+            if r[0] < m[2] and m[0] < r[2] and r[1] < m[3] and m[1] < r[3]:
+                m[0], m[1] = min(m[0], r[0]), min(m[1], r[1])
+                m[2], m[3] = max(m[2], r[2]), max(m[3], r[3])
+                break
+        else:
+            merged.append(list(r))
+    # un'unione può far toccare due zone prima separate
+    return merged if len(merged) == len(rects) else merge_rects(merged)
+
+
+def _nms(xyxy, scores, iou: float = 0.5) -> list[int]:
+    """Indici delle box tenute dopo non-maximum suppression (numpy, poche box per pagina)."""
+    import numpy as np
+
+    order = np.argsort(-scores)
+    area = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    keep: list[int] = []
+    while order.size:
+        i = int(order[0])
+        keep.append(i)
+        rest = order[1:]
+        ix = np.clip(np.minimum(xyxy[i, 2], xyxy[rest, 2]) - np.maximum(xyxy[i, 0], xyxy[rest, 0]), 0, None)
+        iy = np.clip(np.minimum(xyxy[i, 3], xyxy[rest, 3]) - np.maximum(xyxy[i, 1], xyxy[rest, 1]), 0, None)
+        inter = ix * iy
+        union = area[i] + area[rest] - inter
+        order = rest[inter <= iou * np.maximum(union, 1e-12)]
+    return keep
+
+
+def _page_rows(rect, boxes: list[dict]) -> list[list[float]]:
+    """
+    Box normalizzate su un ritaglio -> righe [x0, y0, x1, y1, score] normalizzate
+    sulla pagina; `rect` è il ritaglio (x0, y0, x1, y1) normalizzato, None = pagina intera.
+    """
+    cx0, cy0, cx1, cy1 = rect or (0.0, 0.0, 1.0, 1.0)
+    cw, ch = cx1 - cx0, cy1 - cy0
+    return [[cx0 + b["x"] * cw, cy0 + b["y"] * ch,
+             cx0 + (b["x"] + b["w"]) * cw, cy0 + (b["y"] + b["h"]) * ch, b["score"]] for b in boxes]
+
+
+def _rows_to_boxes(rows: list[list[float]]) -> list[dict]:
+    """Righe [x0, y0, x1, y1, score] di una pagina -> box normalizzate, doppioni rimossi (NMS)."""
+    import numpy as np
+
+    if not rows:
+        return []
+    arr = np.asarray(rows, dtype=np.float64)
+    keep = _nms(arr[:, :4], arr[:, 4])
+    return boxes_from_arrays(arr[keep, :4], arr[keep, 4])
+
+
+def merge_part_boxes(parts: list[tuple]) -> list[dict]:
+    """
+    Box di una pagina rilevata a pezzi (ritagli, vedi firme_anchors): lista di
+    (rect normalizzato o None, box del pezzo) -> box normalizzate sulla pagina.
+    """
+    if len(parts) == 1 and parts[0][0] is None:
+        return parts[0][1]  # pagina intera: box già normalizzate sulla pagina
+    rows: list[list[float]] = []
+    for rect, boxes in parts:
+        rows.extend(_page_rows(rect, boxes))
+    return _rows_to_boxes(rows)
+
+
+def roi_imgsz(crop_shape: tuple, page_shape: tuple, imgsz: int | None = None) -> int:
+    """
+    imgsz per un ritaglio, alla stessa scala della pagina intera a FIRME_IMGSZ:
+    YOLO ridimensiona sul lato lungo, quindi un ritaglio piccolo costa meno.
+    Multiplo di 32 (stride del modello), minimo 64.
+    """
+    imgsz = imgsz or FIRME_IMGSZ
+    ratio = max(crop_shape[:2]) / max(1, max(page_shape[:2]))
+    size = -(-int(imgsz * ratio) // 32) * 32
+    return max(64, min(imgsz, size))
+
+
+def predict_coarse_to_fine(model, images: list, conf: float | None = None,
+                           batch: int | None = None) -> list[list[dict]]:
+    """
+    Rilevamento a due passate, stesso formato di uscita di predict_signatures.
+
+    1. pagina intera a FIRME_COARSE_IMGSZ con soglia bassa (FIRME_COARSE_CONF),
+       solo per trovare le zone candidate;
+    2. attorno a ogni candidato (allargato di FIRME_REFINE_MARGIN volte la sua
+       dimensione, candidati vicini uniti in un solo ritaglio) il ritaglio della
+       pagina a piena risoluzione va al modello a FIRME_REFINE_IMGSZ con la
+       soglia normale, per i bordi precisi delle box.
+
+    Le box dei ritagli sono riportate in coordinate normalizzate della pagina.
+    Se un ritaglio non conferma nulla resta la box della prima passata, purché
+    superi comunque la soglia normale.
+    """
+    import numpy as np
+
+    if not images:
+        return []
+    conf = FIRME_CONF if conf is None else conf
+    batch = max(1, batch or FIRME_PREDICT_BATCH)
+
+    coarse = _predict_batched(model, images, FIRME_COARSE_IMGSZ, min(conf, FIRME_COARSE_CONF), batch)
+
+    crops: list = []
+    owners: list[tuple[int, list[float]]] = []  # (pagina, ritaglio normalizzato)
+    for i, (img, cands) in enumerate(zip(images, coarse)):
+        h, w = img.shape[:2]
+        rects = []
+        for b in cands:
+            mx, my = b["w"] * FIRME_REFINE_MARGIN, b["h"] * FIRME_REFINE_MARGIN
+            rects.append([max(0.0, b["x"] - mx), max(0.0, b["y"] - my),
+                          min(1.0, b["x"] + b["w"] + mx), min(1.0, b["y"] + b["h"] + my)])
+        for r in merge_rects(rects):
+            x0, y0 = int(r[0] * w), int(r[1] * h)
+            x1, y1 = max(x0 + 1, int(np.ceil(r[2] * w))), max(y0 + 1, int(np.ceil(r[3] * h)))
+            crops.append(np.ascontiguousarray(img[y0:y1, x0:x1]))
+            owners.append((i, [x0 / w, y0 / h, x1 / w, y1 / h]))
+
+    refined = _predict_batched(model, crops, FIRME_REFINE_IMGSZ, conf, batch) if crops else []
+
+    per_page: list[list[list[float]]] = [[] for _ in images]
+    for (i, rect), found in zip(owners, refined):
+        per_page[i].extend(_page_rows(rect, found))
+    for i, cands in enumerate(coarse):
+        for b in cands:
+            if b["score"] < conf:
+                continue
+            cx, cy = b["x"] + b["w"] / 2, b["y"] + b["h"] / 2
+            # candidato confermato se il suo centro cade in una box raffinata
+            if not any(r[0] <= cx <= r[2] and r[1] <= cy <= r[3] for r in per_page[i]):
+                per_page[i].append([b["x"], b["y"], b["x"] + b["w"], b["y"] + b["h"], b["score"]])
+
+    return [_rows_to_boxes(rows) for rows in per_page]
+
+
+def _predict_mixed(model, images: list, sizes: list, conf: float | None,
+                   batch: int | None, mode: str | None) -> list[list[dict]]:
+    """predict_signatures con imgsz per immagine (pagine intere e ritagli insieme)."""
+    out: list = [None] * len(images)
+    groups: dict = {}
+    for i, size in enumerate(sizes):
+        groups.setdefault(size, []).append(i)
+    for size, idx in groups.items():
+        sub = [images[i] for i in idx]
+        if size is None:
+            found = predict_signatures(model, sub, conf=conf, batch=batch, mode=mode)
+        else:
+            found = _predict_batched(model, sub, int(size), FIRME_CONF if conf is None else conf,
+                                     max(1, batch or FIRME_PREDICT_BATCH))
+        for i, boxes in zip(idx, found):
+            out[i] = boxes
+    return out
+
+
+def predict_signatures(model, images: list, imgsz: int | list | None = None,
+                       conf: float | None = None, batch: int | None = None,
+                       mode: str | None = None) -> list[list[dict]]:
+    """
+    Rileva le firme su una lista di pagine in memoria (array numpy HxWx3 BGR),
+    con chiamate predict a batch. Restituisce, per ogni immagine e nello stesso
+    ordine, la lista di box normalizzate.
+
+    mode (default FIRME_DETECT_MODE): "single" = una passata a `imgsz`,
+    "coarse" = predict_coarse_to_fine (imgsz ignorato).
+
+    `imgsz` può essere una lista con un valore per immagine: None = pagina
+    intera (come sopra), un intero = ritaglio (roi_imgsz), sempre a passata
+    singola a quella dimensione; le immagini vengono raggruppate per dimensione.
+    """
+    if not images:
+        return []
+    if isinstance(imgsz, (list, tuple)):
+        return _predict_mixed(model, images, list(imgsz), conf, batch, mode)
+    mode = mode or FIRME_DETECT_MODE
+    if mode not in DETECT_MODES:
+        raise ValueError(f"Modalità di rilevamento non valida: {mode!r} (attese: {', '.join(DETECT_MODES)})")
+    if mode == "coarse":
+        return predict_coarse_to_fine(model, images, conf=conf, batch=batch)
+
+    imgsz = imgsz or FIRME_IMGSZ
+    conf = FIRME_CONF if conf is None else conf
+    batch = max(1, batch or FIRME_PREDICT_BATCH)
+    return _predict_batched(model, images, imgsz, conf, batch)
@@ -0,0 +1,220 @@
+# firme_phash.py
+"""
+Memoria dei rilevamenti per pagine ricorrenti (stesso modello di lettera,
+stesso verbale di commissione, stessi allegati): per una pagina quasi identica
+a una già vista, le box salvate si aggiungono a quelle del modello (with_prior).
+Il modello gira comunque su ogni pagina: la cache recupera una firma che il
+modello manca su questa copia ma aveva trovato sulla precedente, non
+sostituisce mai il rilevamento, quindi una firma nuova su un modulo già visto
+viene sempre cercata. Disattivata per default (FIRME_PHASH=0): le box
+suggerite possono venire da pagine caricate da altri utenti.
+
+Chiave di una pagina (PageRaster.layout_key, calcolata sull'array già in
+memoria, pochi ms):
+  - pHash a 64 bit della pagina ridotta a 32x32 (DCT, solo numpy);
+  - maschera dell'inchiostro su una griglia di FIRME_PHASH_GRID colonne
+    (minimo per blocco, come firme_prefilter: i tratti sottili restano).
+Il pHash trova i candidati (distanza di Hamming <= FIRME_PHASH_MAX_DIST), la
+maschera conferma: se differisce in più di FIRME_PHASH_MAX_INK_DIFF celle (in
+frazione) è un'altra pagina. Alzare le due soglie aumenta i suggerimenti e
+quindi le box da scartare in revisione (la redazione copre di più, mai di meno).
+I pHash in cache sono indicizzati per bande di bit (FIRME_PHASH_MAX_DIST + 1
+bande: due hash entro la distanza coincidono in almeno una), così la ricerca
+confronta solo i candidati e non tutta la cache.
+
+La cache è in memoria nel processo web, LRU con al massimo
+FIRME_PHASH_CACHE_SIZE pagine: riparte vuota a ogni riavvio, quindi anche a
+ogni cambio di configurazione del modello (backend, imgsz, confidenza, ...).
+Nella pipeline multi-processo la chiave viene calcolata dai processi di
+rendering e la ricerca fatta dal processo web quando arrivano le box del
+modello.
+
+ENV:
+  FIRME_PHASH               (default: 0)     1 = box delle pagine già viste aggiunte a quelle del modello
+  FIRME_PHASH_MAX_DIST      (default: 6)     distanza di Hamming massima tra pHash (su 64 bit)
+  FIRME_PHASH_MAX_INK_DIFF  (default: 0.0002) frazione massima di celle di inchiostro diverse (~5 celle)
+  FIRME_PHASH_GRID          (default: 128)   colonne della griglia della maschera di inchiostro
+  FIRME_PHASH_CACHE_SIZE    (default: 4096)  pagine in cache (LRU)
+"""
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+
+FIRME_PHASH = os.environ.get("FIRME_PHASH", "0") == "1"
+FIRME_PHASH_MAX_DIST = int(os.environ.get("FIRME_PHASH_MAX_DIST", "6"))
+FIRME_PHASH_MAX_INK_DIFF = float(os.environ.get("FIRME_PHASH_MAX_INK_DIFF", "0.0002"))
+FIRME_PHASH_GRID = int(os.environ.get("FIRME_PHASH_GRID", "128"))
+FIRME_PHASH_CACHE_SIZE = int(os.environ.get("FIRME_PHASH_CACHE_SIZE", "4096"))
+
+_DARK = 128  # come FIRME_PREFILTER_DARK di default
+_dct = None
+
+
+class LayoutKey(NamedTuple):
+    """Chiave di una pagina: pHash, forma della griglia e maschera di inchiostro (packbits)."""
+    phash: int
+    shape: tuple
+    ink: bytes
+
+
+def _dct_matrix(n: int = 32):
+    global _dct
+    if _dct is None:
+        import numpy as np
+
+        k = np.arange(n)[:, None]
+        m = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+        m[0] /= np.sqrt(2)
+        _dct = m
+    return _dct
+
+
+def layout_key(array: np.ndarray) -> LayoutKey | None:
+    """Chiave della pagina (array HxWx3 o HxW); None se la pagina è troppo piccola."""
+    import numpy as np
+
+    gray = array[:, :, 1] if array.ndim == 3 else array
+    h, w = gray.shape
+    if h < 32 or w < 32:
+        return None
+
+    # pHash: media per blocco a 32x32, DCT 2D, 8x8 basse frequenze contro la mediana
+    fy, fx = h // 32, w // 32
+    small = gray[:fy * 32, :fx * 32].reshape(32, fy, 32, fx).mean(axis=(1, 3))
+    d = _dct_matrix()
+    coeffs = (d @ small @ d.T)[:8, :8].ravel()
+    bits = coeffs > np.median(coeffs[1:])
+    phash = int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+    # maschera di inchiostro: minimo per blocco su una griglia di FIRME_PHASH_GRID colonne
+    f = max(1, w // max(1, FIRME_PHASH_GRID))
+    gh, gw = h // f, w // f
+    ink = gray[:gh * f, :gw * f].reshape(gh, f, gw, f).min(axis=(1, 3)) < _DARK
+    return LayoutKey(phash, (gh, gw), np.packbits(ink).tobytes())
+
+
+def _ink_diff(a: LayoutKey, b: LayoutKey) -> float:
+    import numpy as np
+
+    x = np.frombuffer(a.ink, dtype=np.uint8) ^ np.frombuffer(b.ink, dtype=np.uint8)
+    return int(np.unpackbits(x).sum()) / (a.shape[0] * a.shape[1])
+
+
+def same_layout(a: LayoutKey | None, b: LayoutKey | None, max_dist: int = FIRME_PHASH_MAX_DIST,
+                max_ink_diff: float = FIRME_PHASH_MAX_INK_DIFF) -> bool:
+    """True se le due pagine sono la stessa entro le soglie (vedi sopra)."""
+    if a is None or b is None or a.shape != b.shape:
+        return False
+    return (a.phash ^ b.phash).bit_count() <= max_dist and _ink_diff(a, b) <= max_ink_diff
+
+
+def with_prior(boxes: list[dict], prior: list[dict] | None) -> list[dict]:
+    """
+    Box del modello più quelle della pagina già vista (`prior`) che il modello
+    non ha trovato; dove si sovrappongono resta la box con punteggio più alto.
+    """
+    if not prior:
+        return boxes
+    from firme_model import merge_part_boxes
+
+    page = (0.0, 0.0, 1.0, 1.0)
+    return merge_part_boxes([(page, boxes), (page, prior)])
+
+
+def _bands(max_dist: int) -> list[tuple[int, int]]:
+    """(shift, mask) delle max_dist + 1 bande in cui si divide il pHash a 64 bit."""
+    n = max(1, min(64, max_dist + 1))
+    bounds = [64 * i // n for i in range(n + 1)]
+    return [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+
+
+class LayoutCache:
+    """Cache LRU thread-safe: LayoutKey -> box normalizzate della pagina."""
+
+    def __init__(self, max_size: int = FIRME_PHASH_CACHE_SIZE, max_dist: int = FIRME_PHASH_MAX_DIST,
+                 max_ink_diff: float = FIRME_PHASH_MAX_INK_DIFF):
+        self.max_size = max_size
+        self.max_dist = max_dist
+        self.max_ink_diff = max_ink_diff
+        self._entries: OrderedDict[int, tuple[LayoutKey, list[dict]]] = OrderedDict()
+        # (banda, valore dei bit della banda) -> id delle voci
+        self._bands = _bands(max_dist)
+        self._index: dict[tuple[int, int], set[int]] = {}
+        self._ids = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evicted": 0}
+
+    def lookup(self, key: LayoutKey | None) -> list[dict] | None:
+        """Box della pagina più simile entro le soglie (copia), None se nessuna."""
+        if key is None:
+            return None
+        with self._lock:
+            best, best_dist = None, self.max_dist + 1
+            candidates = set().union(*(self._index.get(b, ()) for b in self._band_keys(key.phash)))
+            for entry_id in candidates:
+                k = self._entries[entry_id][0]
+                if k.shape != key.shape:
+                    continue
+                dist = (k.phash ^ key.phash).bit_count()
+                if dist < best_dist and _ink_diff(k, key) <= self.max_ink_diff:
+                    best, best_dist = entry_id, dist
+                    if dist == 0:
+                        break
+            if best is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(best)
+            self._counters["hits"] += 1
+            return [dict(b) for b in self._entries[best][1]]
+
+    def store(self, key: LayoutKey | None, boxes: list[dict]) -> None:
+        if key is None or self.max_size <= 0:
+            return
+        with self._lock:
+            self._ids += 1
+            self._entries[self._ids] = (key, [dict(b) for b in boxes])
+            for b in self._band_keys(key.phash):
+                self._index.setdefault(b, set()).add(self._ids)
+            while len(self._entries) > self.max_size:
+                entry_id, (old, _) = self._entries.popitem(last=False)
+                for b in self._band_keys(old.phash):
+                    ids = self._index[b]
+                    ids.discard(entry_id)
+                    if not ids:
+                        del self._index[b]
+                self._counters["evicted"] += 1
+
+    def _band_keys(self, phash: int) -> list[tuple[int, int]]:
+        return [(i, (phash >> shift) & mask) for i, (shift, mask) in enumerate(self._bands)]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            looked = self._counters["hits"] + self._counters["misses"]
+            return dict(self._counters, entries=len(self._entries), max_size=self.max_size,
+                        hit_rate=round(self._counters["hits"] / looked, 3) if looked else None)
+
+
+_cache: LayoutCache | None = None
+_cache_lock = threading.Lock()
+
+
+def get_layout_cache() -> LayoutCache | None:
+    """Cache condivisa del processo web; None se FIRME_PHASH=0."""
+    global _cache
+    if not FIRME_PHASH:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = LayoutCache()
+        return _cache
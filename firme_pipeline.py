@@ -0,0 +1,230 @@
+# firme_pipeline.py
+"""
+Pipeline multi-core per PDF lunghi: rasterizzazione parallela + rilevamento.
+
+Le pagine vengono divise in blocchi (FIRME_PIPELINE_CHUNK pagine) e
+renderizzate da un pool di processi: ogni processo apre il PDF con fitz per
+conto suo, salva il PNG per la UI e scrive i pixel BGR in shared memory. Il
+processo web passa i segmenti così come sono ai worker di inferenza
+(firme_worker), quindi rendering e inferenza si sovrappongono senza copie;
+i risultati vengono restituiti in ordine di pagina.
+
+Per sfruttare tutti i core conviene dividere la macchina tra rendering e
+inferenza, es. su 16 core: FIRME_RENDER_PROCS=6, FIRME_WORKERS=5,
+FIRME_TORCH_THREADS=2.
+
+ENV:
+  FIRME_RENDER_PROCS        (default: metà dei core) processi di rendering; 1 = pipeline disattivata
+  FIRME_PIPELINE_CHUNK      (default: 4)  pagine per blocco di rendering
+  FIRME_PIPELINE_MIN_PAGES  (default: 8)  sotto questa soglia si usa il rendering in streaming
+  FIRME_PIPELINE_MAX_PAGES  (default: 32) pagine renderizzate in attesa di inferenza (memoria)
+"""
+import os
+import time
+import threading
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Iterator
+
+from firme_raster import render_page, page_count, preview_filename
+from firme_model import merge_part_boxes
+from firme_phash import get_layout_cache, with_prior, FIRME_PHASH
+from firme_worker import get_inference_client, InferenceError, FIRME_INFER_TIMEOUT
+
+FIRME_RENDER_PROCS = int(os.environ.get("FIRME_RENDER_PROCS", str(max(1, (os.cpu_count() or 2) // 2))))
+FIRME_PIPELINE_CHUNK = int(os.environ.get("FIRME_PIPELINE_CHUNK", "4"))
+FIRME_PIPELINE_MIN_PAGES = int(os.environ.get("FIRME_PIPELINE_MIN_PAGES", "8"))
+FIRME_PIPELINE_MAX_PAGES = int(os.environ.get("FIRME_PIPELINE_MAX_PAGES", "32"))
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+
+
+def get_render_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: i processi non ereditano thread/lock del server Flask
+            _pool = ProcessPoolExecutor(max_workers=FIRME_RENDER_PROCS,
+                                        mp_context=mp.get_context("spawn"))
+        return _pool
+
+
+def use_pipeline(n_pages: int) -> bool:
+    """La pipeline multi-processo conviene solo per documenti lunghi."""
+    return FIRME_RENDER_PROCS > 1 and n_pages >= FIRME_PIPELINE_MIN_PAGES
+
+
+# ========= Lato processo di rendering =========
+def _render_chunk(pdf_path: str, start: int, stop: int, dpi: int, doc_dir: str) -> tuple[list[dict], float]:
+    """
+    Renderizza le pagine [start, stop): PNG e anteprima su disco per la UI e pixel BGR in
+    shared memory per l'inferenza, un segmento per ogni pezzo di PageRaster.detect_parts
+    (pagina intera o ritagli attorno alle ancore; nessuno se scartata dal pre-filtro),
+    più la chiave di firme_phash.
+    Restituisce i riferimenti ai segmenti (che poi vengono rimossi dal
+    processo web) e i secondi impiegati.
+    """
+    import fitz  # PyMuPDF
+    import numpy as np
+
+    t0 = time.perf_counter()
+    out = []
+    with fitz.open(pdf_path) as doc:
+        for i in range(start, stop):
+            page = render_page(doc[i], i, dpi)
+            page.save_png(os.path.join(doc_dir, f"page_{i}.png"))
+            page.save_preview(os.path.join(doc_dir, preview_filename(i)))
+            parts = page.detect_parts()
+            info = {
+                "index": i,
+                "parts": [],  # vuota = scartata dal pre-filtro, niente inferenza
+                "width": page.width,
+                "height": page.height,
+                # chiave per la cache delle pagine ricorrenti, cercata dal processo web
+                "layout": page.layout_key() if parts and FIRME_PHASH else None,
+            }
+            for img, rect, imgsz in parts:
+                shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+                np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[...] = img
+                info["parts"].append({"shm": shm.name, "shape": img.shape, "rect": rect, "imgsz": imgsz})
+                shm.close()
+            out.append(info)
+    return out, time.perf_counter() - t0
+
+
+# ========= Lato processo web =========
+def _unlink(parts: list[dict]):
+    for part in parts:
+        try:
+            shm = shared_memory.SharedMemory(name=part["shm"])
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def _detect_inline(part: dict) -> Future:
+    """FIRME_WORKERS=0: inferenza nel processo corrente, direttamente dalla shared memory."""
+    import numpy as np
+    from firme_model import get_yolo_firme, predict_signatures
+
+    fut: Future = Future()
+    shm = shared_memory.SharedMemory(name=part["shm"])
+    try:
+        img = np.ndarray(part["shape"], dtype=np.uint8, buffer=shm.buf)
+        fut.set_result(predict_signatures(get_yolo_firme(), [img], imgsz=[part["imgsz"]])[0])
+        del img
+    except Exception as e:
+        fut.set_exception(InferenceError(str(e)))
+    finally:
+        shm.close()
+        shm.unlink()
+    return fut
+
+
+def iter_pipeline(pdf_path: str, doc_dir: str, dpi: int = 200,
+                  n_pages: int | None = None, stats: dict | None = None) -> Iterator[tuple[int, int, int, list[dict], bool]]:
+    """
+    Genera (index, width, height, auto_boxes, skipped) in ordine di pagina;
+    skipped=True se la pagina è stata scartata dal pre-filtro senza inferenza.
+
+    Al massimo FIRME_PIPELINE_MAX_PAGES pagine renderizzate restano in attesa di
+    inferenza, così la memoria resta limitata anche se il rendering è più veloce
+    del modello. Se `stats` è un dict, alla fine contiene pagine, secondi,
+    pagine/s e tempo di rendering cumulato dei processi.
+    """
+    n = page_count(pdf_path) if n_pages is None else n_pages
+    chunk = max(1, FIRME_PIPELINE_CHUNK)
+    chunks = deque((s, min(s + chunk, n)) for s in range(0, n, chunk))
+
+    pool = get_render_pool()
+    client = get_inference_client()
+    cache = get_layout_cache()
+
+    render_q: deque = deque()  # future di rendering, in ordine di pagina
+    infer_q: deque = deque()   # (page, future box dei pezzi), in ordine di pagina
+    rendering = 0              # pagine nei blocchi in render_q
+    render_s = 0.0
+    done = 0
+    skipped = 0
+    prior_hits = 0
+    t0 = time.perf_counter()
+
+    try:
+        while chunks or render_q or infer_q:
+            # riempi la finestra di rendering senza superare il tetto di pagine in memoria
+            while chunks and (rendering + len(infer_q) + chunk) <= max(chunk, FIRME_PIPELINE_MAX_PAGES):
+                s, e = chunks.popleft()
+                render_q.append((e - s, pool.submit(_render_chunk, pdf_path, s, e, dpi, doc_dir)))
+                rendering += e - s
+
+            # blocco renderizzato (in ordine) -> inferenza; si attende solo se non c'è altro da restituire
+            if render_q and (render_q[0][1].done() or not infer_q):
+                count, fut = render_q.popleft()
+                rendering -= count
+                pages, secs = fut.result()
+                render_s += secs
+                for i, page in enumerate(pages):
+                    futures = []
+                    try:
+                        for j, part in enumerate(page["parts"]):
+                            if client is not None:
+                                futures.append(client.submit_shm(part["shm"], part["shape"], imgsz=part["imgsz"]))
+                            else:
+                                futures.append(_detect_inline(part))
+                    except Exception:
+                        _unlink(page["parts"][j + 1:])
+                        for rest in pages[i + 1:]:
+                            _unlink(rest["parts"])
+                        raise
+                    infer_q.append((page, futures))
+                continue
+
+            # resta in infer_q finché le box non sono pronte: su timeout/errore il finally la cancella
+            page, futures = infer_q[0]
+            boxes = merge_part_boxes([(part["rect"], f.result(timeout=FIRME_INFER_TIMEOUT))
+                                      for part, f in zip(page["parts"], futures)])
+            page_skipped = not page["parts"]
+            if cache is not None and page["layout"]:
+                # pagina già vista: le sue box si aggiungono, il modello ha girato comunque
+                prior = cache.lookup(page["layout"])
+                cache.store(page["layout"], boxes)
+                boxes = with_prior(boxes, prior)
+                prior_hits += prior is not None
+            infer_q.popleft()
+            done += 1
+            skipped += page_skipped
+            yield page["index"], page["width"], page["height"], boxes, page_skipped
+    finally:
+        # interruzione (errore o consumatore che smette): nessun segmento orfano
+        for _, fut in render_q:
+            if fut.cancel():
+                continue
+            try:
+                pages, _ = fut.result()
+            except Exception:
+                continue
+            for page in pages:
+                _unlink(page["parts"])
+        # pagine già in coda al worker: segmenti e posti in coda tornano liberi subito
+        if client is not None:
+            for _, futures in infer_q:
+                client.cancel(futures)
+
+        elapsed = time.perf_counter() - t0
+        if stats is not None:
+            stats.update({
+                "pages": done,
+                "skipped": skipped,
+                "prior_hits": prior_hits,
+                "seconds": round(elapsed, 3),
+                "pages_per_sec": round(done / elapsed, 2) if elapsed > 0 else None,
+                "render_cpu_s": round(render_s, 3),
+                "render_procs": FIRME_RENDER_PROCS,
+            })
+        if done:
+            print(f"[FIRME] Pipeline: {done}/{n} pagine in {elapsed:.1f}s "
+                  f"({done / elapsed:.2f} pagine/s, {FIRME_RENDER_PROCS} processi di rendering)", flush=True)
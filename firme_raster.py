@@ -0,0 +1,244 @@
+# firme_raster.py
+"""
+Rasterizzazione PDF -> pagine, una alla volta.
+
+iter_pdf_pages() è un generatore: ogni pagina viene restituita come array numpy
+che punta direttamente al buffer del pixmap PyMuPDF (nessuna copia, nessuna
+immagine PIL). Un thread di rendering lavora al massimo `lookahead` pagine in
+anticipo, quindi la memoria resta costante qualunque sia il numero di pagine e
+il rilevamento della pagina 1 parte mentre la pagina 2 viene renderizzata.
+
+Per la UI di revisione, oltre al PNG a piena risoluzione (usato dalla
+redazione raster), ogni pagina ha un'anteprima leggera (WebP/JPEG larga
+FIRME_PREVIEW_WIDTH px) generata dallo stesso array già in memoria; le altre
+larghezze (zoom) vengono create su richiesta dal PNG e restano in cache su disco.
+
+ENV:
+  FIRME_RENDER_LOOKAHEAD (default: 2)    pagine renderizzate in anticipo; 0 = sincrono
+  FIRME_PREVIEW_WIDTH    (default: 800)  larghezza in px dell'anteprima (= larghezza in UI)
+  FIRME_PREVIEW_FORMAT   (default: webp) webp | jpeg
+  FIRME_PREVIEW_QUALITY  (default: 70)   qualità di compressione delle anteprime
+"""
+from __future__ import annotations
+
+import os
+import queue
+import threading
+from typing import Iterator, NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+FIRME_RENDER_LOOKAHEAD = int(os.environ.get("FIRME_RENDER_LOOKAHEAD", "2"))
+FIRME_PREVIEW_WIDTH = int(os.environ.get("FIRME_PREVIEW_WIDTH", "800"))
+FIRME_PREVIEW_FORMAT = os.environ.get("FIRME_PREVIEW_FORMAT", "webp").lower()
+FIRME_PREVIEW_QUALITY = int(os.environ.get("FIRME_PREVIEW_QUALITY", "70"))
+
+_PREVIEW_EXT = {"webp": "webp", "jpeg": "jpg", "jpg": "jpg"}
+
+
+class PageRaster(NamedTuple):
+    """
+    Pagina renderizzata: `array` è una vista HxWx3 RGB su `pixmap.samples`;
+    `words` sono i rettangoli in pixel delle parole dello strato di testo
+    (solo con il pre-filtro attivo, vedi firme_prefilter); `rois` i ritagli
+    attorno alle ancore di testo (solo con FIRME_ANCHORS, vedi firme_anchors).
+    """
+    index: int
+    array: np.ndarray
+    pixmap: object  # fitz.Pixmap: va tenuto vivo finché si usa `array`
+    words: list | None = None
+    rois: list | None = None
+
+    @property
+    def width(self) -> int:
+        return self.array.shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.array.shape[0]
+
+    @property
+    def bgr(self) -> np.ndarray:
+        """Vista BGR (convenzione OpenCV/YOLO), senza copia."""
+        return self.array[:, :, ::-1]
+
+    def to_pil(self) -> Image.Image:
+        """Copia PIL, solo dove serve davvero un oggetto Image."""
+        from PIL import Image
+        return Image.fromarray(self.array, "RGB")
+
+    def should_detect(self) -> bool:
+        """False se il pre-filtro esclude che la pagina contenga una firma."""
+        from firme_prefilter import should_detect
+        return should_detect(self.array, self.words)
+
+    def detect_parts(self) -> list[tuple]:
+        """
+        Cosa mandare al modello: lista di (immagine BGR, rect normalizzato o None,
+        imgsz o None). Vuota se il pre-filtro scarta la pagina, la pagina intera se
+        non ci sono ancore, altrimenti un ritaglio per regione di interesse.
+        Le box si ricompongono con firme_model.merge_part_boxes.
+        """
+        from firme_model import roi_imgsz
+
+        if not self.should_detect():
+            return []
+        if not self.rois:
+            return [(self.bgr, None, None)]
+        bgr, h, w = self.bgr, self.height, self.width
+        parts = []
+        for x0, y0, x1, y1 in self.rois:
+            crop = bgr[y0:y1, x0:x1]
+            parts.append((crop, (x0 / w, y0 / h, x1 / w, y1 / h), roi_imgsz(crop.shape, bgr.shape)))
+        return parts
+
+    def layout_key(self):
+        """Chiave per la cache dei rilevamenti delle pagine ricorrenti (firme_phash)."""
+        from firme_phash import layout_key
+        return layout_key(self.array)
+
+    def save_png(self, path: str) -> None:
+        """Salva il PNG con l'encoder di MuPDF (nessun passaggio da PIL)."""
+        self.pixmap.save(path)
+
+    def save_preview(self, path: str, width: int | None = None) -> None:
+        """Salva l'anteprima ridotta della pagina (vedi save_preview_image)."""
+        save_preview_image(self.to_pil(), path, width)
+
+
+# ========= Anteprime =========
+def preview_filename(index: int, width: int | None = None) -> str:
+    """Nome del file di anteprima di una pagina a una certa larghezza."""
+    ext = _PREVIEW_EXT.get(FIRME_PREVIEW_FORMAT, "webp")
+    return f"page_{index}.w{width or FIRME_PREVIEW_WIDTH}.{ext}"
+
+
+def save_preview_image(img: Image.Image, path: str, width: int | None = None) -> None:
+    """
+    Riduce l'immagine alla larghezza richiesta (mai ingrandita) e la salva in
+    WebP/JPEG. Scrittura atomica: un client non legge mai un file a metà.
+    """
+    from PIL import Image
+
+    width = width or FIRME_PREVIEW_WIDTH
+    if img.width > width:
+        height = max(1, round(img.height * width / img.width))
+        img = img.resize((width, height), Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+    fmt = "JPEG" if _PREVIEW_EXT.get(FIRME_PREVIEW_FORMAT) == "jpg" else "WEBP"
+    tmp = f"{path}.tmp"
+    img.save(tmp, fmt, quality=FIRME_PREVIEW_QUALITY)
+    os.replace(tmp, path)
+
+
+def ensure_preview(doc_dir: str, index: int, width: int) -> str | None:
+    """
+    Percorso dell'anteprima `width` della pagina, generata dal PNG a piena
+    risoluzione se non è già in cache. None se la pagina non esiste (ancora).
+    """
+    path = os.path.join(doc_dir, preview_filename(index, width))
+    if os.path.exists(path):
+        return path
+    png_path = os.path.join(doc_dir, f"page_{index}.png")
+    if not os.path.exists(png_path):
+        return None
+
+    from PIL import Image
+
+    with Image.open(png_path) as img:
+        save_preview_image(img.convert("RGB"), path, width)
+    return path
+
+
+def render_page(page, index: int, dpi: int = 200) -> PageRaster:
+    """Renderizza una pagina fitz in RGB senza alpha e la espone come array numpy."""
+    import fitz  # PyMuPDF
+    import numpy as np
+    from firme_prefilter import FIRME_PREFILTER, text_boxes
+    from firme_anchors import FIRME_ANCHORS, anchor_rois
+
+    zoom = dpi / 72  # 72 dpi è la base di fitz
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csRGB, alpha=False)
+    buf = pix.samples_mv if hasattr(pix, "samples_mv") else pix.samples
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    # stride = larghezza * 3 (niente padding con alpha=False)
+    arr = arr.reshape(pix.height, pix.width, pix.n)
+    raw = page.get_text("words") if (FIRME_PREFILTER or FIRME_ANCHORS) else None
+    words = text_boxes(page, zoom, raw) if FIRME_PREFILTER else None
+    rois = anchor_rois(raw, page.rotation_matrix * fitz.Matrix(zoom, zoom), arr.shape) if FIRME_ANCHORS else None
+    return PageRaster(index, arr, pix, words, rois)
+
+
+def _iter_sync(pdf_path: str, dpi: int, pages: range | None) -> Iterator[PageRaster]:
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        indexes = pages if pages is not None else range(doc.page_count)
+        for i in indexes:
+            yield render_page(doc[i], i, dpi)
+
+
+def iter_pdf_pages(pdf_path: str, dpi: int = 200, lookahead: int | None = None,
+                   pages: range | None = None) -> Iterator[PageRaster]:
+    """
+    Genera le pagine del PDF una alla volta (eventualmente solo l'intervallo `pages`).
+
+    Con lookahead > 0 il rendering avviene in un thread separato con una coda
+    limitata: al massimo `lookahead` pagine pronte in attesa del consumatore.
+    Se il consumatore si interrompe (break/eccezione) il thread si ferma.
+    """
+    lookahead = FIRME_RENDER_LOOKAHEAD if lookahead is None else lookahead
+    if lookahead <= 0:
+        yield from _iter_sync(pdf_path, dpi, pages)
+        return
+
+    q: queue.Queue = queue.Queue(maxsize=lookahead)
+    stop = threading.Event()
+    _END = object()
+
+    def _producer():
+        gen = _iter_sync(pdf_path, dpi, pages)
+        try:
+            for page in gen:
+                while not stop.is_set():
+                    try:
+                        q.put(page, timeout=0.2)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            item = _END
+        except Exception as e:  # propagata al consumatore
+            item = e
+        finally:
+            gen.close()  # chiude il documento fitz anche in caso di stop
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    t = threading.Thread(target=_producer, daemon=True, name="firme-render")
+    t.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        t.join(timeout=5)
+
+
+def page_count(pdf_path: str) -> int:
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        return doc.page_count
@@ -0,0 +1,443 @@
+# firme_redact.py
+"""
+Oscuramento firme: dai box confermati in UI al PDF oscurato.
+
+Due modalità:
+  - "raster": ogni pagina renderizzata (page_N.png) viene annerita nei box in
+    memoria e il PDF viene ricostruito da immagini con img2pdf, con una codifica
+    per pagina adatta al contenuto (1 bit CCITT G4, grigi, JPEG o PNG);
+  - "vector": redazioni vere con PyMuPDF direttamente su original.pdf, solo sulle
+    pagine con box. Testo, immagini e grafica sotto i box vengono rimossi dal
+    contenuto, il resto del documento resta invariato (testo selezionabile,
+    dimensioni simili all'originale). Il risultato viene verificato: se sotto un
+    box sopravvive qualcosa si ricade sulla modalità raster per quel documento.
+
+La conferma di più documenti lavora in parallelo nel pool di processi del
+rendering (firme_pipeline, FIRME_RENDER_PROCS) e lo ZIP viene scritto in
+streaming man mano che ogni documento è pronto (stream_zip), senza tenere in
+memoria né tutti i PDF né l'archivio completo.
+
+ENV:
+  FIRME_REDACT_MODE (default: raster) modalità usata se la richiesta non la specifica
+  FIRME_ZIP_CHUNK   (default: 1048576) byte per chunk della risposta ZIP
+
+  Codifica delle pagine in modalità raster (vedi classify_page):
+  FIRME_JPEG_QUALITY     (default: 80)   qualità JPEG per pagine fotografiche
+  FIRME_GRAY_TOLERANCE   (default: 8)    scarto massimo tra canali per considerare la pagina in grigi
+  FIRME_BILEVEL_MAX_GRAY (default: 0.05) frazione massima di mezzitoni per una pagina bianco/nero
+  FIRME_BILEVEL_MAX_COLOR (default: 0.03) frazione massima di pixel colorati (loghi, timbri) per una
+                                          pagina bianco/nero; 0 = solo pagine interamente in grigi
+  FIRME_PHOTO_MIN_FILL   (default: 0.35) frazione di mezzitoni oltre la quale la pagina è una foto
+  FIRME_PHOTO_MIN_COLORS (default: 4096) colori distinti (RGB a 15 bit) oltre i quali si usa JPEG
+"""
+import io
+import os
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Iterable, Iterator
+
+FIRME_REDACT_MODE = os.environ.get("FIRME_REDACT_MODE", "raster")
+FIRME_ZIP_CHUNK = int(os.environ.get("FIRME_ZIP_CHUNK", str(1 << 20)))
+REDACT_MODES = ("raster", "vector")
+
+FIRME_JPEG_QUALITY = int(os.environ.get("FIRME_JPEG_QUALITY", "80"))
+FIRME_GRAY_TOLERANCE = int(os.environ.get("FIRME_GRAY_TOLERANCE", "8"))
+FIRME_BILEVEL_MAX_GRAY = float(os.environ.get("FIRME_BILEVEL_MAX_GRAY", "0.05"))
+FIRME_BILEVEL_MAX_COLOR = float(os.environ.get("FIRME_BILEVEL_MAX_COLOR", "0.03"))
+FIRME_PHOTO_MIN_FILL = float(os.environ.get("FIRME_PHOTO_MIN_FILL", "0.35"))
+FIRME_PHOTO_MIN_COLORS = int(os.environ.get("FIRME_PHOTO_MIN_COLORS", "4096"))
+
+
+class RedactionError(RuntimeError):
+    """La redazione vettoriale non ha superato la verifica."""
+
+
+def pages_from_payload(doc_id: str, pages_data: list[dict]) -> dict[int, list[dict]]:
+    """{page_index: [box, ...]} dalle voci "pages" di /api/firme/confirm."""
+    pages: dict[int, list[dict]] = {}
+    for page_info in pages_data:
+        page_index = page_info.get("page_index")
+        if page_index is None:
+            print(f"[FIRME][WARN] page_index mancante per doc_id={doc_id}", flush=True)
+            continue
+        pages[int(page_index)] = page_info.get("boxes", []) or []
+    return pages
+
+
+def _box_rect(b: dict, width: float, height: float) -> tuple[float, float, float, float]:
+    """Box normalizzata -> (x1, y1, x2, y2) nello spazio (width, height)."""
+    x_norm = float(b["x"])
+    y_norm = float(b["y"])
+    w_norm = float(b["w"])
+    h_norm = float(b["h"])
+    return (x_norm * width, y_norm * height,
+            (x_norm + w_norm) * width, (y_norm + h_norm) * height)
+
+
+# ========= Modalità raster =========
+def _load_page(doc_dir: str, page_index: int):
+    """page_N.png -> array RGB scrivibile (None se la pagina non c'è) e dpi del PNG."""
+    import numpy as np
+    from PIL import Image
+
+    image_path = os.path.join(doc_dir, f"page_{page_index}.png")
+    if not os.path.exists(image_path):
+        print(f"[FIRME][WARN] Immagine pagina non trovata: {image_path}", flush=True)
+        return None, None
+    with Image.open(image_path) as img:
+        return np.array(img.convert("RGB")), img.info.get("dpi")
+
+
+def fill_boxes(arr, boxes: list[dict]) -> None:
+    """Annerisce le box direttamente sull'array HxWx3 (slicing numpy, estremi inclusi)."""
+    height, width = arr.shape[:2]
+    for b in boxes:
+        x1, y1, x2, y2 = _box_rect(b, width, height)
+        x1, y1 = max(0, int(x1)), max(0, int(y1))
+        x2, y2 = min(width - 1, int(x2)), min(height - 1, int(y2))
+        if x2 >= x1 and y2 >= y1:
+            arr[y1:y2 + 1, x1:x2 + 1] = 0
+
+
+def classify_page(arr) -> str:
+    """
+    Sceglie la codifica della pagina oscurata guardando un campione dei pixel:
+      "bilevel"   testo/scansione in bianco e nero (eventualmente con un piccolo
+                  logo a colori)                        -> 1 bit, CCITT G4
+      "gray"      grigi senza toni continui             -> PNG in scala di grigi
+      "gray-jpeg" grigi con molti mezzitoni (foto)      -> JPEG in scala di grigi
+      "jpeg"      colore fotografico o scansione a colori -> JPEG
+      "palette"   colore con pochi colori (grafica)     -> PNG a 256 colori
+      "png"       tutto il resto                        -> PNG RGB
+    """
+    import numpy as np
+
+    sample = arr[::4, ::4].astype(np.int16)
+    colored = float((np.abs(sample - sample[:, :, :1]).max(axis=2) > FIRME_GRAY_TOLERANCE).mean())
+    luma = sample[:, :, 1]
+    mid = float(((luma > 32) & (luma < 223)).mean())
+
+    if colored <= FIRME_BILEVEL_MAX_COLOR and mid <= FIRME_BILEVEL_MAX_GRAY:
+        return "bilevel"
+    if colored <= 0.001:
+        return "gray-jpeg" if mid >= FIRME_PHOTO_MIN_FILL else "gray"
+
+    packed = (sample[:, :, 0] >> 3) << 10 | (sample[:, :, 1] >> 3) << 5 | (sample[:, :, 2] >> 3)
+    n_colors = len(np.unique(packed))
+    if mid >= FIRME_PHOTO_MIN_FILL or n_colors >= FIRME_PHOTO_MIN_COLORS:
+        return "jpeg"
+    return "palette" if n_colors <= 256 else "png"
+
+
+def encode_page(arr, kind: str, dpi=None) -> bytes:
+    """Codifica l'array nel formato scelto da classify_page, pronto per img2pdf (nessuna ricodifica)."""
+    from PIL import Image
+
+    buf = io.BytesIO()
+    extra = {"dpi": dpi} if dpi else {}
+    if kind == "bilevel":
+        Image.fromarray(arr[:, :, 1] >= 128).save(buf, "TIFF", compression="group4", **extra)
+    elif kind in ("gray", "gray-jpeg"):
+        img = Image.fromarray(arr[:, :, 1])
+        if kind == "gray-jpeg":
+            img.save(buf, "JPEG", quality=FIRME_JPEG_QUALITY, **extra)
+        else:
+            img.save(buf, "PNG", optimize=False, **extra)
+    elif kind == "jpeg":
+        Image.fromarray(arr, "RGB").save(buf, "JPEG", quality=FIRME_JPEG_QUALITY, **extra)
+    elif kind == "palette":
+        img = Image.fromarray(arr, "RGB").quantize(256, method=Image.Quantize.FASTOCTREE)
+        img.save(buf, "PNG", **extra)
+    else:
+        Image.fromarray(arr, "RGB").save(buf, "PNG", **extra)
+    return buf.getvalue()
+
+
+def redact_raster(doc_dir: str, pages: dict[int, list[dict]]) -> tuple[bytes | None, int]:
+    """
+    Annerisce i box sulle pagine page_N.png, in memoria, e ricostruisce il PDF
+    con img2pdf; ogni pagina è codificata nel formato più compatto per il suo
+    contenuto (classify_page). Restituisce (pdf_bytes, pagine) oppure (None, 0)
+    se non c'è nessuna pagina utile.
+    """
+    import img2pdf
+
+    encoded = []
+    kinds: dict[str, int] = {}
+
+    for page_index in sorted(pages):
+        arr, dpi = _load_page(doc_dir, page_index)
+        if arr is None:
+            continue
+
+        # Oscuriamo tutte le box (se presenti)
+        fill_boxes(arr, pages[page_index])
+
+        kind = classify_page(arr)
+        kinds[kind] = kinds.get(kind, 0) + 1
+        encoded.append(encode_page(arr, kind, dpi))
+        del arr
+
+    if not encoded:
+        return None, 0
+
+    print(f"[FIRME] Codifica pagine: {', '.join(f'{k}={v}' for k, v in sorted(kinds.items()))}", flush=True)
+    return img2pdf.convert(encoded), len(encoded)
+
+
+# ========= Modalità vettoriale =========
+def _page_rects(page, boxes: list[dict]) -> list:
+    """Box normalizzate -> fitz.Rect in coordinate visibili della pagina."""
+    import fitz  # PyMuPDF
+
+    w, h = page.rect.width, page.rect.height
+    rects = []
+    for b in boxes:
+        r = fitz.Rect(*_box_rect(b, w, h))
+        if not r.is_empty:
+            rects.append(r)
+    return rects
+
+
+def redact_vector(pdf_path: str, pages: dict[int, list[dict]]) -> tuple[bytes, int]:
+    """
+    Applica redazioni PyMuPDF su original.pdf, solo sulle pagine con box.
+    Testo e grafica che toccano un box vengono rimossi, i pixel delle immagini
+    sotto il box vengono azzerati; il file viene riscritto senza gli oggetti
+    non più referenziati (garbage=4), così il contenuto originale non resta
+    nemmeno come oggetto orfano. Gli oggetti piccoli (struttura dei tag,
+    annotazioni) finiscono in object stream compressi: senza, un PDF esportato
+    da Word con migliaia di oggetti esce più grande dell'originale.
+    """
+    import fitz  # PyMuPDF
+
+    with fitz.open(pdf_path) as doc:
+        for page_index, boxes in pages.items():
+            if not boxes or page_index < 0 or page_index >= doc.page_count:
+                continue
+            page = doc[page_index]
+            for r in _page_rects(page, boxes):
+                # le annotazioni usano coordinate non ruotate
+                page.add_redact_annot(r * page.derotation_matrix, fill=(0, 0, 0))
+            try:
+                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_PIXELS,
+                                      graphics=fitz.PDF_REDACT_LINE_ART_REMOVE_IF_TOUCHED)
+            except TypeError:  # PyMuPDF < 1.23: niente parametro graphics
+                page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_PIXELS)
+
+        n_pages = doc.page_count
+        try:
+            pdf_bytes = doc.tobytes(garbage=4, deflate=True, clean=True, use_objstms=1)
+        except TypeError:  # PyMuPDF < 1.24: niente object stream
+            pdf_bytes = doc.tobytes(garbage=4, deflate=True, clean=True)
+
+    problems = verify_redactions(pdf_bytes, pages)
+    if problems:
+        raise RedactionError("; ".join(problems[:5]))
+    return pdf_bytes, n_pages
+
+
+def _is_redaction_fill(drawing: dict, rects: list) -> bool:
+    """Il riempimento nero disegnato dalla redazione stessa (non è contenuto sopravvissuto)."""
+    fill = drawing.get("fill")
+    if not fill or any(c > 0.01 for c in fill):
+        return False
+    r = drawing["rect"]
+    return any(r in (box + (-1, -1, 1, 1)) for box in rects)
+
+
+def _image_region_is_blank(doc, xref: int, info: dict, r) -> bool:
+    """Verifica che i pixel dell'immagine sotto il box siano uniformi (azzerati)."""
+    import fitz  # PyMuPDF
+    import numpy as np
+
+    pix = fitz.Pixmap(doc, xref)
+    if pix.n - pix.alpha > 3:  # CMYK & co.
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+
+    # rettangolo del box -> spazio unitario dell'immagine -> pixel
+    inv = ~fitz.Matrix(info["transform"])
+    q = (r & fitz.Rect(info["bbox"])) * inv
+    x0 = max(0, int(q.x0 * pix.width) + 1)
+    x1 = min(pix.width, int(q.x1 * pix.width) - 1)
+    y0 = max(0, int(q.y0 * pix.height) + 1)
+    y1 = min(pix.height, int(q.y1 * pix.height) - 1)
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return True  # intersezione di pochi pixel: niente da verificare
+
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    region = arr[y0:y1, x0:x1, :pix.n - pix.alpha]
+    return int(region.max()) - int(region.min()) <= 8
+
+
+def verify_redactions(pdf_bytes: bytes, pages: dict[int, list[dict]]) -> list[str]:
+    """
+    Rilegge il PDF oscurato e cerca contenuto sopravvissuto dentro i box:
+    caratteri, tracciati vettoriali e pixel di immagini non azzerati.
+    Restituisce l'elenco dei problemi trovati (vuoto = ok).
+    """
+    import fitz  # PyMuPDF
+
+    problems = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_index, boxes in pages.items():
+            if not boxes or page_index < 0 or page_index >= doc.page_count:
+                continue
+            page = doc[page_index]
+            rects = _page_rects(page, boxes)
+
+            for r in rects:
+                # 1) testo
+                raw = page.get_text("rawdict", clip=r)
+                for block in raw.get("blocks", []):
+                    for line in block.get("lines", []):
+                        for span in line.get("spans", []):
+                            for ch in span.get("chars", []):
+                                cb = fitz.Rect(ch["bbox"])
+                                center = fitz.Point((cb.x0 + cb.x1) / 2, (cb.y0 + cb.y1) / 2)
+                                if center in r and ch.get("c", "").strip():
+                                    problems.append(f"pagina {page_index}: testo '{ch['c']}' sotto un box")
+                                    break
+
+                # 2) immagini
+                for info in page.get_image_info(xrefs=True):
+                    if not fitz.Rect(info["bbox"]).intersects(r):
+                        continue
+                    xref = info.get("xref", 0)
+                    if not xref:
+                        problems.append(f"pagina {page_index}: immagine inline sotto un box")
+                    elif not _image_region_is_blank(doc, xref, info, r):
+                        problems.append(f"pagina {page_index}: pixel immagine (xref {xref}) sotto un box")
+
+            # 3) grafica vettoriale (esclusi i riempimenti neri della redazione)
+            for d in page.get_drawings():
+                dr = d["rect"]
+                if any(dr.intersects(r) for r in rects) and not _is_redaction_fill(d, rects):
+                    problems.append(f"pagina {page_index}: tracciato vettoriale sotto un box")
+                    break
+    return problems
+
+
+# ========= Dispatcher =========
+def redact_document(doc_dir: str, pages: dict[int, list[dict]], mode: str = FIRME_REDACT_MODE) -> tuple[bytes | None, int, str]:
+    """
+    Produce il PDF oscurato di un documento nella modalità richiesta.
+    Restituisce (pdf_bytes, pagine, modalità effettivamente usata).
+    """
+    if mode == "vector":
+        pdf_path = os.path.join(doc_dir, "original.pdf")
+        try:
+            pdf_bytes, n = redact_vector(pdf_path, pages)
+            return pdf_bytes, n, "vector"
+        except RedactionError as e:
+            print(f"[FIRME][WARN] Verifica redazione vettoriale fallita ({doc_dir}): {e} -> uso raster", flush=True)
+        except Exception as e:
+            print(f"[FIRME][WARN] Redazione vettoriale non riuscita ({doc_dir}): {e} -> uso raster", flush=True)
+
+    pdf_bytes, n = redact_raster(doc_dir, pages)
+    return pdf_bytes, n, "raster"
+
+
+# ========= Finalizzazione parallela =========
+def finalize_document(doc_dir: str, pages: dict[int, list[dict]], mode: str) -> dict:
+    """
+    Redazione di un documento, eseguita nel pool di processi: gli errori
+    vengono restituiti invece che sollevati, così un documento rotto non
+    interrompe gli altri.
+    """
+    t0 = time.perf_counter()
+    try:
+        pdf_bytes, n, used = redact_document(doc_dir, pages, mode)
+        error = None
+    except Exception as e:
+        pdf_bytes, n, used, error = None, 0, mode, str(e)
+    return {"pdf": pdf_bytes, "pages": n, "mode": used, "error": error,
+            "seconds": round(time.perf_counter() - t0, 3)}
+
+
+def iter_finalized(tasks: list[tuple[str, str, dict]], mode: str) -> Iterator[tuple[str, dict]]:
+    """
+    tasks = [(chiave, doc_dir, pages), ...] -> genera (chiave, risultato) nell'ordine
+    in cui i documenti sono pronti. Al massimo un documento per processo più
+    uno in coda è in lavorazione o in attesa di essere consumato, quindi la
+    memoria non cresce con il numero di documenti. Se il consumatore smette
+    (es. client disconnesso) i documenti non ancora avviati vengono annullati
+    e si attende la fine di quelli in corso.
+    """
+    from firme_pipeline import get_render_pool, FIRME_RENDER_PROCS
+
+    if len(tasks) <= 1 or FIRME_RENDER_PROCS <= 1:
+        for key, doc_dir, pages in tasks:
+            yield key, finalize_document(doc_dir, pages, mode)
+        return
+
+    pool = get_render_pool()
+    todo = list(tasks)
+    window = FIRME_RENDER_PROCS + 1
+    running: dict = {}
+    try:
+        while todo or running:
+            while todo and len(running) < window:
+                key, doc_dir, pages = todo.pop(0)
+                running[pool.submit(finalize_document, doc_dir, pages, mode)] = key
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                key = running.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:  # processo del pool morto
+                    res = {"pdf": None, "pages": 0, "mode": mode, "error": str(e), "seconds": None}
+                yield key, res
+    finally:
+        for fut in running:
+            fut.cancel()
+        wait(running)
+
+
+# ========= ZIP in streaming =========
+class _ZipSink(io.RawIOBase):
+    """Destinazione non seekable per zipfile: accumula i byte scritti fino al prossimo drain()."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+
+def stream_zip(members: Iterable[tuple[str, bytes]], chunk_size: int = FIRME_ZIP_CHUNK) -> Iterator[bytes]:
+    """
+    Scrive uno ZIP (deflate) a partire da (nome, dati) e ne genera i byte a
+    chunk, man mano che i membri arrivano. zipfile su uno stream non seekable
+    usa i data descriptor, quindi nessun membro va riscritto a posteriori.
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as zipf:
+        for name, data in members:
+            zinfo = zipfile.ZipInfo(name, date_time=time.localtime(time.time())[:6])
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+            zinfo.external_attr = 0o600 << 16
+            zinfo.file_size = len(data)  # serve a zipfile per decidere se usare zip64
+            view = memoryview(data)
+            with zipf.open(zinfo, "w") as f:
+                for off in range(0, len(view), chunk_size):
+                    f.write(view[off:off + chunk_size])
+                    out = sink.drain()
+                    if out:
+                        yield out
+            out = sink.drain()
+            if out:
+                yield out
+    out = sink.drain()
+    if out:
+        yield out
@@ -0,0 +1,414 @@
+# firme_store.py
+"""
+Archivio dei documenti della redazione firme: docs_firme/<doc_id>/.
+
+Il doc_id è lo SHA-256 del PDF caricato. Ricaricare lo stesso file (es. dopo
+aver chiuso la scheda) riusa la cartella esistente: rendering delle pagine e
+rilevamenti salvati in analysis.json vengono restituiti subito, senza un nuovo
+passaggio PyMuPDF + YOLO, se l'analisi è più recente di FIRME_DEDUP_TTL.
+
+Chi sta usando un documento è registrato in refs.json: per ogni utente il
+numero di upload non ancora confermati. /api/firme/confirm rilascia un solo
+riferimento: la cartella viene cancellata quando il conteggio di tutti torna a
+zero, quindi la conferma in una scheda non toglie i file a un'altra scheda
+(dello stesso utente o di un altro) che sta rivedendo lo stesso PDF.
+
+Contenuto di una cartella:
+  original.pdf        PDF caricato
+  page_N.png          pagina a piena risoluzione (+ anteprime, vedi firme_raster)
+  analysis.json       [{index, width, height, auto_boxes, skipped}, ...] a fine analisi
+  refs.json           {utente: {"n": upload aperti, "ts": timestamp dell'ultimo}}
+
+Gestione dello spazio (sweep(), in un thread di background avviato da
+start_sweeper() e comunque a ogni upload per la quota):
+  - TTL: le cartelle non usate da più di FIRME_STORE_TTL secondi (sessioni
+    abbandonate senza conferma) vengono cancellate, riferimenti compresi;
+  - quota: se docs_firme supera FIRME_STORE_QUOTA_MB si eliminano i documenti
+    usati meno di recente (LRU), mai quelli in analisi, usati negli ultimi
+    FIRME_STORE_GRACE secondi o con riferimenti aperti (qualcuno li sta ancora
+    rivedendo: le pagine restano nella cache del browser e non toccano la
+    cartella, quindi l'mtime da solo non basta);
+  - FIRME_SCRATCH_DIR (es. /dev/shm/docs_firme) sposta l'area di lavoro su un
+    filesystem in RAM: le scritture delle pagine non toccano il disco e la
+    quota tiene limitata la memoria occupata.
+L'"ultimo uso" di un documento è l'mtime della sua cartella (touch()).
+I contatori sono esposti da stats() (/api/firme/storage) e sono per processo.
+
+Con più worker web (gunicorn) i lock sono file in docs_firme/.locks
+(shared_state.FileLock): refs.json, cancellazioni e analisi di uno stesso
+documento restano serializzate tra i processi, e la pulizia (che gira in un
+solo worker) vede anche le analisi in corso negli altri.
+
+ENV:
+  FIRME_DEDUP_TTL       (default: 86400) secondi di validità di un'analisi riutilizzabile
+  FIRME_STORE_TTL       (default: 86400) secondi dopo cui un documento non usato viene cancellato
+  FIRME_STORE_QUOTA_MB  (default: 2048)  spazio massimo di docs_firme; 0 = nessuna quota
+  FIRME_STORE_GRACE     (default: 300)   secondi in cui un documento appena usato non viene sfrattato
+  FIRME_STORE_SWEEP_S   (default: 300)   intervallo del thread di pulizia
+  FIRME_SCRATCH_DIR     (default: vuoto) area di lavoro alternativa (es. tmpfs)
+"""
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import hmac
+import hashlib
+import threading
+
+from shared_state import FileLock
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+
+FIRME_SCRATCH_DIR = os.environ.get("FIRME_SCRATCH_DIR", "")
+
+# cartella dove salvare PDF e immagini per la redazione firme
+DOCS_FIRME_ROOT = FIRME_SCRATCH_DIR or os.path.join(DIR, "docs_firme")
+INCOMING_DIR = os.path.join(DOCS_FIRME_ROOT, ".incoming")
+
+FIRME_DEDUP_TTL = int(os.environ.get("FIRME_DEDUP_TTL", "86400"))
+FIRME_STORE_TTL = int(os.environ.get("FIRME_STORE_TTL", "86400"))
+FIRME_STORE_QUOTA_MB = int(os.environ.get("FIRME_STORE_QUOTA_MB", "2048"))
+FIRME_STORE_GRACE = int(os.environ.get("FIRME_STORE_GRACE", "300"))
+FIRME_STORE_SWEEP_S = int(os.environ.get("FIRME_STORE_SWEEP_S", "300"))
+
+_DOC_ID_RE = re.compile(r"[0-9a-f]{64}")
+
+LOCKS_DIR = os.path.join(DOCS_FIRME_ROOT, ".locks")
+
+_lock = FileLock(os.path.join(LOCKS_DIR, "store.lock"), reentrant=True)  # refs.json e creazione/cancellazione cartelle
+_analysis_locks: dict[str, FileLock] = {}  # un'analisi per documento alla volta
+
+# contatori cumulativi (dall'avvio del processo)
+_counters = {
+    "uploads": 0,
+    "dedup_hits": 0,
+    "released": 0,
+    "expired": 0,
+    "evicted": 0,
+    "bytes_freed": 0,
+    "sweeps": 0,
+    "last_sweep": None,
+}
+
+
+def doc_dir(doc_id: str) -> str:
+    return os.path.join(DOCS_FIRME_ROOT, doc_id)
+
+
+def is_valid_doc_id(doc_id: str) -> bool:
+    """Solo SHA-256 esadecimali: il doc_id finisce in un percorso su disco."""
+    return bool(_DOC_ID_RE.fullmatch(doc_id or ""))
+
+
+def _write_json(path: str, data) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _read_json(path: str, default=None):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+# ========= Upload e riferimenti =========
+def save_upload(stream, holder: str) -> tuple[str, bool]:
+    """
+    Salva il PDF calcolandone lo SHA-256 durante la copia e registra `holder`
+    tra gli utilizzatori. Restituisce (doc_id, riusato) dove riusato=True se il
+    documento era già presente.
+    """
+    os.makedirs(INCOMING_DIR, exist_ok=True)
+    tmp_path = os.path.join(INCOMING_DIR, f"{uuid.uuid4().hex}.pdf")
+    h = hashlib.sha256()
+    try:
+        with open(tmp_path, "wb") as out:
+            while True:
+                chunk = stream.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+                out.write(chunk)
+        doc_id = h.hexdigest()
+
+        with _lock:
+            d = doc_dir(doc_id)
+            pdf_path = os.path.join(d, "original.pdf")
+            reused = os.path.exists(pdf_path)
+            if not reused:
+                os.makedirs(d, exist_ok=True)
+                os.replace(tmp_path, pdf_path)
+            _add_ref(doc_id, holder)
+            touch(doc_id)
+            _counters["uploads"] += 1
+            _counters["dedup_hits"] += int(reused)
+        enforce_quota()
+        return doc_id, reused
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_refs(path: str) -> dict:
+    refs = _read_json(path, {}) or {}
+    # formato precedente: {utente: timestamp}, un solo riferimento
+    return {h: r if isinstance(r, dict) else {"n": 1, "ts": r} for h, r in refs.items()}
+
+
+def _add_ref(doc_id: str, holder: str) -> None:
+    path = os.path.join(doc_dir(doc_id), "refs.json")
+    refs = _read_refs(path)
+    ref = refs.setdefault(holder, {"n": 0})
+    ref["n"] += 1
+    ref["ts"] = time.time()
+    _write_json(path, refs)
+
+
+def holder_tag(holder: str) -> str:
+    """Identificativo opaco di `holder` per gli URL firmati delle pagine (non espone l'utente)."""
+    return hashlib.sha256(holder.encode("utf-8")).hexdigest()[:16]
+
+
+def held_by(doc_id: str, tag: str) -> bool:
+    """True se l'utilizzatore con holder_tag() `tag` ha ancora un riferimento sul documento."""
+    refs = _read_refs(os.path.join(doc_dir(doc_id), "refs.json"))
+    return any(hmac.compare_digest(holder_tag(h), tag) for h in refs)
+
+
+def release(doc_id: str, holder: str) -> bool:
+    """
+    Rilascia un riferimento di `holder` (un upload); se non ne restano altri,
+    suoi o di altri utenti, cancella la cartella del documento. Senza un
+    riferimento di `holder` non fa nulla. Restituisce True se la cartella è
+    stata eliminata.
+    """
+    with _lock:
+        d = doc_dir(doc_id)
+        path = os.path.join(d, "refs.json")
+        refs = _read_refs(path)
+        ref = refs.get(holder)
+        if ref is None:
+            return False  # mai caricato da `holder`: non tocca i riferimenti altrui
+        ref["n"] -= 1
+        if ref["n"] <= 0:
+            del refs[holder]
+        if refs and os.path.isdir(d):
+            _write_json(path, refs)
+            open_refs = sum(r["n"] for r in refs.values())
+            print(f"[FIRME] Documento {doc_id[:12]} ancora in uso ({open_refs} upload di {len(refs)} utenti), "
+                  f"non eliminato", flush=True)
+            return False
+        shutil.rmtree(d, ignore_errors=True)
+        _forget(doc_id)
+        _counters["released"] += 1
+        return True
+
+
+# ========= Analisi riutilizzabile =========
+def _analysis_lock_path(doc_id: str) -> str:
+    return os.path.join(LOCKS_DIR, f"{doc_id}.lock")
+
+
+def analysis_lock(doc_id: str) -> FileLock:
+    """Lock per documento: due upload dello stesso PDF non lo analizzano due volte in parallelo."""
+    with _lock:
+        lock = _analysis_locks.get(doc_id)
+        if lock is None:
+            lock = _analysis_locks[doc_id] = FileLock(_analysis_lock_path(doc_id))
+        return lock
+
+
+def _forget(doc_id: str) -> None:
+    """Documento cancellato: via anche il suo lock di analisi, in memoria e in .locks."""
+    _analysis_locks.pop(doc_id, None)
+    try:
+        os.remove(_analysis_lock_path(doc_id))
+    except FileNotFoundError:
+        pass
+
+
+def load_analysis(doc_id: str) -> list[dict] | None:
+    """Pagine analizzate in precedenza, se ancora valide (FIRME_DEDUP_TTL), altrimenti None."""
+    path = os.path.join(doc_dir(doc_id), "analysis.json")
+    try:
+        if time.time() - os.path.getmtime(path) > FIRME_DEDUP_TTL:
+            return None
+    except OSError:
+        return None
+    pages = _read_json(path)
+    if not isinstance(pages, list):
+        return None
+    d = doc_dir(doc_id)
+    if not all(os.path.exists(os.path.join(d, f"page_{p['index']}.png")) for p in pages):
+        return None
+    return pages
+
+
+def save_analysis(doc_id: str, pages: list[dict]) -> None:
+    """Salva i risultati di un'analisi completata (senza URL, che dipendono dalla richiesta)."""
+    keep = ("index", "width", "height", "auto_boxes", "skipped")
+    _write_json(os.path.join(doc_dir(doc_id), "analysis.json"),
+                [{k: p[k] for k in keep if k in p} for p in pages])
+
+
+# ========= Spazio su disco: TTL, quota, statistiche =========
+def touch(doc_id: str) -> None:
+    """Segna il documento come usato adesso (mtime della cartella, per TTL e LRU)."""
+    try:
+        os.utime(doc_dir(doc_id))
+    except OSError:
+        pass
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    total += _dir_size(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return total
+
+
+def _scan() -> list[dict]:
+    """[{doc_id, path, bytes, last_used}, ...] delle cartelle documento (anche quelle legacy uuid4)."""
+    out = []
+    try:
+        entries = list(os.scandir(DOCS_FIRME_ROOT))
+    except FileNotFoundError:
+        return out
+    for entry in entries:
+        if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+            continue
+        try:
+            out.append({
+                "doc_id": entry.name,
+                "path": entry.path,
+                "bytes": _dir_size(entry.path),
+                "last_used": entry.stat().st_mtime,
+            })
+        except OSError:
+            continue
+    return out
+
+
+def _busy(doc_id: str, last_used: float, now: float) -> bool:
+    """In analisi adesso (in qualunque processo) o usato da meno di FIRME_STORE_GRACE secondi."""
+    if now - last_used < FIRME_STORE_GRACE:
+        return True
+    lock = _analysis_locks.get(doc_id) or FileLock(_analysis_lock_path(doc_id))
+    return lock.locked()
+
+
+def _has_refs(doc: dict) -> bool:
+    """Qualcuno ha caricato il documento e non l'ha ancora confermato."""
+    return bool(_read_refs(os.path.join(doc["path"], "refs.json")))
+
+
+def _remove(doc: dict, reason: str) -> None:
+    shutil.rmtree(doc["path"], ignore_errors=True)
+    _forget(doc["doc_id"])
+    _counters[reason] += 1
+    _counters["bytes_freed"] += doc["bytes"]
+    print(f"[FIRME] Storage: rimosso {doc['doc_id'][:12]} ({reason}, {doc['bytes'] / 1e6:.1f} MB)", flush=True)
+
+
+def enforce_quota(docs: list[dict] | None = None) -> None:
+    """Sfratta i documenti meno usati di recente finché docs_firme non rientra nella quota."""
+    if FIRME_STORE_QUOTA_MB <= 0:
+        return
+    quota = FIRME_STORE_QUOTA_MB * 1024 * 1024
+    with _lock:
+        docs = _scan() if docs is None else docs
+        total = sum(d["bytes"] for d in docs)
+        if total <= quota:
+            return
+        now = time.time()
+        for doc in sorted(docs, key=lambda d: d["last_used"]):
+            if total <= quota:
+                break
+            if _busy(doc["doc_id"], doc["last_used"], now) or _has_refs(doc):
+                continue
+            _remove(doc, "evicted")
+            total -= doc["bytes"]
+        if total > quota:
+            print(f"[FIRME][WARN] Storage oltre quota ({total / 1e6:.0f} MB): documenti tutti in uso "
+                  f"o in revisione", flush=True)
+
+
+def sweep() -> None:
+    """Pulizia completa: upload interrotti, documenti scaduti (TTL), poi quota."""
+    now = time.time()
+    with _lock:
+        # upload interrotti a metà
+        if os.path.isdir(INCOMING_DIR):
+            for entry in os.scandir(INCOMING_DIR):
+                try:
+                    if now - entry.stat().st_mtime > 3600:
+                        os.remove(entry.path)
+                except OSError:
+                    continue
+
+        # lock di analisi rimasti da documenti già cancellati
+        if os.path.isdir(LOCKS_DIR):
+            for entry in os.scandir(LOCKS_DIR):
+                doc_id = entry.name[:-len(".lock")]
+                if (entry.name.endswith(".lock") and is_valid_doc_id(doc_id)
+                        and not os.path.isdir(doc_dir(doc_id)) and not FileLock(entry.path).locked()):
+                    _forget(doc_id)
+
+        docs = []
+        for doc in _scan():
+            if now - doc["last_used"] > FIRME_STORE_TTL and not _busy(doc["doc_id"], doc["last_used"], now):
+                _remove(doc, "expired")
+            else:
+                docs.append(doc)
+        enforce_quota(docs)
+        _counters["sweeps"] += 1
+        _counters["last_sweep"] = now
+
+
+def start_sweeper() -> threading.Thread:
+    """Thread daemon che esegue sweep() subito e poi ogni FIRME_STORE_SWEEP_S secondi."""
+    def _loop():
+        while True:
+            try:
+                sweep()
+            except Exception as e:
+                print(f"[FIRME][WARN] Pulizia docs_firme fallita: {e}", flush=True)
+            time.sleep(max(10, FIRME_STORE_SWEEP_S))
+
+    t = threading.Thread(target=_loop, daemon=True, name="firme-sweeper")
+    t.start()
+    return t
+
+
+def stats() -> dict:
+    """Occupazione attuale di docs_firme e contatori di pulizia."""
+    docs = _scan()
+    total = sum(d["bytes"] for d in docs)
+    now = time.time()
+    quota = FIRME_STORE_QUOTA_MB * 1024 * 1024
+    with _lock:
+        counters = dict(_counters)
+    return {
+        "root": DOCS_FIRME_ROOT,
+        "scratch": bool(FIRME_SCRATCH_DIR),
+        "documents": len(docs),
+        "bytes": total,
+        "quota_bytes": quota or None,
+        "usage": round(total / quota, 3) if quota else None,
+        "oldest_age_s": round(now - min(d["last_used"] for d in docs)) if docs else None,
+        "ttl_s": FIRME_STORE_TTL,
+        **counters,
+    }
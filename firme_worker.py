@@ -0,0 +1,388 @@
+# firme_worker.py
+"""
+Worker di inferenza per il modello firme, separato dai thread Flask.
+
+Il modello YOLO vive in uno (o pochi) processi dedicati: il processo web non
+importa torch e non ne tiene in memoria i pesi. Le pagine viaggiano in shared
+memory (nessuna serializzazione dei pixel), le richieste di utenti diversi
+vengono raggruppate in batch e, se la coda è piena, la richiesta viene
+rifiutata (InferenceBusy) invece di rallentare le altre dashboard.
+
+ENV:
+  FIRME_WORKERS          (default: 1)  numero di processi; 0 = inferenza inline nel processo web
+  FIRME_TORCH_THREADS    (default: metà dei core) thread intra-op del backend (FIRME_BACKEND) per worker
+  FIRME_BATCH_SIZE       (default: 8)  pagine massime per chiamata predict
+  FIRME_BATCH_WAIT_MS    (default: 20) attesa massima per riempire un batch
+  FIRME_MAX_INFLIGHT     (default: 64) pagine in coda/in elaborazione (backpressure)
+  FIRME_QUEUE_TIMEOUT    (default: 30) secondi di attesa per un posto in coda
+  FIRME_INFER_TIMEOUT    (default: 300) secondi massimi per una singola pagina
+  FIRME_WATCH_S          (default: 1)  ogni quanti secondi si controlla che i worker siano vivi
+  FIRME_START_RETRIES    (default: 3)  avvii falliti di fila (modello non caricabile) prima di smettere
+  FIRME_START_COOLDOWN_S (default: 300) secondi senza nuovi avvii dopo FIRME_START_RETRIES fallimenti
+"""
+import os
+import time
+import queue
+import threading
+import itertools
+import multiprocessing as mp
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+
+FIRME_WORKERS = int(os.environ.get("FIRME_WORKERS", "1"))
+FIRME_TORCH_THREADS = int(os.environ.get("FIRME_TORCH_THREADS", str(max(1, (os.cpu_count() or 2) // 2))))
+FIRME_BATCH_SIZE = int(os.environ.get("FIRME_BATCH_SIZE", "8"))
+FIRME_BATCH_WAIT_MS = int(os.environ.get("FIRME_BATCH_WAIT_MS", "20"))
+FIRME_MAX_INFLIGHT = int(os.environ.get("FIRME_MAX_INFLIGHT", "64"))
+FIRME_QUEUE_TIMEOUT = float(os.environ.get("FIRME_QUEUE_TIMEOUT", "30"))
+FIRME_INFER_TIMEOUT = float(os.environ.get("FIRME_INFER_TIMEOUT", "300"))
+FIRME_WATCH_S = float(os.environ.get("FIRME_WATCH_S", "1"))
+FIRME_START_RETRIES = int(os.environ.get("FIRME_START_RETRIES", "3"))
+FIRME_START_COOLDOWN_S = float(os.environ.get("FIRME_START_COOLDOWN_S", "300"))
+
+
+class InferenceBusy(RuntimeError):
+    """Coda di inferenza piena: il chiamante deve riprovare più tardi."""
+
+
+class InferenceError(RuntimeError):
+    """Errore nel worker (modello non caricabile, predict fallita, ...)."""
+
+
+# ========= Lato worker (processo dedicato) =========
+def _worker_main(req_q, resp_q, torch_threads: int, batch_size: int, batch_wait_s: float):
+    """Loop del processo worker: carica il modello e serve batch di pagine."""
+    # limita i thread prima che torch/OpenMP vengano importati
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(torch_threads)
+
+    import numpy as np
+    from firme_model import get_yolo_firme, predict_signatures, set_threads, FIRME_BACKEND
+
+    try:
+        set_threads(torch_threads, 1)
+        model = get_yolo_firme()
+    except Exception as e:
+        print(f"[FIRME][WORKER] Caricamento modello fallito: {e}", flush=True)
+        resp_q.put(("fatal", None, str(e)))
+        return
+
+    print(f"[FIRME][WORKER] pid={os.getpid()} pronto (backend {FIRME_BACKEND}, threads={torch_threads})", flush=True)
+    resp_q.put(("ready", None, os.getpid()))
+
+    while True:
+        item = req_q.get()
+        if item is None:
+            break
+        batch = [item]
+        deadline = time.monotonic() + batch_wait_s
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                nxt = req_q.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if nxt is None:
+                req_q.put(None)  # ripropaga lo stop agli altri worker
+                break
+            batch.append(nxt)
+
+        ids, images, sizes, segments = [], [], [], []
+        for req_id, shm_name, shape, dtype, imgsz in batch:
+            try:
+                shm = shared_memory.SharedMemory(name=shm_name)
+            except FileNotFoundError:
+                # il client ha rinunciato (InferenceClient.cancel) e rimosso il segmento
+                continue
+            segments.append(shm)
+            ids.append(req_id)
+            images.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+            sizes.append(imgsz)
+
+        try:
+            results = predict_signatures(model, images, imgsz=sizes)
+            for req_id, boxes in zip(ids, results):
+                resp_q.put(("ok", req_id, boxes))
+        except Exception as e:
+            for req_id in ids:
+                resp_q.put(("error", req_id, str(e)))
+        finally:
+            del images
+            for shm in segments:
+                shm.close()
+
+
+# ========= Lato web (client) =========
+class InferenceClient:
+    """
+    Client thread-safe verso il pool di worker.
+
+    submit() copia la pagina in un segmento di shared memory e restituisce un
+    Future con le box normalizzate; detect() è la versione bloccante per liste.
+    Chi smette di attendere un Future deve chiamare cancel(), che libera subito
+    segmento e posto in coda. Se un worker muore, le richieste in corso
+    falliscono con InferenceError senza aspettare FIRME_INFER_TIMEOUT. Dopo
+    FIRME_START_RETRIES avvii falliti di fila (worker morti prima di essere
+    pronti) il pool non viene più riavviato per FIRME_START_COOLDOWN_S secondi:
+    submit() solleva subito InferenceError con l'ultimo errore.
+    """
+
+    def __init__(self, workers: int = FIRME_WORKERS, torch_threads: int = FIRME_TORCH_THREADS,
+                 batch_size: int = FIRME_BATCH_SIZE, batch_wait_ms: int = FIRME_BATCH_WAIT_MS,
+                 max_inflight: int = FIRME_MAX_INFLIGHT):
+        self.workers = max(1, workers)
+        self.torch_threads = torch_threads
+        self.batch_size = batch_size
+        self.batch_wait_s = batch_wait_ms / 1000
+        self.max_inflight = max_inflight
+
+        # spawn: non si eredita lo stato dei thread Flask
+        self._ctx = mp.get_context("spawn")
+        self._req_q = None
+        self._resp_q = None
+        self._procs = []
+        self._slots = threading.BoundedSemaphore(max_inflight)
+        self._pending: dict[int, tuple[Future, shared_memory.SharedMemory]] = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self.last_error: str | None = None  # ultimo errore fatale dei worker
+        self._start_failures = 0            # avvii falliti di fila
+        self._failed_at = 0.0               # monotonic dell'ultimo avvio fallito
+        self._dispatcher = None
+        self._stopping = threading.Event()  # arresto della generazione corrente di worker
+
+    # --- ciclo di vita ---
+    def start(self):
+        with self._lock:
+            if self._procs and all(p.is_alive() for p in self._procs):
+                return
+            self._stop_locked()
+            self.last_error = None
+            self._req_q = self._ctx.Queue(maxsize=self.max_inflight)
+            self._resp_q = self._ctx.Queue()
+            self._procs = []
+            self._stopping = threading.Event()
+            for _ in range(self.workers):
+                p = self._ctx.Process(
+                    target=_worker_main,
+                    args=(self._req_q, self._resp_q, self.torch_threads,
+                          self.batch_size, self.batch_wait_s),
+                    daemon=True,
+                    name="firme-inference",
+                )
+                p.start()
+                self._procs.append(p)
+            self._dispatcher = threading.Thread(
+                target=self._dispatch, args=(self._resp_q, list(self._procs), self._stopping), daemon=True
+            )
+            self._dispatcher.start()
+            print(f"[FIRME] Avviati {self.workers} worker di inferenza", flush=True)
+
+    def _stop_locked(self):
+        # il dispatcher non deve più prendere il lock (lo teniamo noi mentre lo aspettiamo)
+        self._stopping.set()
+        if self._req_q is not None:
+            for _ in self._procs:
+                try:
+                    self._req_q.put_nowait(None)
+                except Exception:
+                    pass
+        for p in self._procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._procs = []
+        if self._resp_q is not None:
+            self._resp_q.put(("stop", None, None))
+            if self._dispatcher is not None:
+                self._dispatcher.join(timeout=5)
+        self._fail_pending_locked("Worker di inferenza arrestato")
+
+    def stop(self):
+        with self._lock:
+            self._stop_locked()
+
+    def alive(self) -> bool:
+        """True se tutti i worker sono in esecuzione."""
+        return bool(self._procs) and all(p.is_alive() for p in self._procs)
+
+    # --- risposte ---
+    def _dispatch(self, resp_q, procs, stopping):
+        ready = False
+        while True:
+            try:
+                kind, req_id, payload = resp_q.get(timeout=FIRME_WATCH_S)
+            except queue.Empty:
+                kind = None
+            except (EOFError, OSError):
+                return  # coda chiusa (arresto del processo web)
+            if kind == "stop" or stopping.is_set():
+                return
+            if kind is None:
+                dead = next((p for p in procs if not p.is_alive()), None)
+                if dead is not None:
+                    self._worker_died(dead, ready)
+                    return
+                continue
+            if kind == "ready":
+                if not ready:
+                    ready = True
+                    with self._lock:
+                        self._start_failures = 0
+                continue
+            if kind == "fatal":
+                with self._lock:
+                    self.last_error = payload
+                    self._fail_pending_locked(payload)
+                continue
+            with self._lock:
+                entry = self._pending.pop(req_id, None)
+            if entry is None:
+                continue
+            fut, shm = entry
+            self._release(shm)
+            if kind == "ok":
+                fut.set_result(payload)
+            else:
+                fut.set_exception(InferenceError(payload))
+
+    def _worker_died(self, proc, ready: bool):
+        """
+        Un worker è terminato (crash, OOM kill): non si sa quali richieste
+        avesse in mano, falliscono subito tutte quelle in corso. Il prossimo
+        submit() riavvia il pool (alive() è False). Se nessun worker era
+        ancora pronto l'avvio conta come fallito (vedi _check_restart).
+        """
+        msg = f"Worker di inferenza terminato (pid={proc.pid}, exitcode={proc.exitcode})"
+        print(f"[FIRME][ERR] {msg}", flush=True)
+        with self._lock:
+            self.last_error = self.last_error or msg
+            if not ready:
+                self._start_failures += 1
+                self._failed_at = time.monotonic()
+            self._fail_pending_locked(self.last_error)
+
+    def _release(self, shm):
+        try:
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        self._slots.release()
+
+    def _fail_pending_locked(self, msg: str):
+        pending, self._pending = self._pending, {}
+        for fut, shm in pending.values():
+            self._release(shm)
+            if not fut.done():
+                fut.set_exception(InferenceError(msg))
+
+    # --- API ---
+    def cancel(self, futures) -> None:
+        """
+        Rinuncia alle richieste non ancora completate (timeout, pipeline
+        interrotta): rimuove il segmento e libera il posto in coda. Un worker
+        che l'avesse già agganciato lo usa fino in fondo; la sua risposta
+        viene ignorata.
+        """
+        waiting = {id(f) for f in futures if not f.done()}
+        if not waiting:
+            return
+        with self._lock:
+            dropped = [req_id for req_id, (fut, _) in self._pending.items() if id(fut) in waiting]
+            entries = [self._pending.pop(req_id) for req_id in dropped]
+        for fut, shm in entries:
+            self._release(shm)
+            fut.cancel()
+
+    def submit(self, image, imgsz: int | None = None) -> Future:
+        """
+        Accoda una pagina (array numpy HxWx3 BGR). Solleva InferenceBusy se la coda è piena.
+        imgsz: None = pagina intera, altrimenti ritaglio (vedi firme_model.roi_imgsz).
+        """
+        import numpy as np
+
+        self._acquire_slot()
+        arr = np.asarray(image)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, arr.nbytes))
+        # copia unica (gestisce anche viste non contigue, es. RGB->BGR)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        return self._enqueue(shm, arr.shape, arr.dtype.str, imgsz)
+
+    def submit_shm(self, shm_name: str, shape: tuple, dtype: str = "|u1",
+                   imgsz: int | None = None) -> Future:
+        """
+        Accoda una pagina già presente in shared memory (es. scritta da un processo
+        di rendering), senza copiarla. Il segmento passa sempre al client, che lo
+        rimuove a risposta ricevuta (o subito, se la richiesta viene rifiutata).
+        """
+        shm = shared_memory.SharedMemory(name=shm_name)
+        try:
+            self._acquire_slot()
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+        return self._enqueue(shm, tuple(shape), dtype, imgsz)
+
+    def _check_restart(self):
+        """InferenceError invece di un nuovo avvio se gli ultimi FIRME_START_RETRIES sono falliti."""
+        with self._lock:
+            if self._start_failures < FIRME_START_RETRIES:
+                return
+            wait = FIRME_START_COOLDOWN_S - (time.monotonic() - self._failed_at)
+            if wait <= 0:
+                return
+            raise InferenceError(f"Modello firme non disponibile ({self._start_failures} avvii falliti: "
+                                 f"{self.last_error}); nuovo tentativo tra {int(wait) + 1} s")
+
+    def _acquire_slot(self):
+        # worker mai avviato o terminato (es. modello non caricabile): nuovo tentativo, se non sono troppi
+        if not self.alive():
+            self._check_restart()
+            self.start()
+        if not self._slots.acquire(timeout=FIRME_QUEUE_TIMEOUT):
+            raise InferenceBusy("Troppe pagine in coda per il rilevamento firme, riprova tra poco")
+
+    def _enqueue(self, shm, shape: tuple, dtype: str, imgsz: int | None = None) -> Future:
+        fut: Future = Future()
+        req_id = next(self._ids)
+        with self._lock:
+            self._pending[req_id] = (fut, shm)
+        try:
+            self._req_q.put((req_id, shm.name, shape, dtype, imgsz), timeout=FIRME_QUEUE_TIMEOUT)
+        except queue.Full:
+            with self._lock:
+                self._pending.pop(req_id, None)
+            self._release(shm)
+            raise InferenceBusy("Coda di inferenza piena, riprova tra poco")
+        return fut
+
+    def detect(self, images: list, sizes: list | None = None,
+               timeout: float = FIRME_INFER_TIMEOUT) -> list[list[dict]]:
+        """Versione bloccante: box normalizzate per ogni immagine, nello stesso ordine."""
+        futures = []
+        try:
+            for img, imgsz in zip(images, sizes or [None] * len(images)):
+                futures.append(self.submit(img, imgsz))
+            return [f.result(timeout=timeout) for f in futures]
+        finally:
+            # timeout o errore su una pagina: le altre non restano in coda
+            self.cancel(futures)
+
+
+_client: InferenceClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_inference_client() -> InferenceClient | None:
+    """Client condiviso del processo web; None se FIRME_WORKERS=0 (inferenza inline)."""
+    global _client
+    if FIRME_WORKERS <= 0:
+        return None
+    with _client_lock:
+        if _client is None:
+            _client = InferenceClient()
+        return _client
@@ -0,0 +1,75 @@
+# gunicorn.conf.py
+"""
+Avvio di produzione: gunicorn -c gunicorn.conf.py avvia_tool:app
+
+Più processi worker (uno per core di default), ognuno con un pool di thread
+per le richieste lente (upload, stream SSE dei job, ZIP). L'app viene
+importata una volta nel master (preload_app) e i worker nascono per fork:
+codice e moduli già importati restano pagine condivise in copy-on-write.
+
+Stato tra i worker (shared_state): lock degli scraper e dei documenti su
+file, cache RDP e job di analisi su SQLite; scraper, monitor e pulizia di
+docs_firme girano in un solo worker.
+
+Inferenza firme: come con python avvia_tool.py, ogni worker gunicorn avvia
+(alla prima analisi, o subito con FIRME_PRELOAD=1) i propri processi di
+inferenza dedicati (firme_worker, FIRME_WORKERS per worker, avviati con
+spawn quindi senza ereditare nulla dal fork): torch resta fuori dai thread
+delle richieste. Ogni worker gunicorn ha una quota dei core per l'inferenza
+(FIRME_TORCH_THREADS) e per il rendering (FIRME_RENDER_PROCS); in memoria ci
+sono WEB_CONCURRENCY x FIRME_WORKERS copie del modello.
+
+Con FIRME_WORKERS=0 (inferenza inline nei thread delle richieste, una copia
+del modello per worker) e FIRME_PRELOAD=1 il modello torch viene caricato nel
+master prima dei fork e condiviso in copy-on-write (una copia sola finché le
+pagine dei pesi non vengono scritte). Il prezzo: i thread OpenMP/MKL creati
+nel master non sopravvivono al fork, quindi il backend deve essere torch e
+l'inferenza inline compete con le richieste per la CPU. Valori espliciti
+nell'ambiente hanno sempre la precedenza; FIRME_WORKERS, FIRME_TORCH_THREADS
+e FIRME_RENDER_PROCS valgono per ogni worker gunicorn.
+
+ENV:
+  PORT              (default: 8081)
+  WEB_CONCURRENCY   (default: numero di core) processi worker
+  GUNICORN_THREADS  (default: 8)   thread per worker
+  GUNICORN_TIMEOUT  (default: 300) secondi massimi di una richiesta (analisi ?sync=1 comprese)
+"""
+import os
+
+_cores = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8081')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", str(_cores)))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+preload_app = True
+accesslog = "-"
+
+# letti dai moduli dell'app al preload (dopo questo file)
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# quota dei core per worker gunicorn: inferenza dedicata e rendering (inline: thread intra-op)
+os.environ.setdefault("FIRME_TORCH_THREADS", str(max(1, _cores // workers)))
+os.environ.setdefault("FIRME_INTRA_THREADS", str(max(1, _cores // workers)))
+os.environ.setdefault("FIRME_RENDER_PROCS", str(max(1, _cores // workers)))
+
+
+def when_ready(server):
+    """Nel master, prima dei fork: con inferenza inline e FIRME_PRELOAD=1, modello torch caricato una volta e condiviso."""
+    from firme import FIRME_PRELOAD
+    from firme_model import get_yolo_firme, FIRME_BACKEND
+    from firme_worker import FIRME_WORKERS
+
+    # solo torch: ONNX Runtime / OpenVINO creano thread nativi al caricamento, da non ereditare col fork
+    if FIRME_PRELOAD and FIRME_WORKERS <= 0 and FIRME_BACKEND == "torch":
+        try:
+            get_yolo_firme()
+        except Exception as e:
+            server.log.warning(f"[FIRME] Preload del modello nel master fallito: {e}")
+
+
+def post_fork(server, worker):
+    """In ogni worker: thread di background (job unici solo nel worker eletto)."""
+    from avvia_tool import start_background
+
+    start_background()
@@ -1,6 +1,7 @@
 import requests
 from bs4 import BeautifulSoup
 import re
+import os
 import json
 import time
 
@@ -116,6 +117,22 @@ def scrape_mobilita():
 
 if __name__ == "__main__":
     dati = scrape_mobilita()
-    with open("bandi-mobilita.json", "w", encoding="utf-8") as f:
+    # scrittura atomica: il processo web può leggere il file in qualunque momento
+    with open("bandi-mobilita.json.tmp", "w", encoding="utf-8") as f:
         json.dump(dati, f, ensure_ascii=False, indent=2)
+    os.replace("bandi-mobilita.json.tmp", "bandi-mobilita.json")
     print("📁 File salvato: bandi-mobilita.json")
+
+    # indice di ricerca (/api/search): riscrive solo i bandi cambiati
+    try:
+        import search_index
+        print(f"[OK] Indice di ricerca aggiornato: {search_index.index_source('mob', dati)}")
+    except Exception as e:
+        print(f"[WARN] Indice di ricerca non aggiornato: {e}")
+
+    # join dei bandi (bandi-join.json, letto da index.html e stato-avanzamento.html)
+    try:
+        import bandi_join
+        print(f"[OK] Join dei bandi aggiornato: {bandi_join.summary(bandi_join.write_join())}")
+    except Exception as e:
+        print(f"[WARN] Join dei bandi non aggiornato: {e}")
@@ -1,4 +1,5 @@
 import requests
+import os
 import json
 from bs4 import BeautifulSoup
 import time
@@ -146,10 +147,26 @@ def main():
             time.sleep(1)  # per non stressare troppo il server
 
     # Salvataggio finale (stesso nome di prima per non toccare frontend/backend)
-    with open("bandi-concorsi-pubblici-sol.json", "w", encoding="utf-8") as f:
+    # scrittura atomica: il processo web può leggere il file in qualunque momento
+    with open("bandi-concorsi-pubblici-sol.json.tmp", "w", encoding="utf-8") as f:
         json.dump(bandi_info, f, ensure_ascii=False, indent=2)
+    os.replace("bandi-concorsi-pubblici-sol.json.tmp", "bandi-concorsi-pubblici-sol.json")
     print("[OK] File salvato: bandi-concorsi-pubblici-sol.json")
 
+    # indice di ricerca (/api/search): riscrive solo i bandi cambiati
+    try:
+        import search_index
+        print(f"[OK] Indice di ricerca aggiornato: {search_index.index_source('sol', bandi_info)}")
+    except Exception as e:
+        print(f"[WARN] Indice di ricerca non aggiornato: {e}")
+
+    # join dei bandi (bandi-join.json, letto da index.html e stato-avanzamento.html)
+    try:
+        import bandi_join
+        print(f"[OK] Join dei bandi aggiornato: {bandi_join.summary(bandi_join.write_join())}")
+    except Exception as e:
+        print(f"[WARN] Join dei bandi non aggiornato: {e}")
+
 
 if __name__ == "__main__":
     main()
@@ -214,6 +214,31 @@ def _pdf_has_text(pdf_bytes: bytes) -> bool:
         return False
 
 
+_corpus_mod = None
+
+
+def _corpus():
+    """
+    corpus_allegati (archivio del testo, pool di estrazione), importato al
+    primo PDF; None se non disponibile: si usa _pdf_has_text come prima.
+    """
+    global _corpus_mod
+    if _corpus_mod is None:
+        try:
+            import corpus_allegati
+            _corpus_mod = corpus_allegati
+        except Exception as e:
+            print(f"[WARN] corpus_allegati non disponibile, testo dei PDF non archiviato: {e}")
+            _corpus_mod = False
+    return _corpus_mod or None
+
+
+def _shutdown_corpus():
+    """Chiude il pool di estrazione, se è stato avviato."""
+    if _corpus_mod:
+        _corpus_mod.shutdown()
+
+
 def _pdf_tag_info(pdf_bytes: bytes) -> dict:
     info = {"is_tagged": False, "has_struct_tree": False, "lang": None, "title": None}
     if not PIKEPDF_AVAILABLE:
@@ -246,6 +271,8 @@ def valuta_accessibilita_pdf(url: str) -> dict:
     Scarica e valuta un PDF. Euristica 'accessible':
       - deve esserci testo estraibile
       - e almeno uno tra: PDF taggato, struttura o lingua impostata
+    Il testo estratto resta in corpus_allegati, se disponibile (chiave: sha256
+    del file): un PDF già visto non viene estratto di nuovo.
     """
     out = {
         "checked": False,
@@ -265,8 +292,23 @@ def valuta_accessibilita_pdf(url: str) -> dict:
 
     out["checked"] = True
     out["is_pdf"] = True
-    out["has_text"] = _pdf_has_text(pdf)
+    # estrazione del testo nel pool di corpus_allegati, intanto si leggono i tag
+    corpus, pending, pages = _corpus(), None, None
+    if corpus is not None:
+        try:
+            out["sha256"], pending = corpus.submit(pdf)
+        except Exception as e:
+            print(f"[WARN] Estrazione testo non avviata: {e}")
     tag = _pdf_tag_info(pdf)
+    if pending is not None:
+        try:
+            pages = pending.result(timeout=corpus.CORPUS_TIMEOUT)
+        except Exception:
+            pages = None
+    if pages is not None:
+        out["has_text"] = len("".join(pages).strip()) >= 200  # soglia robusta
+    else:
+        out["has_text"] = _pdf_has_text(pdf)
     out["is_tagged"] = tag["is_tagged"]
     out["has_struct_tree"] = tag["has_struct_tree"]
     out["lang"] = tag["lang"]
@@ -666,6 +708,7 @@ def backfill_accessibility_on_json(path: str = "bandi-completi-urp.json") -> Non
 if __name__ == "__main__":
     if "--refresh-accessibility" in sys.argv:
         backfill_accessibility_on_json("bandi-completi-urp.json")
+        _shutdown_corpus()
         sys.exit(0)
 
     dati_finali = {}
@@ -676,12 +719,29 @@ if __name__ == "__main__":
 
     # Scrape archivio vecchio
     dati_finali["archivio-vecchio"] = parse_archivio_old_urp()
+    _shutdown_corpus()  # fine dei PDF da valutare: nessun processo di estrazione resta aperto
 
     # Salva JSON completo
-    with open("bandi-completi-urp.json", "w", encoding="utf-8") as f:
+    # scrittura atomica: il processo web può leggere il file in qualunque momento
+    with open("bandi-completi-urp.json.tmp", "w", encoding="utf-8") as f:
         json.dump(dati_finali, f, ensure_ascii=False, indent=2)
+    os.replace("bandi-completi-urp.json.tmp", "bandi-completi-urp.json")
     print("[OK] File salvato: bandi-completi-urp.json")
 
+    # indice di ricerca (/api/search): riscrive solo i bandi cambiati
+    try:
+        import search_index
+        print(f"[OK] Indice di ricerca aggiornato: {search_index.index_source('urp', dati_finali)}")
+    except Exception as e:
+        print(f"[WARN] Indice di ricerca non aggiornato: {e}")
+
+    # join dei bandi (bandi-join.json, letto da index.html e stato-avanzamento.html)
+    try:
+        import bandi_join
+        print(f"[OK] Join dei bandi aggiornato: {bandi_join.summary(bandi_join.write_join())}")
+    except Exception as e:
+        print(f"[WARN] Join dei bandi non aggiornato: {e}")
+
     # Costruisci e salva tabella controllo (>= 2020) in JSON
     rows = build_tabella_controllo(dati_finali, anno_minimo=2020)
     salva_json_controllo(rows, "controllo_criteri_tracce_2020plus.json")
@@ -0,0 +1,473 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ricerca full-text sui bandi: indice invertito SQLite FTS5 su URP, Selezioni
+Online e Mobilità, interrogato da /api/search (avvia_tool) al posto della
+ricerca per sottostringa sui JSON completi fatta da search.html nel browser.
+Il modulo non dipende da Flask: lo importano anche gli scraper.
+
+Campi indicizzati (peso nel ranking BM25 tra parentesi): codice (10),
+protocollo (8, anche quelli degli allegati), titolo (5), titoli degli
+allegati (2), estratto (1).
+
+Tokenizzazione italiana (_terms): minuscolo, senza accenti, apostrofi
+separati ("dell'istituto" -> dell istituto), parole vuote escluse (di, del,
+per, ...), stemming leggero di genere e numero, così "concorso", "concorsi",
+"graduatoria" e "graduatorie" si trovano a vicenda:
+  concorsi -> concors   ricerche -> ricerc   selezione -> selezion
+FTS5 indicizza il testo già ridotto; titoli ed estratti originali restano in
+docs per mostrare i risultati, evidenziati in Python (<mark>) confrontando
+le radici.
+
+Aggiornamento incrementale: ogni documento ha un hash dei campi
+indicizzati; index_source() riscrive solo i documenti nuovi o cambiati e
+toglie quelli spariti dalla fonte. Lo chiamano gli scraper dopo aver salvato
+il JSON; start_watcher() (nel processo web che esegue gli scraper) riallinea
+l'indice quando un JSON cambia per altre vie.
+
+Testo degli allegati PDF dei bandi URP (corpus_allegati, chiave SHA-256 in
+access_check.sha256): indicizzato per pagina in fts_pages, una volta per PDF
+anche se allegato a più bandi, appena l'estrazione è in archivio
+(index_pages). Si cerca con source="allegati": un risultato per pagina, con
+snippet, numero di pagina e bandi a cui il PDF è allegato.
+
+Da riga di comando:
+  python search_index.py            # riallinea con i JSON presenti
+  python search_index.py "ricercatore ibp"
+  python search_index.py --allegati "prova orale"
+
+Sintassi della query: parole in AND, "frase tra virgolette", codici come
+367.600 cercati come sequenza; l'ultima parola vale anche come prefisso
+(ricerca mentre si scrive).
+
+ENV:
+  SEARCH_POLL_S     (default: 30)  intervallo di controllo dei JSON delle fonti
+  SEARCH_MAX_LIMIT  (default: 100) risultati massimi per richiesta
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import html
+import hashlib
+import threading
+import unicodedata
+
+from bandi_join import URP_JSON, SOL_JSON, MOB_JSON, urp_code, load_source, source_mtime, flatten_urp
+from shared_state import FileLock, SharedDB, shared_path
+import corpus_allegati
+
+SEARCH_POLL_S = int(os.environ.get("SEARCH_POLL_S", "30"))
+SEARCH_MAX_LIMIT = int(os.environ.get("SEARCH_MAX_LIMIT", "100"))
+
+SOURCES = {"urp": URP_JSON, "sol": SOL_JSON, "mob": MOB_JSON}
+# fonti di /api/search: i bandi e il testo dei loro allegati PDF (corpus_allegati)
+SEARCH_SOURCES = (*SOURCES, "allegati")
+SOL_DETAIL_URL = "https://selezionionline.cnr.it/jconon/call-detail?callCode="
+
+# colonne FTS cercate e pesi BM25, nello stesso ordine; la colonna "fonte"
+# (peso 0) serve solo al filtro per fonte dentro la MATCH
+_COLUMNS = ("codice", "protocollo", "titolo", "allegati", "estratto")
+_WEIGHTS = (10.0, 8.0, 5.0, 2.0, 1.0)
+
+_db = SharedDB("search", f"""
+CREATE TABLE IF NOT EXISTS docs (
+  id TEXT PRIMARY KEY, source TEXT NOT NULL, hash TEXT NOT NULL, data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS docs_source ON docs (source);
+CREATE VIRTUAL TABLE IF NOT EXISTS fts USING fts5(fonte, {", ".join(_COLUMNS)}, tokenize = "unicode61");
+CREATE TABLE IF NOT EXISTS meta (source TEXT PRIMARY KEY, mtime REAL, indexed_at REAL);
+CREATE TABLE IF NOT EXISTS allegati (doc_rowid INTEGER NOT NULL, hash TEXT NOT NULL, link TEXT, titolo TEXT, tipo TEXT);
+CREATE INDEX IF NOT EXISTS allegati_doc ON allegati (doc_rowid);
+CREATE INDEX IF NOT EXISTS allegati_hash ON allegati (hash);
+CREATE TABLE IF NOT EXISTS pages (rowid INTEGER PRIMARY KEY, hash TEXT NOT NULL, page INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS pages_hash ON pages (hash);
+CREATE VIRTUAL TABLE IF NOT EXISTS fts_pages USING fts5(testo, tokenize = "unicode61");
+""")
+_write_lock = FileLock(shared_path("search-index.lock"))
+
+
+# ========= Tokenizzazione italiana =========
+_WORD_RE = re.compile(r"[0-9a-z]+")
+
+_STOPWORDS = frozenset("""
+a ad al ai agli all alla alle allo anche che chi con col coi da dal dai dagli dall dalla dalle dallo
+del dei degli dell della delle dello di e ed gli i il in l la le lo ma ne nei negli nell nella nelle
+nello non o per su sul sui sugli sull sulla sulle sullo tra fra un una uno
+""".split())
+
+# (desinenza, sostituzione) provate in ordine: plurali in -che/-ghe prima delle vocali finali
+_SUFFIXES = (("che", "c"), ("chi", "c"), ("ghe", "g"), ("ghi", "g"),
+             ("a", ""), ("e", ""), ("i", ""), ("o", ""))
+
+
+def _fold(text: str) -> str:
+    """Minuscolo e senza accenti, carattere per carattere (stesse posizioni del testo originale)."""
+    out = []
+    for ch in text:
+        base = unicodedata.normalize("NFKD", ch.lower())
+        out.append(base[0] if base else ch)
+    return "".join(out)
+
+
+def stem(word: str) -> str:
+    """Stemming leggero (genere e numero) di una parola già passata da _fold."""
+    if len(word) <= 4 or not word.isalpha():
+        return word
+    for suffix, repl in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[: -len(suffix)] + repl
+    return word
+
+
+def _terms(text) -> list[str]:
+    """Radici indicizzabili di un testo (stesso trattamento per documenti e query)."""
+    return [stem(w) for w in _WORD_RE.findall(_fold(str(text or ""))) if w not in _STOPWORDS]
+
+
+# ========= Documenti delle fonti =========
+def _urp_doc(b: dict) -> tuple[str, dict, dict] | None:
+    if not b.get("url"):
+        return None
+    allegati = [a for a in b.get("allegati") or [] if isinstance(a, dict)]
+    codice = urp_code(b) or ""
+    protocolli = [b.get("numero_protocollo")] + [a.get("protocollo") for a in allegati]
+    fields = {
+        "codice": codice,
+        "protocollo": " ".join(str(p) for p in protocolli if p),
+        "titolo": b.get("titolo_bando") or "",
+        "allegati": "\n".join(a.get("titolo") or "" for a in allegati),
+        "estratto": b.get("estratto") or "",
+    }
+    data = {
+        "url": b["url"], "codice": codice, "titolo": fields["titolo"], "categoria": b.get("categoria") or "",
+        "protocollo": b.get("numero_protocollo"), "data": b.get("data_pubblicazione_bando"),
+        "estratto": fields["estratto"],
+        "allegati": [{"titolo": a.get("titolo") or "", "link": a.get("link") or "",
+                      "tipo": a.get("tipo_documento") or a.get("tipo_graduatoria"),
+                      "sha256": (a.get("access_check") or {}).get("sha256")} for a in allegati],
+    }
+    return b["url"], fields, data
+
+
+def _sol_doc(b: dict) -> tuple[str, dict, dict] | None:
+    codice = (b.get("codice") or "").strip()
+    if not codice:
+        return None
+    fields = {"codice": codice, "protocollo": "", "titolo": b.get("titolo") or "", "allegati": "", "estratto": ""}
+    data = {
+        "url": SOL_DETAIL_URL + codice.replace(" ", "%20"), "codice": codice, "titolo": fields["titolo"],
+        "categoria": b.get("tipologia") or "", "protocollo": None,
+        "data": (b.get("data_pubblicazione_inpa") or "")[:10] or None, "estratto": "", "allegati": [],
+    }
+    return f"sol:{codice}", fields, data
+
+
+def _mob_doc(b: dict) -> tuple[str, dict, dict] | None:
+    if not b.get("url"):
+        return None
+    fields = {
+        "codice": b.get("codice") or "", "protocollo": b.get("numero_protocollo") or "",
+        "titolo": b.get("titolo") or b.get("codice") or "", "allegati": "", "estratto": b.get("estratto") or "",
+    }
+    data = {
+        "url": b["url"], "codice": fields["codice"], "titolo": fields["titolo"], "categoria": "mobilita",
+        "protocollo": b.get("numero_protocollo"), "data": b.get("data_pubblicazione_bando"),
+        "estratto": fields["estratto"], "allegati": [],
+    }
+    return f"mob:{b['url']}", fields, data
+
+
+def _documents(source: str, data) -> list[tuple[str, dict, dict]]:
+    if source == "urp":
+        items, make = flatten_urp(data), _urp_doc
+    else:
+        items, make = (data if isinstance(data, list) else []), (_sol_doc if source == "sol" else _mob_doc)
+    return [d for d in (make(it) for it in items if isinstance(it, dict)) if d]
+
+
+# ========= Aggiornamento dell'indice =========
+def index_source(source: str, data=None) -> dict:
+    """
+    Allinea l'indice ai dati di una fonte ("urp", "sol", "mob"): `data` è il
+    contenuto del JSON (letto dal file se None). Riscrive solo i documenti
+    cambiati; restituisce {"added", "updated", "deleted", "unchanged"}.
+    """
+    if source not in SOURCES:
+        raise ValueError(f"Fonte non valida: {source!r}")
+    mtime = source_mtime(SOURCES[source])
+    if data is None:
+        data = load_source(SOURCES[source])
+        if data is None:
+            return {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+
+    stats = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    with _write_lock:
+        conn = _db.connect()
+        known = {doc_id: (rowid, h) for rowid, doc_id, h in
+                 conn.execute("SELECT rowid, id, hash FROM docs WHERE source = ?", (source,))}
+        seen = set()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for doc_id, fields, payload in _documents(source, data):
+                if doc_id in seen:
+                    continue
+                seen.add(doc_id)
+                terms = {c: " ".join(_terms(fields[c])) for c in _COLUMNS}
+                h = hashlib.sha1(json.dumps([fields, payload], ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+                old = known.get(doc_id)
+                if old and old[1] == h:
+                    stats["unchanged"] += 1
+                    continue
+                if old:
+                    conn.execute("DELETE FROM fts WHERE rowid = ?", (old[0],))
+                    conn.execute("DELETE FROM allegati WHERE doc_rowid = ?", (old[0],))
+                    conn.execute("UPDATE docs SET hash = ?, data = ? WHERE rowid = ?",
+                                 (h, json.dumps(payload, ensure_ascii=False), old[0]))
+                    rowid = old[0]
+                    stats["updated"] += 1
+                else:
+                    rowid = conn.execute("INSERT INTO docs (id, source, hash, data) VALUES (?, ?, ?, ?)",
+                                         (doc_id, source, h, json.dumps(payload, ensure_ascii=False))).lastrowid
+                    stats["added"] += 1
+                conn.execute(f"INSERT INTO fts (rowid, fonte, {', '.join(_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (rowid, source, *(terms[c] for c in _COLUMNS)))
+                conn.executemany("INSERT INTO allegati (doc_rowid, hash, link, titolo, tipo) VALUES (?, ?, ?, ?, ?)",
+                                 [(rowid, a["sha256"], a["link"], a["titolo"], a["tipo"])
+                                  for a in payload.get("allegati") or [] if a.get("sha256")])
+            for doc_id, (rowid, _h) in known.items():
+                if doc_id not in seen:
+                    conn.execute("DELETE FROM fts WHERE rowid = ?", (rowid,))
+                    conn.execute("DELETE FROM allegati WHERE doc_rowid = ?", (rowid,))
+                    conn.execute("DELETE FROM docs WHERE rowid = ?", (rowid,))
+                    stats["deleted"] += 1
+            conn.execute("INSERT OR REPLACE INTO meta (source, mtime, indexed_at) VALUES (?, ?, ?)",
+                         (source, mtime, time.time()))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    if source == "urp":
+        stats["pages"] = index_pages()
+    return stats
+
+
+def index_pages() -> int:
+    """
+    Indicizza pagina per pagina il testo (da corpus_allegati) degli allegati
+    non ancora indicizzati e toglie quello dei PDF non più allegati a nessun
+    bando. Ogni PDF viene indicizzato una volta sola, anche se allegato a più
+    bandi. Restituisce le pagine aggiunte.
+    """
+    added = 0
+    with _write_lock:
+        conn = _db.connect()
+        todo = [r[0] for r in conn.execute(
+            "SELECT DISTINCT hash FROM allegati WHERE hash NOT IN (SELECT hash FROM pages)")]
+        ready = corpus_allegati.known(todo)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for h in todo:
+                pages = corpus_allegati.get_pages(h) if h in ready else None
+                if pages is None:
+                    continue  # estrazione non ancora fatta: al prossimo giro
+                if not any(p.strip() for p in pages):
+                    # scansione senza testo: riga segnaposto per non riprovare
+                    conn.execute("INSERT INTO pages (hash, page) VALUES (?, -1)", (h,))
+                    continue
+                for n, text in enumerate(pages):
+                    rowid = conn.execute("INSERT INTO pages (hash, page) VALUES (?, ?)", (h, n)).lastrowid
+                    conn.execute("INSERT INTO fts_pages (rowid, testo) VALUES (?, ?)",
+                                 (rowid, " ".join(_terms(text))))
+                    added += 1
+            conn.execute("DELETE FROM fts_pages WHERE rowid IN "
+                         "(SELECT rowid FROM pages WHERE hash NOT IN (SELECT hash FROM allegati))")
+            conn.execute("DELETE FROM pages WHERE hash NOT IN (SELECT hash FROM allegati)")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return added
+
+
+def sync() -> dict:
+    """Reindicizza le fonti il cui JSON è cambiato dall'ultima indicizzazione e il testo degli allegati mancante."""
+    conn = _db.connect()
+    indexed = dict(conn.execute("SELECT source, mtime FROM meta"))
+    out = {}
+    for source, fname in SOURCES.items():
+        mtime = source_mtime(fname)
+        if mtime is not None and mtime != indexed.get(source):
+            out[source] = index_source(source)
+    if "urp" not in out:
+        pages = index_pages()
+        if pages:
+            out["allegati"] = {"pages": pages}
+    return out
+
+
+def start_watcher() -> threading.Thread:
+    """Thread daemon: sync() all'avvio e ogni SEARCH_POLL_S secondi."""
+    def _loop():
+        while True:
+            try:
+                for source, st in sync().items():
+                    if source == "allegati":
+                        print(f"[SEARCH] Indice allegati: +{st['pages']} pagine", flush=True)
+                        continue
+                    print(f"[SEARCH] Indice {source}: +{st['added']} ~{st['updated']} -{st['deleted']} "
+                          f"(invariati {st['unchanged']})", flush=True)
+            except Exception as e:
+                print(f"[SEARCH] Errore nell'aggiornamento dell'indice: {e}", flush=True)
+            time.sleep(max(1, SEARCH_POLL_S))
+
+    t = threading.Thread(target=_loop, daemon=True, name="search-index")
+    t.start()
+    return t
+
+
+# ========= Query =========
+def _parse_query(q: str) -> tuple[str, set, set]:
+    """
+    Query FTS5 da una query utente, più le radici cercate e i prefissi (per
+    l'evidenziazione). Stringa vuota se non resta nulla da cercare.
+    """
+    parts = re.findall(r'"([^"]*)"?|(\S+)', q)
+    prefix_last = not q.endswith((" ", '"'))
+    clauses, stems, prefixes = [], set(), set()
+    for i, (quoted, word) in enumerate(parts):
+        toks = _terms(quoted or word)
+        if not toks:
+            continue
+        is_prefix = prefix_last and i == len(parts) - 1 and not quoted
+        clauses.append(f'"{" ".join(toks)}"' + ("*" if is_prefix else ""))
+        stems.update(toks[:-1] if is_prefix else toks)
+        if is_prefix:
+            prefixes.add(toks[-1])
+    return " AND ".join(clauses), stems, prefixes
+
+
+def _hit(word: str, stems: set, prefixes: set) -> bool:
+    s = stem(word)
+    return s in stems or any(s.startswith(p) or word.startswith(p) for p in prefixes)
+
+
+def highlight(text: str, stems: set, prefixes: set, max_words: int = 0) -> str:
+    """
+    HTML (escaped) di `text` con <mark> sulle parole cercate. Con max_words > 0
+    restituisce solo una finestra di max_words parole attorno alla prima.
+    """
+    text = text or ""
+    folded = _fold(text)
+    spans = [(m.start(), m.end()) for m in _WORD_RE.finditer(folded)]
+    hits = [j for j, (a, b) in enumerate(spans) if _hit(folded[a:b], stems, prefixes)]
+    start, end, pre, post = 0, len(text), "", ""
+    if max_words and len(spans) > max_words:
+        first = hits[0] if hits else 0
+        lo = max(0, min(first - max_words // 3, len(spans) - max_words))
+        hi = lo + max_words - 1
+        start, end = spans[lo][0], spans[hi][1]
+        pre, post = ("… " if lo else ""), (" …" if hi < len(spans) - 1 else "")
+
+    out, pos = [], start
+    for j in hits:
+        a, b = spans[j]
+        if a < start or b > end:
+            continue
+        out.append(html.escape(text[pos:a]))
+        out.append(f"<mark>{html.escape(text[a:b])}</mark>")
+        pos = b
+    out.append(html.escape(text[pos:end]))
+    return pre + "".join(out) + post
+
+
+def search(q: str, source: str | None = None, limit: int = 20, offset: int = 0) -> dict:
+    """
+    Risultati ordinati per rilevanza (BM25 pesato), con campi evidenziati.
+    source="allegati" cerca nel testo dei PDF: un risultato per pagina.
+    """
+    match, stems, prefixes = _parse_query(q or "")
+    if not match:
+        return {"total": 0, "results": []}
+    if source == "allegati":
+        return _search_pages(match, stems, prefixes, limit, offset)
+    match = f"{{{' '.join(_COLUMNS)}}} : ({match})"
+    if source:
+        match = f'fonte : "{source}" AND {match}'
+    conn = _db.connect()
+    total = conn.execute("SELECT count(*) FROM fts WHERE fts MATCH ?", (match,)).fetchone()[0]
+    # prima il ranking sul solo indice, poi i documenti delle righe della pagina
+    ranked = conn.execute(
+        f"SELECT rowid, bm25(fts, 0, {', '.join(map(str, _WEIGHTS))}) AS score FROM fts "
+        "WHERE fts MATCH ? ORDER BY score LIMIT ? OFFSET ?", (match, limit, offset)).fetchall()
+    docs = {}
+    if ranked:
+        marks = ", ".join("?" * len(ranked))
+        docs = {rowid: (src, data) for rowid, src, data in conn.execute(
+            f"SELECT rowid, source, data FROM docs WHERE rowid IN ({marks})", [r[0] for r in ranked])}
+
+    results = []
+    for rowid, score in ranked:
+        if rowid not in docs:
+            continue
+        src, data = docs[rowid]
+        d = json.loads(data)
+        allegati = [{"titolo": highlight(a["titolo"], stems, prefixes), "link": a["link"]}
+                    for a in d.get("allegati") or []
+                    if any(_hit(w, stems, prefixes) for w in _WORD_RE.findall(_fold(a["titolo"])))]
+        results.append({
+            "source": src, "url": d["url"], "categoria": d.get("categoria"), "data": d.get("data"),
+            "codice": highlight(d.get("codice") or "", stems, prefixes),
+            "titolo": highlight(d.get("titolo") or "", stems, prefixes),
+            "protocollo": d.get("protocollo"),
+            "snippet": highlight(d.get("estratto") or "", stems, prefixes, max_words=30),
+            "allegati": allegati[:5],
+            "score": round(-score, 3),
+        })
+    return {"total": total, "results": results}
+
+
+def _search_pages(match: str, stems: set, prefixes: set, limit: int, offset: int) -> dict:
+    conn = _db.connect()
+    total = conn.execute("SELECT count(*) FROM fts_pages WHERE fts_pages MATCH ?", (match,)).fetchone()[0]
+    ranked = conn.execute(
+        "SELECT p.hash, p.page, r.score FROM (SELECT rowid, rank AS score FROM fts_pages "
+        "WHERE fts_pages MATCH ? ORDER BY rank LIMIT ? OFFSET ?) r JOIN pages p ON p.rowid = r.rowid "
+        "ORDER BY r.score", (match, limit, offset)).fetchall()
+
+    results, texts = [], {}
+    for h, page, score in ranked:
+        # un PDF può essere allegato a più bandi: si mostra il primo, gli altri in "bandi"
+        owners = conn.execute(
+            "SELECT a.link, a.titolo, a.tipo, d.data FROM allegati a JOIN docs d ON d.rowid = a.doc_rowid "
+            "WHERE a.hash = ? LIMIT 5", (h,)).fetchall()
+        if not owners:
+            continue
+        if h not in texts:
+            texts[h] = corpus_allegati.get_pages(h) or []
+        text = texts[h][page] if page < len(texts[h]) else ""
+        link, titolo, tipo, data = owners[0]
+        bandi = [json.loads(o[3]) for o in owners]
+        results.append({
+            "source": "allegati", "url": f"{link}#page={page + 1}" if link else None, "pagina": page + 1,
+            "tipo": tipo, "titolo": highlight(titolo or "", stems, prefixes),
+            "codice": bandi[0].get("codice"),
+            "bandi": [{"url": b["url"], "codice": b.get("codice"), "titolo": b.get("titolo")} for b in bandi],
+            "snippet": highlight(text, stems, prefixes, max_words=30),
+            "score": round(-score, 3),
+        })
+    return {"total": total, "results": results}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--allegati":
+        print(json.dumps(search(" ".join(sys.argv[2:]), "allegati", limit=10), ensure_ascii=False, indent=2))
+    elif len(sys.argv) > 1:
+        print(json.dumps(search(" ".join(sys.argv[1:]), limit=10), ensure_ascii=False, indent=2))
+    else:
+        for src in SOURCES:
+            print(src, index_source(src), flush=True)
+    sys.exit(0)
@@ -0,0 +1,205 @@
+# session_store.py
+"""
+Sessioni server-side in SQLite, al posto dei file di Flask-Session.
+
+Con SESSION_TYPE=filesystem ogni richiesta protetta (anche ogni PNG di pagina
+o JSON servito da /_static) apre e de-serializza un file di
+instance/flask_session e a fine richiesta lo riscrive, e la cartella cresce
+senza limiti. Qui invece:
+  - una tabella SQLite in SHARED_STATE_DIR (vista da tutti i worker web, WAL):
+    lettura per chiave primaria, scrittura solo se la sessione è cambiata;
+  - scadenza per inattività (SESSION_TTL): l'ultimo uso viene aggiornato al
+    più una volta ogni decimo di TTL, non a ogni richiesta; le sessioni
+    scadute vengono cancellate da sweep() (thread di start_sweeper);
+  - richieste con URL firmato (signed_urls): la sessione non viene letta;
+  - cache in memoria per processo: una sessione letta da meno di
+    SESSION_CACHE_S secondi non viene riletta dal database. Le modifiche fatte
+    dal processo aggiornano subito la sua cache; un logout fatto da un altro
+    worker viene visto al più dopo SESSION_CACHE_S secondi.
+
+Il cookie contiene l'id di sessione firmato con SECRET_KEY (come
+SESSION_USE_SIGNER di Flask-Session). SESSION_BACKEND=filesystem torna a
+Flask-Session su file, come prima.
+
+ENV:
+  SESSION_BACKEND     (default: sqlite) sqlite | filesystem
+  SESSION_TTL         (default: 86400)  secondi di inattività dopo cui una sessione scade
+  SESSION_CACHE_S     (default: 5)      secondi di validità della cache in memoria; 0 = nessuna cache
+  SESSION_CACHE_SIZE  (default: 1024)   sessioni in cache per processo (LRU)
+  SESSION_SWEEP_S     (default: 600)    intervallo della pulizia delle sessioni scadute
+"""
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from flask_session.sessions import ServerSideSession, SessionInterface
+from itsdangerous import BadSignature, want_bytes
+
+from shared_state import SharedDB
+from signed_urls import has_signature
+
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "sqlite").strip().lower()
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "86400"))
+SESSION_CACHE_S = float(os.environ.get("SESSION_CACHE_S", "5"))
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", "1024"))
+SESSION_SWEEP_S = int(os.environ.get("SESSION_SWEEP_S", "600"))
+
+_db = SharedDB("sessions", """
+CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, expires REAL, data BLOB);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+""")
+
+
+class SQLiteSession(ServerSideSession):
+    pass
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """SessionInterface di Flask su SQLite con cache in memoria (vedi sopra)."""
+
+    session_class = SQLiteSession
+
+    def __init__(self, ttl: int = SESSION_TTL, cache_s: float = SESSION_CACHE_S,
+                 cache_size: int = SESSION_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache_s = cache_s
+        self.cache_size = cache_size
+        # sid -> (letta alle (monotonic), dati)
+        self._cache: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.has_same_site_capability = hasattr(self, "get_cookie_samesite")
+
+    # --- cache in memoria ---
+    def _cached(self, sid: str) -> dict | None:
+        if self.cache_s <= 0:
+            return None
+        with self._lock:
+            entry = self._cache.get(sid)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] >= self.cache_s:
+                del self._cache[sid]
+                return None
+            self._cache.move_to_end(sid)
+            return dict(entry[1])
+
+    def _remember(self, sid: str, data: dict | None) -> None:
+        if self.cache_s <= 0:
+            return
+        with self._lock:
+            if data is None:
+                self._cache.pop(sid, None)
+                return
+            self._cache[sid] = (time.monotonic(), dict(data))
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    # --- database ---
+    def _load(self, sid: str) -> dict | None:
+        conn = _db.connect()
+        now = time.time()
+        row = conn.execute("SELECT expires, data FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None or row[0] <= now:
+            return None
+        try:
+            data = pickle.loads(row[1])
+        except Exception:
+            return None
+        # scadenza scorrevole, aggiornata al più una volta ogni ttl/10
+        if row[0] - now < self.ttl * 0.9:
+            conn.execute("UPDATE sessions SET expires = ? WHERE sid = ?", (now + self.ttl, sid))
+        return data
+
+    def open_session(self, app, request):
+        if has_signature(request):
+            # risorsa con URL firmato: autorizzata dalla firma, sessione vuota e mai salvata
+            return self.session_class(sid=self._generate_sid(), permanent=app.config["SESSION_PERMANENT"])
+        sid = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+        if sid:
+            signer = self._get_signer(app)
+            if signer is None:
+                return None
+            try:
+                sid = signer.unsign(sid).decode()
+            except BadSignature:
+                sid = None
+        if not sid:
+            return self.session_class(sid=self._generate_sid(), permanent=app.config["SESSION_PERMANENT"])
+
+        data = self._cached(sid)
+        if data is None:
+            data = self._load(sid)
+            if data is None:
+                return self.session_class(sid=sid, permanent=app.config["SESSION_PERMANENT"])
+            self._remember(sid, data)
+        return self.session_class(data, sid=sid)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                _db.connect().execute("DELETE FROM sessions WHERE sid = ?", (session.sid,))
+                self._remember(session.sid, None)
+                response.delete_cookie(app.config["SESSION_COOKIE_NAME"], domain=domain, path=path)
+            return
+        # sessione solo letta (quasi tutte le richieste): niente scritture né Set-Cookie
+        if not session.modified:
+            return
+
+        data = dict(session)
+        _db.connect().execute("INSERT OR REPLACE INTO sessions (sid, expires, data) VALUES (?, ?, ?)",
+                              (session.sid, time.time() + self.ttl, sqlite3.Binary(pickle.dumps(data))))
+        self._remember(session.sid, data)
+
+        conditional_cookie_kwargs = {}
+        if self.has_same_site_capability:
+            conditional_cookie_kwargs["samesite"] = self.get_cookie_samesite(app)
+        response.set_cookie(app.config["SESSION_COOKIE_NAME"],
+                            self._get_signer(app).sign(want_bytes(session.sid)).decode(),
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), **conditional_cookie_kwargs)
+
+
+# ========= Avvio e pulizia =========
+def init_app(app) -> None:
+    """Installa il backend di sessione scelto da SESSION_BACKEND."""
+    if SESSION_BACKEND == "filesystem":
+        from flask_session import Session
+
+        os.makedirs(app.config["SESSION_FILE_DIR"], exist_ok=True)
+        Session(app)
+        return
+    if SESSION_BACKEND != "sqlite":
+        raise RuntimeError(f"SESSION_BACKEND non valido: {SESSION_BACKEND!r} (attesi: sqlite, filesystem)")
+    app.session_interface = SQLiteSessionInterface()
+
+
+def sweep() -> int:
+    """Cancella le sessioni scadute; restituisce quante."""
+    return _db.connect().execute("DELETE FROM sessions WHERE expires <= ?", (time.time(),)).rowcount
+
+
+def start_sweeper() -> threading.Thread | None:
+    """Thread daemon che esegue sweep() ogni SESSION_SWEEP_S secondi (solo backend sqlite)."""
+    if SESSION_BACKEND != "sqlite":
+        return None
+
+    def _loop():
+        while True:
+            try:
+                n = sweep()
+                if n:
+                    print(f"[INFO] Sessioni scadute eliminate: {n}", flush=True)
+            except Exception as e:
+                print(f"[WARN] Pulizia sessioni fallita: {e}", flush=True)
+            time.sleep(max(10, SESSION_SWEEP_S))
+
+    t = threading.Thread(target=_loop, daemon=True, name="session-sweeper")
+    t.start()
+    return t
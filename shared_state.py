@@ -0,0 +1,217 @@
+# shared_state.py
+"""
+Stato condiviso tra i processi del server web.
+
+In produzione l'app gira sotto gunicorn con più worker (vedi gunicorn.conf.py):
+ogni worker è un processo separato, quindi lock, cache e job tenuti in
+variabili globali non si vedono tra un worker e l'altro. Qui le primitive
+equivalenti, basate su file in SHARED_STATE_DIR:
+
+  - FileLock: lock esclusivo tra thread e tra processi (flock), con la stessa
+    interfaccia di threading.Lock (acquire/release/locked, with);
+  - SharedCache: cache chiave -> valore JSON con scadenza, in SQLite (WAL);
+  - run_in_one_worker: esegue una funzione (scraper, monitor, pulizie) in un
+    solo processo tra quelli che la chiamano. Il processo che prende il lock
+    lo tiene finché vive; se muore (riavvio del worker) il kernel rilascia il
+    lock e un altro worker subentra entro SHARED_LEADER_RETRY_S secondi.
+
+Con un solo processo (python avvia_tool.py) tutto funziona allo stesso modo.
+Senza fcntl (Windows) i FileLock valgono solo tra i thread del processo.
+
+I database contengono dati riservati (sessioni con i token OIDC, cache):
+SHARED_STATE_DIR sta fuori dalla cartella dell'app, che avvia_tool serve
+come file statici, ed è creata con permessi 0700 (file 0600).
+
+ENV:
+  SHARED_STATE_DIR       (default: $XDG_STATE_HOME/manager-ufficio-reclutamento,
+                          cioè ~/.local/state/...) cartella di lock e database condivisi
+  SHARED_LEADER_RETRY_S  (default: 30)  ogni quanti secondi un worker riprova a prendere i job di background
+  WEB_CONCURRENCY        (default: 1)   processi web (impostato da gunicorn.conf.py); >1 = stato condiviso su SQLite
+"""
+from __future__ import annotations
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+_XDG_STATE_HOME = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR", os.path.join(_XDG_STATE_HOME, "manager-ufficio-reclutamento"))
+SHARED_LEADER_RETRY_S = int(os.environ.get("SHARED_LEADER_RETRY_S", "30"))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+
+# più processi web: i dati che devono vedere tutti (job, cache) passano da SQLite
+MULTI_PROCESS = WEB_CONCURRENCY > 1
+
+
+def shared_path(name: str) -> str:
+    """Percorso di un file condiviso in SHARED_STATE_DIR (cartella creata se manca, solo per l'utente)."""
+    os.makedirs(SHARED_STATE_DIR, mode=0o700, exist_ok=True)
+    return os.path.join(SHARED_STATE_DIR, name)
+
+
+# ========= Lock tra processi =========
+class FileLock:
+    """
+    Lock esclusivo su `path`: un thread alla volta nel processo (threading.Lock
+    o RLock se reentrant=True) e un processo alla volta (flock sul file).
+    Come threading.Lock può essere rilasciato da un thread diverso da quello
+    che l'ha preso (solo se non reentrant). locked() vede anche i lock presi
+    da altri processi.
+    """
+
+    def __init__(self, path: str, reentrant: bool = False):
+        self.path = path
+        self._thread_lock = threading.RLock() if reentrant else threading.Lock()
+        self._fd: int | None = None
+        self._depth = 0
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        if not self._thread_lock.acquire(blocking, timeout):
+            return False
+        if self._depth > 0 or fcntl is None:
+            self._depth += 1
+            return True
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if blocking and timeout < 0:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline = time.monotonic() + max(0.0, timeout)
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not blocking or time.monotonic() >= deadline:
+                            os.close(fd)
+                            self._thread_lock.release()
+                            return False
+                        time.sleep(0.05)
+        except BaseException:
+            os.close(fd)
+            self._thread_lock.release()
+            raise
+        self._fd = fd
+        self._depth = 1
+        return True
+
+    def release(self) -> None:
+        if self._depth <= 0:
+            raise RuntimeError("release di un FileLock non acquisito")
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+    def locked(self) -> bool:
+        """True se il lock è preso, da questo processo o da un altro."""
+        if self._depth > 0:
+            return True
+        if fcntl is None:
+            return False
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return False
+        try:
+            # prova non bloccante: se riesce nessuno lo tiene (e lo si rilascia subito)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return False
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# ========= SQLite condiviso =========
+class SharedDB:
+    """
+    Database SQLite in SHARED_STATE_DIR con una connessione per thread (e per
+    processo: dopo un fork le connessioni ereditate non vengono riusate).
+    `schema` viene eseguito alla prima connessione di ogni processo.
+    """
+
+    def __init__(self, name: str, schema: str = ""):
+        self.name = name
+        self.schema = schema
+        self._local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        path = shared_path(f"{self.name}.sqlite")
+        # file del database (e -wal/-shm, che SQLite crea con gli stessi permessi) leggibili solo dall'utente
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if self.schema:
+            conn.executescript(self.schema)
+        self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+
+class SharedCache:
+    """Cache chiave -> valore (JSON) con scadenza, vista da tutti i processi."""
+
+    _SCHEMA = "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT);"
+
+    def __init__(self, name: str):
+        self._db = SharedDB(f"cache-{name}", self._SCHEMA)
+
+    def get(self, key: str):
+        """Valore salvato con set(); None se assente o scaduto."""
+        row = self._db.connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value, ttl: float) -> None:
+        conn = self._db.connect()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                     (key, now + ttl, json.dumps(value, ensure_ascii=False)))
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+
+
+# ========= Job di background in un solo processo =========
+def run_in_one_worker(name: str, fn) -> threading.Thread:
+    """
+    Esegue fn() in un solo processo tra tutti quelli che chiamano
+    run_in_one_worker(name, ...). Gli altri riprovano ogni
+    SHARED_LEADER_RETRY_S secondi e subentrano se quel processo termina.
+    fn deve solo avviare i propri thread e tornare.
+    """
+    lock = FileLock(shared_path(f"{name}.leader"))
+
+    def _elect():
+        while not lock.acquire(blocking=False):
+            time.sleep(max(1, SHARED_LEADER_RETRY_S))
+        # il lock non viene più rilasciato: lo libera il kernel all'uscita del processo
+        print(f"[INFO] Processo {os.getpid()}: esegue i job di background '{name}'", flush=True)
+        fn()
+
+    t = threading.Thread(target=_elect, daemon=True, name=f"leader-{name}")
+    t.start()
+    return t
@@ -0,0 +1,99 @@
+# signed_urls.py
+"""
+URL firmati (HMAC) e a scadenza per le risorse che la UI carica a decine:
+immagini delle pagine della redazione firme e JSON dei dati.
+
+Le API che restituiscono questi URL (es. image_url di /api/firme/analyze, urls
+di /api/status) li firmano con sign_url(); le route decorate con
+signed_or_login_required accettano un URL firmato valido senza leggere la
+sessione (session_store non la apre nemmeno) e rispondono con cache privata
+del browser fino alla scadenza. Senza firma vale il normale login_required.
+Firma scaduta o non valida: redirect allo stesso URL senza firma, che passa
+dalla sessione come prima.
+
+La scadenza è arrotondata a multipli di SIGNED_URL_TTL: nella stessa finestra
+la stessa risorsa ha sempre lo stesso URL, quindi le visite ripetute vengono
+servite dalla cache del browser; un URL resta valido da SIGNED_URL_TTL a
+2 x SIGNED_URL_TTL secondi. Chi ha l'URL può scaricare la risorsa fino alla
+scadenza, come con un link condiviso: da tenere breve.
+
+ENV:
+  SIGNED_URL_TTL  (default: 3600) validità minima di un URL firmato (secondi); 0 = URL non firmati
+  SIGNED_URL_KEY  (default: SECRET_KEY) chiave HMAC, uguale in tutti i worker
+"""
+import os
+import hmac
+import time
+import base64
+import hashlib
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import request, redirect, make_response
+
+from auth import login_required
+
+SIGNED_URL_TTL = int(os.environ.get("SIGNED_URL_TTL", "3600"))
+_KEY = (os.environ.get("SIGNED_URL_KEY") or os.environ.get("SECRET_KEY", "dev-secret")).encode()
+
+_SIGN_PARAMS = ("exp", "sig")
+
+
+def _signature(path: str, params: dict) -> str:
+    query = urlencode(sorted((k, v) for k, v in params.items() if k != "sig"))
+    digest = hmac.new(_KEY, f"{path}?{query}".encode(), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def sign_url(path: str, params: dict | None = None, ttl: int = SIGNED_URL_TTL) -> str:
+    """
+    URL `path` (completo di script_root) con i parametri `params`, firmato.
+    Non usa il contesto Flask: si può chiamare dai thread dei job.
+    """
+    params = {k: str(v) for k, v in (params or {}).items()}
+    if ttl > 0:
+        params["exp"] = str((int(time.time()) // ttl + 2) * ttl)
+        params["sig"] = _signature(path, params)
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def has_signature(req) -> bool:
+    """La richiesta porta una firma (valida o no): la sessione non serve."""
+    return "sig" in req.args
+
+
+def verify(req) -> int | None:
+    """Secondi di validità rimasti se la firma della richiesta è valida, altrimenti None."""
+    params = req.args.to_dict()
+    try:
+        remaining = int(params.get("exp", "")) - int(time.time())
+    except ValueError:
+        return None
+    if remaining <= 0:
+        return None
+    expected = _signature(req.script_root + req.path, params)
+    return remaining if hmac.compare_digest(expected, params.get("sig", "")) else None
+
+
+def signed_or_login_required(fn):
+    """login_required, oppure un URL firmato valido (vedi sopra)."""
+    protected = login_required(fn)
+
+    @wraps(fn)
+    def _wrapped(*args, **kwargs):
+        if not has_signature(request):
+            return protected(*args, **kwargs)
+        remaining = verify(request)
+        if remaining is None:
+            rest = {k: v for k, v in request.args.items() if k not in _SIGN_PARAMS}
+            url = request.script_root + request.path
+            return redirect(f"{url}?{urlencode(rest)}" if rest else url)
+
+        resp = make_response(fn(*args, **kwargs))
+        if resp.status_code == 200:
+            resp.cache_control.public = False
+            resp.cache_control.no_cache = None
+            resp.cache_control.private = True
+            resp.cache_control.max_age = min(resp.cache_control.max_age or remaining, remaining)
+        return resp
+    return _wrapped